@@ -0,0 +1,315 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+import numpy as np
+
+from rest import app
+from benchmarks.synthetic import SyntheticDataset
+
+TOKEN = 'benchmark-token'
+
+API = '/mug/api/dmp'
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the DMP REST endpoints')
+    parser.add_argument(
+        '--records', type=int, default=1000,
+        help='Number of synthetic file records to register (10^3 - 10^6)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--chain-length', type=int, default=4,
+        help='Number of files in each lineage chain')
+    parser.add_argument(
+        '--iterations', type=int, default=200,
+        help='Number of requests for each scenario')
+    parser.add_argument('--user-id', default='test')
+    parser.add_argument(
+        '--sqlite-path', default=None,
+        help='Use the sqlite backend with the database at this location')
+    parser.add_argument(
+        '--scenario', action='append',
+        help='Only run the named scenario, can be given more than once')
+    parser.add_argument(
+        '--server', action='store_true',
+        help='Send the requests to a waitress server instead of the test client')
+    parser.add_argument('--threads', type=int, default=4, help='waitress threads')
+    parser.add_argument(
+        '--concurrency', type=int, default=4,
+        help='Number of concurrent clients when using --server')
+    parser.add_argument('--gzip', action='store_true', help='Accept gzip responses')
+    parser.add_argument('--output', help='Write the results to a JSON file')
+    parser.add_argument('--baseline', help='Compare the results with a JSON file')
+    parser.add_argument(
+        '--max-regression', type=float, default=None,
+        help='Exit with an error if a p95 latency is this fraction worse than '
+             'the baseline, e.g. 0.2')
+    return parser.parse_args(argv)
+
+
+def build_scenarios(dataset, iterations):
+    """
+    Requests to make for each endpoint and query mode
+
+    Returns
+    -------
+    list
+        (name, paths, conditional) - conditional scenarios send the ETag from
+        a previous response in an If-None-Match header
+    """
+    file_ids = dataset.sample_file_ids(iterations, seed=1)
+    leaf_ids = [dataset.leaf_ids[i % len(dataset.leaf_ids)] for i in range(iterations)]
+    regions = dataset.sample_regions(iterations, seed=2)
+
+    file_meta = [API + '/file_meta?file_id={}'.format(f) for f in file_ids]
+    return [
+        ('ping', [API + '/ping'] * iterations, False),
+        ('file_meta', file_meta, False),
+        ('file_meta_not_modified', file_meta, True),
+        ('files_by_user_page', [API + '/files?by_user=1&limit=100'] * iterations, False),
+        ('files_by_user_stream',
+         [API + '/files?by_user=1&stream=1&limit=1000'] * iterations, False),
+        ('files_filtered', [
+            API + '/files?assembly={}&file_type=bw&data_type=RNA-seq'.format(a)
+            for a, _ in regions], False),
+        ('files_region', [
+            API + '/files?assembly={}&region={}'.format(a, r) for a, r in regions], False),
+        ('file_history', [
+            API + '/file_history?file_id={}'.format(f) for f in leaf_ids], False),
+        ('file_history_dag', [
+            API + '/file_history?file_id={}&depth=0'.format(f) for f in leaf_ids], False),
+    ]
+
+
+class TestClientTransport(object):
+    """
+    Sends the requests through the Flask test client
+    """
+
+    def __init__(self, options):
+        self.client = app.APP.test_client()
+        self.concurrency = 1
+
+    def get(self, path, headers):
+        response = self.client.get(path, headers=headers)
+        response.get_data()
+        return response.status_code, response.headers.get('ETag')
+
+    def close(self):
+        pass
+
+
+class ServerTransport(object):
+    """
+    Sends the requests to a waitress server running in a background thread
+    """
+
+    def __init__(self, options):
+        from waitress import create_server
+        self.server = create_server(app.APP, host='127.0.0.1', port=0, threads=options.threads)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.effective_port)
+        self.concurrency = options.concurrency
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, path, headers):
+        try:
+            response = urlopen(Request(self.base_url + path, headers=headers))
+            response.read()
+            return response.getcode(), response.headers.get('ETag')
+        except HTTPError as err:
+            err.read()
+            return err.code, err.headers.get('ETag')
+
+    def close(self):
+        self.server.close()
+
+
+def run_scenario(transport, paths, headers, conditional):
+    """
+    Time each request for a scenario
+
+    Returns
+    -------
+    dict
+        Request count, errors, throughput and latency percentiles in ms
+    """
+    requests = [(path, dict(headers)) for path in paths]
+    if conditional:
+        for path, request_headers in requests:
+            _, etag = transport.get(path, headers)
+            if etag is not None:
+                request_headers['If-None-Match'] = etag
+
+    def _timed(request):
+        start = time.time()
+        status, _ = transport.get(*request)
+        return time.time() - start, status
+
+    start = time.time()
+    if transport.concurrency > 1:
+        pool = ThreadPool(transport.concurrency)
+        try:
+            results = pool.map(_timed, requests)
+        finally:
+            pool.close()
+    else:
+        results = [_timed(request) for request in requests]
+    elapsed = time.time() - start
+
+    latencies = np.array([r[0] for r in results]) * 1000.0
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'requests': len(results),
+        'errors': sum(1 for r in results if r[1] not in (200, 304)),
+        'throughput': len(results) / elapsed if elapsed > 0 else None,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99)
+    }
+
+
+def compare(results, baseline, max_regression=None):
+    """
+    Print the change in throughput and p95 latency against a baseline
+
+    Returns
+    -------
+    list
+        Names of the scenarios whose p95 latency regressed by more than
+        `max_regression`
+    """
+    regressions = []
+    print('\n{:<26} {:>12} {:>12} {:>10}'.format('scenario', 'p95 base', 'p95 now', 'change'))
+    for name, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print('{:<26} {:>12} {:>12.2f} {:>10}'.format(name, '-', result['p95_ms'], 'new'))
+            continue
+        change = (result['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0.0
+        print('{:<26} {:>12.2f} {:>12.2f} {:>+9.1f}%'.format(
+            name, base['p95_ms'], result['p95_ms'], change * 100))
+        if max_regression is not None and change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    """
+    Run the benchmarks
+
+    Example
+    -------
+    .. code-block:: none
+       :linenos:
+
+       python -m benchmarks.bench_rest --records 100000 --output baseline.json
+       python -m benchmarks.bench_rest --records 100000 --baseline baseline.json --max-regression 0.2
+    """
+    options = _parse_args(argv)
+
+    if options.sqlite_path is not None:
+        app.APP.config['DM_BACKEND'] = 'sqlite'
+        app.APP.config['DM_SQLITE_PATH'] = options.sqlite_path
+        app.DM_REGISTRY.reload()
+        app.DM_REGISTRY.resize(max(options.threads, options.concurrency), mode='test')
+
+    # Allow the filtered listings to return everything that matches
+    app.APP.config['FILES_QUERY_MAX'] = max(app.APP.config['FILES_QUERY_MAX'], options.records)
+
+    start = time.time()
+    with app.DM_REGISTRY.client(options.user_id) as dmp_api:
+        dataset = SyntheticDataset(
+            options.records, seed=options.seed, chain_length=options.chain_length
+        ).load(dmp_api, options.user_id, batch_size=app.APP.config['BULK_BATCH_SIZE'])
+    app.VERSIONS.bump(options.user_id)
+    print('Registered {} files in {:.1f}s'.format(len(dataset.file_ids), time.time() - start))
+
+    headers = {'Authorization': 'Bearer ' + TOKEN}
+    if options.gzip:
+        headers['Accept-Encoding'] = 'gzip'
+
+    transport = ServerTransport(options) if options.server else TestClientTransport(options)
+    results = {}
+    try:
+        print('{:<26} {:>10} {:>8} {:>10} {:>10} {:>10}'.format(
+            'scenario', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for name, paths, conditional in build_scenarios(dataset, options.iterations):
+            if options.scenario and name not in options.scenario:
+                continue
+            # Keep the token cached so that the auth server is not part of
+            # the measurements
+            app.TOKEN_CACHE.put(
+                TOKEN, {'user_id': options.user_id, 'public_id': options.user_id})
+            result = run_scenario(transport, paths, headers, conditional)
+            results[name] = result
+            print('{:<26} {:>10.1f} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                name, result['throughput'] or 0, result['errors'],
+                result['p50_ms'], result['p95_ms'], result['p99_ms']))
+    finally:
+        transport.close()
+
+    report = {
+        'meta': {
+            'records': options.records,
+            'seed': options.seed,
+            'chain_length': options.chain_length,
+            'iterations': options.iterations,
+            'transport': 'waitress' if options.server else 'test_client',
+            'threads': options.threads if options.server else None,
+            'concurrency': options.concurrency if options.server else 1,
+            'gzip': options.gzip,
+            'backend': app.APP.config['DM_BACKEND'],
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': results
+    }
+
+    if options.output:
+        with open(options.output, 'w') as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as handle:
+            regressions = compare(results, json.load(handle), options.max_regression)
+        if regressions:
+            print('\nRegressions: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import random
+
+from rest.dm_store import insert_files
+
+ASSEMBLIES = [
+    ('GRCh38', 9606), ('GRCh37', 9606), ('GRCm38', 10090), ('dm6', 7227)
+]
+
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ['X', 'Y']
+
+CHROM_SIZE = 100000000
+
+# Each lineage chain is made up of a raw file followed by the files derived
+# from it. Files from the later steps cover a region so that they are picked
+# up by region queries.
+PIPELINE = [
+    ('fastq', 'RNA-seq'),
+    ('bam', 'RNA-seq'),
+    ('bw', 'RNA-seq'),
+    ('bb', 'ChIP-seq'),
+    ('bed', 'ChIP-seq'),
+    ('tsv', 'WGBS'),
+]
+
+REGION_FILE_TYPES = ['bw', 'bb', 'bed', 'tsv']
+
+
+class SyntheticDataset(object):
+    """
+    Deterministic set of file records spread over several assemblies, made up
+    of lineage chains whose track files cover known regions.
+    """
+
+    def __init__(self, records=1000, seed=0, chain_length=4):
+        """
+        Parameters
+        ----------
+        records : int
+            Number of file records to generate
+        seed : int
+            Seed for the random number generator, the same seed always
+            generates the same records
+        chain_length : int
+            Number of files in each lineage chain
+        """
+        self.records = int(records)
+        self.seed = seed
+        self.chain_length = max(1, min(int(chain_length), len(PIPELINE)))
+        self.file_ids = []
+        self.leaf_ids = []
+        self.regions = {}
+
+    def _record(self, rng, chain, step, source_ids):
+        assembly, taxon_id = ASSEMBLIES[chain % len(ASSEMBLIES)]
+        file_type, data_type = PIPELINE[step]
+        parent_dir = '/data/bench/run_{:07d}'.format(chain)
+        meta_data = {'assembly': assembly, 'chain': chain, 'step': step}
+
+        if file_type in REGION_FILE_TYPES:
+            chrom = rng.choice(CHROMOSOMES)
+            start = rng.randint(0, CHROM_SIZE - 1)
+            end = start + rng.randint(1000, 1000000)
+            meta_data.update({'chrom': chrom, 'start': start, 'end': end})
+            self.regions.setdefault(assembly, []).append((chrom, start, end))
+
+        return {
+            'file_path': '{}/file_{}.{}'.format(parent_dir, step, file_type),
+            'parent_dir': parent_dir,
+            'file_type': file_type,
+            'data_type': data_type,
+            'taxon_id': taxon_id,
+            'size': rng.randint(1000, 10 ** 10),
+            'compressed': None,
+            'source_id': source_ids,
+            'meta_data': meta_data
+        }
+
+    def load(self, dmp_api, user_id, batch_size=1000):
+        """
+        Register the records with a DM API client
+
+        The chains are inserted one step at a time so that each file can refer
+        to the ids of the files that it was derived from.
+
+        Parameters
+        ----------
+        dmp_api : dmp
+            DM API client
+        user_id : str
+            User that the files are registered for
+        batch_size : int
+            Number of files to insert at a time
+        """
+        rng = random.Random(self.seed)
+        chains = -(-self.records // self.chain_length)
+        previous = [[] for _ in range(chains)]
+        remaining = self.records
+
+        for step in range(self.chain_length):
+            count = min(chains, remaining)
+            remaining -= count
+            current = []
+            for offset in range(0, count, batch_size):
+                batch = [
+                    self._record(rng, chain, step, previous[chain])
+                    for chain in range(offset, min(offset + batch_size, count))
+                ]
+                for file_id, error in insert_files(dmp_api, user_id, batch):
+                    if error is not None:
+                        raise RuntimeError(error)
+                    current.append([file_id])
+            self.file_ids.extend(file_id for (file_id,) in current)
+            previous = current + previous[count:]
+
+        self.leaf_ids = [ids[0] for ids in previous if ids]
+        return self
+
+    def sample_file_ids(self, count, seed=None):
+        """
+        Deterministic sample of the registered file ids
+        """
+        rng = random.Random(self.seed if seed is None else seed)
+        return [rng.choice(self.file_ids) for _ in range(count)]
+
+    def sample_regions(self, count, width=1000000, seed=None):
+        """
+        Deterministic sample of (assembly, region) pairs centred on the
+        regions covered by the registered tracks
+        """
+        rng = random.Random(self.seed if seed is None else seed)
+        assemblies = sorted(self.regions)
+        regions = []
+        for _ in range(count):
+            assembly = rng.choice(assemblies)
+            chrom, start, _ = rng.choice(self.regions[assembly])
+            start = max(0, start - width // 2)
+            regions.append((assembly, '{}:{}:{}'.format(chrom, start, start + width)))
+        return regions
@@ -18,24 +18,121 @@
 from __future__ import print_function
 
 # Required for ReadTheDocs
-from functools import wraps # pylint: disable=unused-import
+from contextlib import contextmanager
+from functools import wraps
 
+import atexit
+import base64
 import json
 import os
 import sys
 #import logging
 
-from flask import Flask, request
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+from flask import Flask, Response, g, request
 from flask_restful import Api, Resource
+from flask_restful.representations.json import output_json
 
 from dmp import dmp
 from reader.hdf5_reader import hdf5_reader
 
-from mg_rest_util.mg_auth import authorized
+from mg_rest_util import mg_auth
+
+from rest.auth_cache import TokenCache, get_bearer_token
+from rest.compression import Compressor, etag_matches
+from rest.dm_pool import DMClientRegistry
+from rest.dm_store import (
+    DELETE_FILTER_FIELDS, QueryTooBroad, delete_files, ensure_indexes,
+    find_file_ids, find_files, format_record, get_files_by_ids, insert_files, is_valid_id,
+    iter_files_by_user, patch_file_metadata, unique_ids, validate_files
+)
+from rest.file_stream import file_etag, is_allowed_path, send_original
+from rest.handle_cache import HandleCache
+from rest.lineage import LineageCache, get_lineage
+from rest.metrics import MetricsRegistry
+from rest.profiling import RequestProfiler
+from rest.region_index import INTERVAL_KEYS, RegionIndex, parse_bed, parse_regions
+from rest.sequences import (
+    SequenceError, fastq_head, fastq_sample, open_fasta, sequence_type
+)
+from rest.single_flight import SingleFlight
+from rest.sqlite_store import SQLiteStore
+from rest.tabix import TabixError, open_index, tabular_columns
+from rest.tracks import (
+    NPZ_MIMETYPE, SUMMARY_TYPES, TrackError, bigbed_stats, bigwig_stats, open_track,
+    parse_region, read_bigbed, read_bigwig, to_json, to_npz, track_type
+)
+from rest.versioning import VersionTracker
+
+# Statistics that region query results can be ordered by
+REGION_STATS = ['features', 'bases_covered', 'min', 'mean', 'max']
 
 APP = Flask(__name__)
+APP.config.setdefault('DM_BACKEND', 'dmp')
+APP.config.setdefault(
+    'DM_SQLITE_PATH', os.path.dirname(os.path.abspath(__file__)) + '/dmp.sqlite')
+APP.config.setdefault('DM_POOL_SIZE', 4)
+APP.config.setdefault('DM_POOL_TIMEOUT', 30.0)
+APP.config.setdefault('DM_BATCH_SIZE', 1000)
+APP.config.setdefault('DM_LOOKUP_WORKERS', 8)
+APP.config.setdefault('FILES_PAGE_MAX', 10000)
+APP.config.setdefault('FILES_QUERY_MAX', 10000)
+APP.config.setdefault('FILES_REGIONS_MAX', 100000)
+APP.config.setdefault('BULK_BATCH_SIZE', 500)
+APP.config.setdefault(
+    'REGION_INDEX_DIR', os.path.dirname(os.path.abspath(__file__)) + '/index_cache/regions')
+APP.config.setdefault('REGION_INDEX_SAVE_INTERVAL', 60.0)
+APP.config.setdefault('LINEAGE_CACHE_SIZE', 100000)
+APP.config.setdefault('LINEAGE_MAX_DEPTH', 100)
+APP.config.setdefault('TRACK_MAX_VALUES', 1000000)
+APP.config.setdefault('ORIGINAL_FILE_ROOTS', None)
+APP.config.setdefault(
+    'TABIX_INDEX_DIR', os.path.dirname(os.path.abspath(__file__)) + '/index_cache/tabix')
+APP.config.setdefault(
+    'SEQUENCE_INDEX_DIR', os.path.dirname(os.path.abspath(__file__)) + '/index_cache/fasta')
+APP.config.setdefault('SEQUENCE_MAX_BASES', 10000000)
+APP.config.setdefault('SEQUENCE_MAX_RECORDS', 10000)
+APP.config.setdefault('FASTQ_SAMPLE_SCAN', 100000)
+APP.config.setdefault('HANDLE_CACHE_SIZE', 64)
+APP.config.setdefault('HANDLE_CACHE_IDLE', 300.0)
+APP.config.setdefault('HDF5_READER_MAX_AGE', 60.0)
+APP.config.setdefault('COALESCE_REQUESTS', True)
+APP.config.setdefault('AUTH_CACHE_SIZE', 1024)
+APP.config.setdefault('AUTH_CACHE_TTL', 300.0)
+APP.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+APP.config.setdefault('COMPRESS_LEVEL', 6)
+APP.config.setdefault('COMPRESS_CACHE_SIZE', 256)
+APP.config.setdefault('PROFILE_ENABLED', False)
+APP.config.setdefault('PROFILE_DIR', None)
+APP.config.setdefault('PROFILE_ALLOW', ['127.0.0.1'])
+APP.config.setdefault('PROFILE_SAMPLE_INTERVAL', 0.005)
+APP.config.setdefault('PROFILE_MAX_FILES', 50)
+APP.config.setdefault('PROFILE_MAX_BYTES', 100 * 1024 * 1024)
 #logging.basicConfig()
 
+def _resource_name(endpoint):
+    view = APP.view_functions.get(endpoint)
+    return getattr(view, 'view_class', view).__name__ if view is not None else 'unmatched'
+
+APP.wsgi_app = RequestProfiler(APP.wsgi_app, APP.config)
+
+# Registered before the compressor so that the request timings include it
+METRICS = MetricsRegistry(APP, resource_names=_resource_name)
+
+# COMPRESS_MIN_SIZE and COMPRESS_LEVEL are read from the config on each request
+COMPRESSOR = Compressor(APP, cache_size=APP.config['COMPRESS_CACHE_SIZE'])
+
+TOKEN_CACHE = TokenCache(
+    max_size=APP.config['AUTH_CACHE_SIZE'],
+    ttl=APP.config['AUTH_CACHE_TTL']
+)
+authorized = TOKEN_CACHE.decorator(
+    lambda func: METRICS.timed('auth', 'validate')(mg_auth.authorized(func)))
+
 def help_usage(error_message, status_code,
                parameters_required, parameters_provided):
     """
@@ -67,18 +164,34 @@ def help_usage(error_message, status_code,
     """
     parameters = {
         'by_user': ['By User [0|1]', 'int', 'OPTIONAL'],
+        'limit': ['Maximum number of files to return', 'int', 'OPTIONAL'],
+        'cursor': ['Value of the cursor from the _next link', 'str', 'OPTIONAL'],
+        'stream': ['Stream the records [0|1]', 'int', 'OPTIONAL'],
         'file_id': ['File ID', 'str', 'REQUIRED'],
         'region': ['Chromosome:Start:End', 'str:int:int', 'OPTIONAL'],
         'file_type': ['File type (bb, bw, tsv, fasta, fastq, ...)', 'str', 'OPTIONAL'],
         'data_type': ['Data type (chip-seq, rna-seq, wgbs, ...)', 'str', 'OPTIONAL'],
+        'taxon_id': ['Taxon ID (9606, 10090, ...)', 'int', 'OPTIONAL'],
         'assembly': ['Assembly', 'str', 'REQUIRED'],
         'chrom': ['Chromosome', 'str', 'OPTIONAL'],
         'start': ['Start', 'int', 'OPTIONAL'],
         'end': ['End', 'int', 'OPTIONAL'],
         'type': ['add_meta|remove_meta', 'str', 'OPTIONAL'],
+        'depth': ['Generations of history to return (0 for all)', 'int', 'OPTIONAL'],
+        'bins': ['Number of bins to summarise the region into', 'int', 'OPTIONAL'],
+        'summary': ['Bin summary (' + '|'.join(SUMMARY_TYPES) + ')', 'str', 'OPTIONAL'],
+        'format': ['Output format (json|npz)', 'str', 'OPTIONAL'],
         'output': [
             "Default is None. State 'original' to return the original whole file",
             'str', 'OPTIONAL'],
+        'regions': ['List of chrom:start:end regions or a BED file', 'list', 'REQUIRED'],
+        'include_files': ['Include the records of the matching files [0|1]', 'int', 'OPTIONAL'],
+        'records': ['Number of FASTQ records to return (default 10)', 'int', 'OPTIONAL'],
+        'sample': ['Return a random sample of the FASTQ records [0|1]', 'int', 'OPTIONAL'],
+        'seed': ['Seed for the random sample', 'int', 'OPTIONAL'],
+        'stats': ['Include the overlap with the region for each file [0|1]', 'int', 'OPTIONAL'],
+        'sort': ['Order files by an overlap statistic (' + '|'.join(REGION_STATS) + ')',
+                 'str', 'OPTIONAL'],
     }
 
     used_param = {k : parameters[k] for k in parameters_required if k in parameters}
@@ -103,19 +216,253 @@ def help_usage(error_message, status_code,
 
     return message
 
-def _get_dm_api(user_id=None):
-    cnf_loc = os.path.dirname(os.path.abspath(__file__)) + '/mongodb.cnf'
+def _dm_factory(cnf_loc, mode):
+    if APP.config['DM_BACKEND'] == 'sqlite':
+        return SQLiteStore(APP.config['DM_SQLITE_PATH'], timeout=APP.config['DM_POOL_TIMEOUT'])
+    if mode == 'test':
+        dmp_api = dmp(cnf_loc, test=True)
+    else:
+        dmp_api = dmp(cnf_loc)
+    ensure_indexes(dmp_api)
+    return dmp_api
+
+DM_REGISTRY = DMClientRegistry(
+    os.path.dirname(os.path.abspath(__file__)) + '/mongodb.cnf',
+    _dm_factory,
+    max_size=APP.config['DM_POOL_SIZE'],
+    timeout=APP.config['DM_POOL_TIMEOUT']
+)
+atexit.register(DM_REGISTRY.shutdown)
+
+REGION_INDEX = RegionIndex(
+    APP.config['REGION_INDEX_DIR'],
+    save_interval=APP.config['REGION_INDEX_SAVE_INTERVAL']
+)
+atexit.register(REGION_INDEX.flush)
+
+LINEAGE_CACHE = LineageCache(max_size=APP.config['LINEAGE_CACHE_SIZE'])
+
+HANDLE_CACHE = HandleCache(
+    max_open=APP.config['HANDLE_CACHE_SIZE'],
+    idle_timeout=APP.config['HANDLE_CACHE_IDLE']
+)
+atexit.register(HANDLE_CACHE.clear)
+
+SINGLE_FLIGHT = SingleFlight()
+
+VERSIONS = VersionTracker()
+
+find_files = METRICS.timed('dm_store', 'find_files')(find_files)
+find_file_ids = METRICS.timed('dm_store', 'find_file_ids')(find_file_ids)
+get_files_by_ids = METRICS.timed('dm_store', 'get_files_by_ids')(get_files_by_ids)
+insert_files = METRICS.timed('dm_store', 'insert_files')(insert_files)
+iter_files_by_user = METRICS.timed('dm_store', 'iter_files_by_user')(iter_files_by_user)
+patch_file_metadata = METRICS.timed('dm_store', 'patch_file_metadata')(patch_file_metadata)
+delete_files = METRICS.timed('dm_store', 'delete_files')(delete_files)
+
+METRICS.add_gauges('dmp_pool', 'DM API client pool usage', 'mode', DM_REGISTRY.stats)
+METRICS.add_gauges('dmp_auth_cache', 'Validated token cache usage', None, TOKEN_CACHE.stats)
+METRICS.add_gauges('dmp_handle_cache', 'Open track file handles', None, HANDLE_CACHE.stats)
+METRICS.add_gauges('dmp_single_flight', 'Coalesced requests', None, SINGLE_FLIGHT.stats)
+METRICS.add_gauges('dmp_compress_cache', 'Compressed response cache usage', None,
+                   COMPRESSOR.stats)
+METRICS.add_gauges(
+    'dmp_region_index', 'Resident region indexes', None,
+    lambda: {'indexes': len(REGION_INDEX.stats()),
+             'intervals': sum(REGION_INDEX.stats().values())})
+
+@APP.before_request
+def _sync_workers():
+    """
+    Drop the per-process caches for the users and assemblies whose files
+    another worker process has changed since the last request
+    """
+    stale = VERSIONS.changed_elsewhere()
+    if stale is not None:
+        LINEAGE_CACHE.invalidate_users(stale)
+        REGION_INDEX.invalidate(stale)
+
+@APP.after_request
+def _save_region_index(response):
+    """
+    Write the region index snapshots that are due once the response has been
+    sent, so that requests changing the files are not held up by the write
+    """
+    response.call_on_close(REGION_INDEX.save_pending)
+    return response
 
-    if user_id == 'test':
-        print("TEST USER DM API")
-        return dmp(cnf_loc, test=True)
+def conditional_get(file_arg=None, public=True, file_stat=False):
+    """
+    Decorator for GET functions that adds an ETag to successful responses and
+    returns 304 Not Modified without calling the function when the request
+    has a matching If-None-Match header.
 
-    if os.path.isfile(cnf_loc) is True:
-        print("LIVE DM API")
-        return dmp(cnf_loc)
+    Parameters
+    ----------
+    file_arg : str
+        Name of the parameter holding the file id if the response only
+        depends on that file
+    public : bool
+        True if the `public` parameter selects the public user's files
+    file_stat : bool
+        True if the response is read from the registered file, so that the
+        ETag changes when the file is rewritten without its record changing
+    """
+    def _decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            user_id = kwargs.get('user_id')
+            if user_id is None:
+                return func(*args, **kwargs)
 
-    print("TEST DM API")
-    return dmp(cnf_loc, test=True)
+            selected_user_id = user_id['user_id']
+            if public and request.args.get('public') is not None:
+                selected_user_id = user_id['public_id']
+
+            request_key = request.path + '?' + urlencode(sorted(request.args.items(True)))
+            file_id = request.args.get(file_arg) if file_arg is not None else None
+            if file_stat and file_id is not None:
+                request_key += '\n' + _get_file_stat_key(selected_user_id, file_id)
+            etag = VERSIONS.etag(request_key, selected_user_id, file_id)
+
+            # The body, and so the ETag, depends on the encoding negotiated by
+            # the compressor, so caches have to key on Accept-Encoding
+            matched_etag = etag_matches(request.if_none_match, etag)
+            if matched_etag is not None:
+                response = Response(status=304)
+                response.set_etag(matched_etag)
+                response.vary.add('Accept-Encoding')
+                return response
+
+            result = func(*args, **kwargs)
+            if isinstance(result, Response):
+                # Responses that carry their own validator, such as whole files,
+                # keep it
+                if result.status_code == 200 and result.get_etag()[0] is None:
+                    result.set_etag(etag)
+                    result.vary.add('Accept-Encoding')
+                return result
+            if isinstance(result, dict) and 'usage' not in result and 'error' not in result:
+                return result, 200, {'ETag': '"{}"'.format(etag), 'Vary': 'Accept-Encoding'}
+            return result
+        return wrapper
+    return _decorator
+
+def coalesced(public=True):
+    """
+    Decorator for GET functions so that concurrent identical requests share
+    one call of the function and one serialised response. Requests are
+    identical when they are for the same resolved user, host, path and
+    parameters.
+
+    The response is serialised once by the leading request and each request
+    returns its own copy of the body. Usage and error messages are shared
+    without serialising them, so that conditional_get treats them as before,
+    and responses such as streams or files are not shared, so those requests
+    call the function themselves.
+
+    Parameters
+    ----------
+    public : bool
+        True if the `public` parameter selects the public user's files
+    """
+    def _decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            user_id = kwargs.get('user_id')
+            if user_id is None or not APP.config['COALESCE_REQUESTS']:
+                return func(*args, **kwargs)
+
+            selected_user_id = user_id['user_id']
+            if public and request.args.get('public') is not None:
+                selected_user_id = user_id['public_id']
+
+            key = (request.endpoint, selected_user_id, request.host_url,
+                   urlencode(sorted(request.args.items(True))))
+
+            def _call():
+                result = func(*args, **kwargs)
+                if isinstance(result, dict) and 'usage' not in result and 'error' not in result:
+                    response = REST_API.representations['application/json'](result, 200, {})
+                    return response.get_data(), result
+                return None, result
+
+            shared, (body, result) = SINGLE_FLIGHT.do(key, _call)
+            if body is not None:
+                return Response(body, mimetype='application/json')
+            if shared and isinstance(result, Response):
+                return func(*args, **kwargs)
+            return result
+        return wrapper
+    return _decorator
+
+def _encode_cursor(file_id):
+    return base64.urlsafe_b64encode(str(file_id).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor):
+    return base64.urlsafe_b64decode(str(cursor)).decode('utf-8')
+
+def _iter_ndjson(stream):
+    """
+    Parse a newline delimited JSON stream one line at a time. Lines that are
+    not valid JSON are passed on as None so that they are reported as invalid
+    records.
+    """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+def _batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+@contextmanager
+def _get_dm_api(user_id=None):
+    """
+    Check out a pooled DM API client for the given user. This should be used
+    as a context manager so that the client is returned to the pool once the
+    request has been handled. Calls made on the client are timed.
+    """
+    with DM_REGISTRY.client(user_id) as dmp_api:
+        yield METRICS.instrument(dmp_api, 'dmp')
+
+def _get_file_obj(user_id, file_id):
+    """
+    Get the record for a file, reusing the record that was looked up for the
+    ETag of the current request
+    """
+    cached = getattr(g, 'file_obj', None)
+    if cached is not None and cached[0] == (user_id, file_id):
+        return cached[1]
+    with _get_dm_api(user_id) as dmp_api:
+        file_obj = format_record(dmp_api.get_file_by_id(user_id, file_id))
+    g.file_obj = ((user_id, file_id), file_obj)
+    return file_obj
+
+def _get_file_stat_key(user_id, file_id):
+    """
+    Part of the ETag for a response read from a registered file, based on
+    the size and modification time of the file
+    """
+    file_obj = _get_file_obj(user_id, file_id)
+    file_path = (file_obj or {}).get('file_path') or ''
+    if not is_allowed_path(file_path, APP.config['ORIGINAL_FILE_ROOTS']):
+        return ''
+    try:
+        return file_etag(file_path, os.stat(file_path))
+    except OSError:
+        return ''
 
 class EndPoints(Resource):
     """
@@ -143,7 +490,12 @@ class EndPoints(Resource):
                 '_getFile': request.url_root + 'mug/api/dmp/file',
                 '_getFiles': request.url_root + 'mug/api/dmp/files',
                 '_getFileHistory': request.url_root + 'mug/api/dmp/file_history',
+                '_getTrack': request.url_root + 'mug/api/dmp/track',
+                '_getRegion': request.url_root + 'mug/api/dmp/region',
+                '_getSequence': request.url_root + 'mug/api/dmp/sequence',
                 '_ping': request.url_root + 'mug/api/dmp/ping',
+                '_token': request.url_root + 'mug/api/dmp/token',
+                '_metrics': request.url_root + 'mug/api/dmp/metrics',
                 '_parent': request.url_root + 'mug/api'
             }
         }
@@ -158,6 +510,8 @@ class FileMeta(Resource):
     """
 
     @authorized
+    @conditional_get(file_arg='file_id')
+    @coalesced()
     def get(self, user_id):
         """
         GET  List values from the file
@@ -171,6 +525,10 @@ class FileMeta(Resource):
         ----------
         file_id : str
             Identifier of the file to retrieve data from
+        output : str
+            'original' to return the whole file. Single and multiple byte
+            ranges can be requested with a Range header. Files can only be
+            returned from the directories listed in ORIGINAL_FILE_ROOTS.
 
         Returns
         -------
@@ -185,9 +543,12 @@ class FileMeta(Resource):
 
            curl -X GET http://localhost:5002/mug/api/dmp/track?file_id=test_file
 
+           curl -X GET -H "Range: bytes=0-65535" http://localhost:5002/mug/api/dmp/file_meta?file_id=test_file&output=original
+
         """
         file_id = request.args.get('file_id')
         public = request.args.get('public')
+        output = request.args.get('output')
 
         params = [file_id]
 
@@ -204,11 +565,31 @@ class FileMeta(Resource):
             if public is not None:
                 selected_user_id = user_id['public_id']
 
-            dmp_api = _get_dm_api(selected_user_id)
-            return dmp_api.get_file_by_id(selected_user_id, file_id)
+            with _get_dm_api(selected_user_id) as dmp_api:
+                file_obj = format_record(dmp_api.get_file_by_id(selected_user_id, file_id))
+
+            if file_obj is None:
+                return help_usage('FileNotFound', 404, ['file_id'], {'file_id': file_id})
+            if output == 'original':
+                return self._get_original(file_id, file_obj)
+            return file_obj
 
         return help_usage('Forbidden', 403, ['file_id'], {})
 
+    def _get_original(self, file_id, file_obj):
+        """
+        Send the file registered for a file record
+        """
+        params_required = ['file_id', 'output']
+        file_path = file_obj.get('file_path') if file_obj else None
+        if file_path is None or not os.path.isfile(file_path):
+            return help_usage('FileNotFound', 404, params_required, {'file_id': file_id})
+
+        if not is_allowed_path(file_path, APP.config['ORIGINAL_FILE_ROOTS']):
+            return help_usage('Forbidden', 403, params_required, {'file_id': file_id})
+
+        return send_original(request, file_path)
+
     @authorized
     def post(self, user_id):
         """
@@ -244,11 +625,20 @@ class FileMeta(Resource):
             meta_data : dict
                 Hash array describing the relevant metadata for the file,
                 including the assembly if relevant
+                Files covering known genomic regions can include either
+                `chrom`, `start` and `end` keys or a `regions` list of
+                [chrom, start, end] so that they are found by region queries
+
+        Several files can be registered in one request by passing a JSON list
+        of these dicts, or by streaming one dict per line with the
+        Content-Type set to application/x-ndjson.
 
         Returns
         -------
         file_id
-            Returns the id of the stored file
+            Returns the id of the stored file. For a list or stream of files a
+            `files` list is returned with the `file_id` or `error` for each
+            file in the order that they were provided.
 
         Example
         -------
@@ -271,11 +661,25 @@ class FileMeta(Resource):
                -H "Authorization: Bearer teststring"
                -d @data.json http://localhost:5002/mug/api/dmp/file
 
+        To register a stream of files:
+
+        .. code-block:: none
+           :linenos:
+
+           curl -X POST
+               -H "Content-Type: application/x-ndjson"
+               -H "Authorization: Bearer teststring"
+               --data-binary @files.ndjson http://localhost:5002/mug/api/dmp/file
+
         """
         if user_id is not None:
-            dmp_api = _get_dm_api(user_id['user_id'])
+            if request.mimetype == 'application/x-ndjson':
+                return self._post_bulk(user_id['user_id'], _iter_ndjson(request.stream))
 
             new_track = json.loads(request.data)
+            if isinstance(new_track, list):
+                return self._post_bulk(user_id['user_id'], new_track)
+
             file_path = new_track['file_path'] if 'file_path' in new_track else None
             file_type = new_track['file_type'] if 'file_type' in new_track else None
             size = new_track['size'] if 'size' in new_track else None
@@ -296,23 +700,70 @@ class FileMeta(Resource):
                 return help_usage('MissingParameters', 400, params_required,
                                   user_id)
 
-            new_track = json.loads(request.data)
+            with _get_dm_api(user_id['user_id']) as dmp_api:
+                file_id = dmp_api.set_file(
+                    user_id['user_id'],
+                    file_path,
+                    file_type,
+                    size,
+                    parent_dir,
+                    data_type,
+                    taxon_id,
+                    compressed,
+                    source_id,
+                    meta_data
+                )
 
-            return dmp_api.set_file(
-                user_id['user_id'],
-                file_path,
-                file_type,
-                size,
-                parent_dir,
-                data_type,
-                taxon_id,
-                compressed,
-                source_id,
-                meta_data
-            )
+            REGION_INDEX.add_file(user_id['user_id'], file_id, meta_data)
+            VERSIONS.bump(user_id['user_id'], assemblies=[meta_data.get('assembly')])
+            return file_id
 
         return help_usage('Forbidden', 403, [], {})
 
+    def _post_bulk(self, user_id, records):
+        """
+        Register a list or stream of file descriptors in batches
+
+        Returns
+        -------
+        dict
+            The file id or the error for each record, in the order that they
+            were provided
+        """
+        results = []
+        index = 0
+        batch_size = APP.config['BULK_BATCH_SIZE']
+        with _get_dm_api(user_id) as dmp_api:
+            for batch in _batches(records, batch_size):
+                assemblies = set()
+                errors = validate_files(batch)
+                valid = [r for r, e in zip(batch, errors) if e is None]
+                inserted = iter(insert_files(dmp_api, user_id, valid) if valid else [])
+
+                for record, error in zip(batch, errors):
+                    result = {'index': index}
+                    index += 1
+                    if error is not None:
+                        result.update(error)
+                    else:
+                        file_id, insert_error = next(inserted)
+                        if insert_error is not None:
+                            result['error'] = insert_error
+                        else:
+                            result['file_id'] = file_id
+                            REGION_INDEX.add_file(user_id, file_id, record['meta_data'])
+                            assemblies.add(record['meta_data'].get('assembly'))
+                    results.append(result)
+                VERSIONS.bump(user_id, assemblies=assemblies)
+
+        return {
+            '_links': {
+                '_self': request.base_url,
+                '_parent' : request.url_root + 'mug/api/dmp'
+            },
+            'files': results
+        }
+
     @authorized
     def put(self, user_id):
         """
@@ -328,20 +779,27 @@ class FileMeta(Resource):
         json : dict
             user_id : str
                 User identifier
-            file_id : str
-                ID of the stored file
+            file_id : str | list
+                ID of the stored file. For 'add_meta', 'remove_meta' and
+                'patch_meta' this can be a list of IDs to update several
+                files at once.
             type : str
-                Options are 'add_meta' or 'remove_meta' to modify they key-value
-                pairs for the file entry. Minimum sets of pairs are defined
-                within the DM API (mg-dm-api)
+                Options are 'add_meta', 'remove_meta' or 'patch_meta' to
+                modify they key-value pairs for the file entry. Minimum sets
+                of pairs are defined within the DM API (mg-dm-api)
             meta_data : dict
                 Hash array describing the relevant metadata key-value pairs that
                 are to be added
+            add_meta : dict
+                For 'patch_meta', the key-value pairs to add
+            remove_meta : list
+                For 'patch_meta', the keys to remove
 
         Returns
         -------
         file_id
-            Returns the id of the stored file
+            Returns the id of the stored file, or the list of ids if a list
+            was provided
 
         Example
         -------
@@ -377,6 +835,23 @@ class FileMeta(Resource):
                -H "Authorization: Bearer teststring"
                -d @data.json http://localhost:5002/mug/api/dmp/file
 
+        To add and remove key value pairs for several files in one update:
+
+        .. code-block:: none
+           :linenos:
+
+           echo '{
+               "type":"patch_meta",
+               "file_id":["<file_id>", "<file_id>"],
+               "add_meta":{"experiment":"exp_001"},
+               "remove_meta":["citation"]
+           }' > data.json
+
+           curl -X PUT
+               -H "Content-Type: application/json"
+               -H "Authorization: Bearer teststring"
+               -d @data.json http://localhost:5002/mug/api/dmp/file
+
         To modify a column value (file size):
 
         .. code-block:: none
@@ -396,28 +871,59 @@ class FileMeta(Resource):
 
         """
         if user_id is not None:
-            dmp_api = _get_dm_api(user_id['user_id'])
-
             data_put = json.loads(request.data)
             file_id = data_put['file_id']
 
             params_required = ['user_id', 'file_id', 'type']
 
+            put_types = ['add_meta', 'remove_meta', 'patch_meta', 'modify_column']
+            if data_put['type'] not in put_types:
+                return help_usage('MissingMetaDataParameters', 400, params_required,
+                                  {'type' : put_types})
+
+            if data_put['type'] == 'modify_column':
+                with _get_dm_api(user_id['user_id']) as dmp_api:
+                    result = dmp_api.modify_column(
+                        user_id['user_id'], file_id, data_put['key'], data_put['value']
+                    )
+                if data_put['key'] == 'source_id':
+                    LINEAGE_CACHE.invalidate(user_id['user_id'], file_id)
+                VERSIONS.bump(user_id['user_id'], [file_id])
+                return result
+
+            add_meta = {}
+            remove_meta = []
             if data_put['type'] == 'add_meta':
-                for k in data_put['meta_data']:
-                    result = dmp_api.add_file_metadata(
-                        user_id['user_id'], file_id, k, data_put['meta_data'][k])
+                add_meta = data_put['meta_data']
             elif data_put['type'] == 'remove_meta':
-                for k in data_put['meta_data']:
-                    result = dmp_api.remove_file_metadata(user_id['user_id'], file_id, k)
-            elif data_put['type'] == 'modify_column':
-                result = dmp_api.modify_column(
-                    user_id['user_id'], file_id, data_put['key'], data_put['value']
-                )
+                remove_meta = data_put['meta_data']
             else:
-                return help_usage('MissingMetaDataParameters', 400, params_required,
-                                  {'type' : ['add_meta', 'remove_meta', 'modify_column']})
-            return result
+                add_meta = data_put.get('add_meta', {})
+                remove_meta = data_put.get('remove_meta', [])
+
+            file_ids = file_id if isinstance(file_id, list) else [file_id]
+            # Only changes to the intervals affect the region indexes, but the
+            # assemblies that the files were on before are not known
+            assemblies = []
+            try:
+                with _get_dm_api(user_id['user_id']) as dmp_api:
+                    patch_file_metadata(
+                        dmp_api, user_id['user_id'], file_ids, add_meta, remove_meta)
+
+                    if set(INTERVAL_KEYS).intersection(list(add_meta) + list(remove_meta)):
+                        assemblies = None
+                        for record in get_files_by_ids(
+                                dmp_api, user_id['user_id'], file_ids,
+                                chunk_size=APP.config['DM_BATCH_SIZE'],
+                                max_workers=APP.config['DM_LOOKUP_WORKERS']):
+                            REGION_INDEX.update_file(
+                                user_id['user_id'], record['_id'], record.get('meta_data'))
+            except ValueError as err:
+                return help_usage(str(err), 400, params_required,
+                                  {'add_meta': add_meta, 'remove_meta': remove_meta})
+
+            VERSIONS.bump(user_id['user_id'], file_ids, assemblies=assemblies)
+            return file_id
 
         return help_usage('Forbidden', 403, [], {})
 
@@ -436,6 +942,17 @@ class FileMeta(Resource):
         json : dict
             file_id : str
                 ID of the stored file
+            file_ids : list
+                IDs of several files to remove
+            filter : dict
+                Remove all files matching the source_id, parent_dir and/or
+                data_type given
+            dry_run : bool
+                Report which files would be removed without removing them
+
+        When file_ids or filter are used the outcome for each file is streamed
+        back as newline delimited JSON with the file_id and a status of
+        'deleted', 'would_delete' or 'not_found'.
 
         Example
         -------
@@ -451,14 +968,34 @@ class FileMeta(Resource):
                -H "Authorization: Bearer teststring"
                -d @data.json http://localhost:5002/mug/api/dmp/file
 
+        To remove all files generated from a given file:
+
+        .. code-block:: none
+           :linenos:
+
+           echo '{
+               "filter":{"source_id":"<file_id>"},
+               "dry_run":true
+           }' > data.json
+
+           curl -X DELETE
+               -H "Content-Type: application/json"
+               -H "Authorization: Bearer teststring"
+               -d @data.json http://localhost:5002/mug/api/dmp/file
+
         """
         if user_id is not None:
-            dmp_api = _get_dm_api(user_id['user_id'])
-
             params_required = ['user_id', 'file_id']
             data_delete = json.loads(request.data)
-            if data_delete['file_id']:
-                file_id = dmp_api.remove_file(user_id['user_id'], data_delete['file_id'])
+            if 'file_ids' in data_delete or 'filter' in data_delete:
+                return self._delete_bulk(user_id['user_id'], data_delete)
+
+            if data_delete.get('file_id'):
+                with _get_dm_api(user_id['user_id']) as dmp_api:
+                    file_id = dmp_api.remove_file(user_id['user_id'], data_delete['file_id'])
+                REGION_INDEX.remove_file(user_id['user_id'], data_delete['file_id'])
+                LINEAGE_CACHE.invalidate(user_id['user_id'], data_delete['file_id'])
+                VERSIONS.bump(user_id['user_id'], [data_delete['file_id']])
             else:
                 return help_usage('MissingMetaDataParameters', 400, params_required,
                                   {})
@@ -466,6 +1003,57 @@ class FileMeta(Resource):
 
         return help_usage('Forbidden', 403, [], {})
 
+    def _delete_bulk(self, user_id, data_delete):
+        """
+        Remove a list of files, or the files matching a filter, streaming back
+        the outcome for each file
+        """
+        params_required = ['user_id', 'file_ids', 'filter', 'dry_run']
+        file_ids = data_delete.get('file_ids') or []
+        filters = data_delete.get('filter') or {}
+        dry_run = bool(data_delete.get('dry_run', False))
+
+        if not isinstance(file_ids, list) or not isinstance(filters, dict):
+            return help_usage('InvalidParameters', 400, params_required, data_delete)
+
+        filters = {k: v for k, v in filters.items() if v is not None}
+        if not file_ids and not set(filters).intersection(DELETE_FILTER_FIELDS):
+            return help_usage('MissingParameters', 400, params_required,
+                              {'filter': DELETE_FILTER_FIELDS})
+
+        chunk_size = APP.config['DM_BATCH_SIZE']
+
+        def _forget(deleted):
+            """
+            Drop the deleted files from the caches, once for each chunk
+            """
+            if deleted:
+                REGION_INDEX.remove_files(user_id, deleted)
+                for file_id in deleted:
+                    LINEAGE_CACHE.invalidate(user_id, file_id)
+                VERSIONS.bump(user_id, deleted)
+                del deleted[:]
+
+        def _stream():
+            deleted = []
+            try:
+                with _get_dm_api(user_id) as dmp_api:
+                    selected = list(file_ids)
+                    if filters:
+                        selected += find_file_ids(dmp_api, user_id, filters)
+                    for file_id, status in delete_files(
+                            dmp_api, user_id, selected,
+                            chunk_size=chunk_size, dry_run=dry_run):
+                        if status == 'deleted':
+                            deleted.append(file_id)
+                            if len(deleted) >= chunk_size:
+                                _forget(deleted)
+                        yield json.dumps({'file_id': file_id, 'status': status}) + '\n'
+            finally:
+                _forget(deleted)
+
+        return Response(_stream(), mimetype='application/x-ndjson')
+
 class Files(Resource):
     """
     Class to handle the http requests for retrieving the list of files for a
@@ -473,6 +1061,8 @@ class Files(Resource):
     """
 
     @authorized
+    @conditional_get()
+    @coalesced()
     def get(self, user_id):
         """
         GET List user tracks
@@ -489,6 +1079,29 @@ class Files(Resource):
             <chromosome>:<start_pos>:<end_pos>
         file_type : str
         data_type : str
+        taxon_id : int
+            The assembly, file_type, data_type and taxon_id filters can be
+            used in any combination. Requests matching more than
+            FILES_QUERY_MAX files are rejected with a QueryTooBroad error.
+        by_user : int
+            1 to list all files for the user
+        limit : int
+            Maximum number of files to return when listing by user. If there
+            are more files then `_links` has a `_next` link to the next page.
+        cursor : str
+            Cursor from the `_next` link
+        stream : int
+            1 to stream the records as they are read when listing by user
+        stats : int
+            1 to add `region_stats` to each file found by a region query. The
+            number of indexed intervals overlapping the region (`features`)
+            and the bases of the region they cover come from the region
+            index. For bigWig files the `min`, `mean` and `max` signal and
+            the bases with data are read from the file, and for bigBed files
+            the features are counted from the file.
+        sort : str
+            Order the files from a region query by one of the statistics,
+            largest first. `limit` then keeps the first files.
 
         Example
         -------
@@ -497,15 +1110,22 @@ class Files(Resource):
 
            curl -X GET http://localhost:5002/mug/api/dmp/Files?>
 
+           curl -X GET http://localhost:5002/mug/api/dmp/files?by_user=1&limit=100
+
+           curl -X GET http://localhost:5002/mug/api/dmp/files?assembly=GRCh38&region=1:1000:2000&stats=1&sort=mean&limit=10
+
         """
         if user_id is not None:
             region = request.args.get('region')
             assembly = request.args.get('assembly')
             file_type = request.args.get('file_type')
             data_type = request.args.get('data_type')
+            taxon_id = request.args.get('taxon_id')
             by_user = request.args.get('by_user')
             public = request.args.get('public')
 
+            params_required = ['region', 'assembly', 'file_type', 'data_type',
+                               'taxon_id', 'by_user']
             params = [user_id]
 
             # Display the parameters available
@@ -518,23 +1138,41 @@ class Files(Resource):
             if public is not None:
                 selected_user_id = user_id['public_id']
 
-            dmp_api = _get_dm_api(selected_user_id)
+            filters = {
+                'assembly': assembly,
+                'file_type': file_type,
+                'data_type': data_type,
+                'taxon_id': taxon_id
+            }
 
-            files = []
             if region is not None and assembly is not None:
-                files = self._get_all_files_region(dmp_api, selected_user_id, assembly, region)
-            elif file_type is not None and assembly is not None:
-                files = dmp_api.get_files_by_file_type(selected_user_id)
-            elif data_type is not None and assembly is not None:
-                files = dmp_api.get_files_by_data_type(selected_user_id)
-            elif assembly is not None:
-                files = dmp_api.get_files_by_assembly(selected_user_id, assembly)
+                try:
+                    parse_regions([region])
+                except ValueError:
+                    return help_usage('InvalidParameters', 400, params_required,
+                                      {'region': region})
+                if request.args.get('stats') is not None or request.args.get('sort') is not None:
+                    return self._get_region_stats(selected_user_id, assembly, region)
+                with _get_dm_api(selected_user_id) as dmp_api:
+                    files = self._get_all_files_region(
+                        dmp_api, selected_user_id, assembly, region)
+            elif any(x is not None for x in filters.values()):
+                if taxon_id is not None:
+                    if not taxon_id.isdigit():
+                        return help_usage('InvalidParameters', 400, params_required,
+                                          {'taxon_id': taxon_id})
+                    filters['taxon_id'] = int(taxon_id)
+                try:
+                    with _get_dm_api(selected_user_id) as dmp_api:
+                        files = find_files(
+                            dmp_api, selected_user_id, filters,
+                            max_results=APP.config['FILES_QUERY_MAX'])
+                except QueryTooBroad:
+                    return help_usage('QueryTooBroad', 400, params_required, filters)
             elif by_user is not None and int(by_user) == 1:
-                files = dmp_api.get_files_by_user(selected_user_id)
+                return self._get_user_files(selected_user_id)
             else:
-                return help_usage(
-                    None, 200,
-                    ['region', 'assembly', 'file_type', 'data_type', 'by_user'], {})
+                return help_usage(None, 200, params_required, {})
 
             return {
                 '_links': {
@@ -548,16 +1186,302 @@ class Files(Resource):
             None, 200,
             ['region', 'assembly', 'file_type', 'data_type', 'by_user'], {})
 
+    def _get_user_files(self, user_id):
+        """
+        List all files for a user ordered by file id. The `limit` and `cursor`
+        parameters page through the list and `stream` writes the records out
+        as they are read from the DM API.
+        """
+        params_required = ['by_user', 'limit', 'cursor', 'stream']
+        limit = request.args.get('limit')
+        cursor = request.args.get('cursor')
+        stream = request.args.get('stream')
+
+        try:
+            limit = int(limit) if limit is not None else None
+            after = _decode_cursor(cursor) if cursor is not None else None
+        except (TypeError, ValueError):
+            return help_usage('InvalidParameters', 400, params_required,
+                              {'limit': limit, 'cursor': cursor})
+
+        if limit is not None and not 0 < limit <= APP.config['FILES_PAGE_MAX']:
+            return help_usage('InvalidParameters', 400, params_required,
+                              {'limit': limit})
+
+        if after is not None:
+            with _get_dm_api(user_id) as dmp_api:
+                if not is_valid_id(dmp_api, after):
+                    return help_usage('InvalidParameters', 400, params_required,
+                                      {'cursor': cursor})
+
+        links = {
+            '_self': request.base_url,
+            '_parent' : request.url_root + 'mug/api/dmp'
+        }
+        base_url = request.base_url
+        args = request.args.to_dict()
+        fetch = limit + 1 if limit is not None else None
+
+        def _next_link(last_id):
+            args['cursor'] = _encode_cursor(last_id)
+            return base_url + '?' + urlencode(sorted(args.items()))
+
+        if stream is not None and int(stream) == 1:
+            def _stream():
+                count = 0
+                last_id = None
+                more = False
+                yield '{"files": ['
+                with _get_dm_api(user_id) as dmp_api:
+                    for record in iter_files_by_user(dmp_api, user_id, after, fetch):
+                        if count == limit:
+                            more = True
+                            break
+                        yield (',' if count else '') + json.dumps(record, default=str)
+                        count += 1
+                        last_id = record['_id']
+                if more:
+                    links['_next'] = _next_link(last_id)
+                yield '], "_links": ' + json.dumps(links) + '}'
+
+            return Response(_stream(), mimetype='application/json')
+
+        with _get_dm_api(user_id) as dmp_api:
+            files = list(iter_files_by_user(dmp_api, user_id, after, fetch))
+
+        if limit is not None and len(files) > limit:
+            files = files[:limit]
+            links['_next'] = _next_link(files[-1]['_id'])
+
+        return {
+            '_links': links,
+            'files': files
+        }
+
+    def _get_region_stats(self, user_id, assembly, region):
+        """
+        Find the files overlapping a region along with how much of the region
+        each of them covers. The files can be ordered by one of the
+        statistics and trimmed to the first `limit` files.
+        """
+        params_required = ['assembly', 'region', 'stats', 'sort', 'limit']
+        sort = request.args.get('sort')
+        limit = request.args.get('limit')
+        try:
+            chrom, start, end = parse_region(region)
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            return help_usage('InvalidParameters', 400, params_required,
+                              {'region': region, 'limit': limit})
+        if (sort is not None and sort not in REGION_STATS) or (limit is not None and limit < 1):
+            return help_usage('InvalidParameters', 400, params_required,
+                              {'sort': sort, 'limit': limit})
+
+        with _get_dm_api(user_id) as dmp_api:
+            files = self._get_all_files_region(dmp_api, user_id, assembly, region)
+            with METRICS.timer('region_index', 'overlap_stats'):
+                index_stats = REGION_INDEX.overlap_stats(
+                    user_id, assembly, chrom, start, end,
+                    loader=lambda: dmp_api.get_files_by_assembly(user_id, assembly))
+
+        for file_obj in files:
+            stats = dict((index_stats or {}).get(str(file_obj['_id']), {}))
+            stats.update(self._get_track_stats(file_obj, chrom, start, end))
+            file_obj['region_stats'] = stats
+
+        if sort is not None:
+            # Files without the statistic go last
+            files.sort(key=lambda f: (f['region_stats'].get(sort) is None,
+                                      -(f['region_stats'].get(sort) or 0)))
+        if limit is not None:
+            files = files[:limit]
+
+        return {
+            '_links': {
+                '_self': request.base_url,
+                '_parent' : request.url_root + 'mug/api/dmp'
+            },
+            'files': files
+        }
+
+    def _get_track_stats(self, file_obj, chrom, start, end):
+        """
+        Statistics for a region read from a bigWig or bigBed file, or an empty
+        dict for other files and tracks that cannot be read
+        """
+        kind = track_type(file_obj.get('file_type'))
+        file_path = file_obj.get('file_path')
+        if kind is None or file_path is None or not os.path.isfile(file_path):
+            return {}
+        if not is_allowed_path(file_path, APP.config['ORIGINAL_FILE_ROOTS']):
+            return {}
+        try:
+            with METRICS.timer('track', kind + '_stats'):
+                with HANDLE_CACHE.open(file_path, open_track, 'track') as handle:
+                    if kind == 'bigwig':
+                        return bigwig_stats(handle, chrom, start, end)
+                    return bigbed_stats(handle, chrom, start, end)
+        except TrackError:
+            return {}
+
+    @authorized
+    def post(self, user_id):
+        """
+        POST Find the files overlapping each of a list of regions
+
+        The regions are matched against the region index in a single pass, so
+        a large set of regions such as a peak file can be queried in one
+        request.
+
+        Parameters
+        ----------
+        This should be passed as the data block with the HTTP request:
+
+        json : dict
+            assembly : str
+                Genome assembly accession
+            regions : list
+                List of chrom:start:end strings or [chrom, start, end, name]
+                lists, the name being optional
+            include_files : bool
+                True to also return the records of the matching files
+
+        A BED file can be sent instead with the Content-Type set to text/plain
+        or text/x-bed, with the assembly and include_files given as query
+        parameters.
+
+        Returns
+        -------
+        dict
+            `regions` lists the `file_ids` of the files overlapping each
+            region, in the order that the regions were provided. With
+            include_files `files` has the record of each matching file once.
+
+        Example
+        -------
+        .. code-block:: none
+           :linenos:
+
+           curl -X POST
+               -H "Content-Type: application/json"
+               -H "Authorization: Bearer teststring"
+               -d '{"assembly": "GRCh38", "regions": ["1:1000:2000", "2:500:800"]}'
+               http://localhost:5002/mug/api/dmp/files
+
+           curl -X POST
+               -H "Content-Type: text/x-bed"
+               -H "Authorization: Bearer teststring"
+               --data-binary @peaks.bed
+               http://localhost:5002/mug/api/dmp/files?assembly=GRCh38&include_files=1
+
+        """
+        if user_id is None:
+            return help_usage('Forbidden', 403, [], {})
+
+        params_required = ['assembly', 'regions', 'include_files']
+        try:
+            if request.mimetype in ('text/plain', 'text/x-bed'):
+                assembly = request.args.get('assembly')
+                include_files = request.args.get('include_files')
+                regions = parse_bed(request.get_data(as_text=True).splitlines())
+            else:
+                query = json.loads(request.data)
+                if not isinstance(query, dict) or not isinstance(query.get('regions', []), list):
+                    raise ValueError('Invalid request')
+                assembly = query.get('assembly')
+                include_files = query.get('include_files')
+                regions = parse_regions(query.get('regions', []))
+        except ValueError as err:
+            return help_usage('InvalidParameters', 400, params_required, {'regions': str(err)})
+
+        if assembly is None or not regions:
+            return help_usage('MissingParameters', 400, params_required, {})
+
+        if len(regions) > APP.config['FILES_REGIONS_MAX']:
+            return help_usage('TooManyRegions', 400, params_required,
+                              {'regions': len(regions)})
+
+        selected_user_id = user_id['user_id']
+        if request.args.get('public') is not None:
+            selected_user_id = user_id['public_id']
+
+        with _get_dm_api(selected_user_id) as dmp_api:
+            matches = self._get_all_files_regions(
+                dmp_api, selected_user_id, assembly, [r[:3] for r in regions])
+
+            result = {
+                '_links': {
+                    '_self': request.base_url,
+                    '_parent' : request.url_root + 'mug/api/dmp'
+                },
+                'regions': []
+            }
+            for (chrom, start, end, name), file_ids in zip(regions, matches):
+                match = {'region': '{}:{}:{}'.format(chrom, start, end), 'file_ids': file_ids}
+                if name is not None:
+                    match['name'] = name
+                result['regions'].append(match)
+
+            if str(include_files).lower() in ('1', 'true'):
+                result['files'] = get_files_by_ids(
+                    dmp_api, selected_user_id, unique_ids(*matches),
+                    chunk_size=APP.config['DM_BATCH_SIZE'],
+                    max_workers=APP.config['DM_LOOKUP_WORKERS']
+                )
+
+        return result
+
+    def _get_all_files_regions(self, dmp_api, user_id, assembly, regions):
+        """
+        Get the ids of the files overlapping each of a list of regions
+
+        Files that are in the region index are merged with those found in the
+        HDF5 index, so files registered with intervals do not hide the files
+        that are only in the HDF5 index.
+        """
+        with METRICS.timer('region_index', 'query_many'):
+            matches = REGION_INDEX.query_many(
+                user_id, assembly, regions,
+                loader=lambda: dmp_api.get_files_by_assembly(user_id, assembly))
+        if matches is None:
+            matches = [[] for _ in regions]
+
+        return [
+            [str(f_id) for f_id in unique_ids(index_hits, h5_hits[1], h5_hits[1000])]
+            for index_hits, h5_hits in zip(
+                matches, self._get_hdf5_regions(user_id, assembly, regions))
+        ]
+
+    def _get_hdf5_regions(self, user_id, assembly, regions):
+        """
+        Query the HDF5 index one region at a time
+
+        Returns
+        -------
+        list
+            The files found by the HDF5 reader for each region
+        """
+        # The location of the HDF5 index is internal to the reader, so the
+        # readers are cached per user and reopened after a maximum age
+        with METRICS.timer('hdf5_reader', 'get_regions'):
+            with HANDLE_CACHE.open(
+                    'hdf5_reader:' + str(user_id), lambda _: hdf5_reader(user_id), 'hdf5',
+                    max_age=APP.config['HDF5_READER_MAX_AGE']) as h5_idx:
+                return [
+                    h5_idx.get_regions(assembly, chrom, int(start), int(end))
+                    for chrom, start, end in regions
+                ]
+
     def _get_all_files_region(self, dmp_api, user_id, assembly, region):
-        files = []
-        chrom, start, end = region.split(':')
-        h5_idx = hdf5_reader(user_id['user_id'])
-        potential_files = h5_idx.get_regions(assembly, chrom, int(start), int(end))
-        for f_in in potential_files[1]:
-            files.append(dmp_api.get_file_by_id(f_in))
-        for f_in in potential_files[1000]:
-            files.append(dmp_api.get_file_by_id(f_in))
-        return files
+        chrom, start, end, _ = parse_regions([region])[0]
+        file_ids = self._get_all_files_regions(
+            dmp_api, user_id, assembly, [(chrom, start, end)])[0]
+
+        return get_files_by_ids(
+            dmp_api, user_id, file_ids,
+            chunk_size=APP.config['DM_BATCH_SIZE'],
+            max_workers=APP.config['DM_LOOKUP_WORKERS']
+        )
 
 
 class FileHistory(Resource):
@@ -567,21 +1491,32 @@ class FileHistory(Resource):
     """
 
     @authorized
+    @conditional_get(public=False)
+    @coalesced(public=False)
     def get(self, user_id):
         """
         GET the list of files that were used for generating the defined file
 
+        Parameters
+        ----------
+        file_id : str
+            ID of the stored file
+        depth : int
+            Number of generations of source files to return as a DAG of
+            `nodes` and `edges`. 0 returns every generation.
+
         Example
         -------
         .. code-block:: none
            :linenos:
 
            curl -X GET http://localhost:5002/mug/api/dmp/file_history?file_id=<file_id>
+
+           curl -X GET http://localhost:5002/mug/api/dmp/file_history?file_id=<file_id>&depth=0
         """
         if user_id is not None:
-            dmp_api = _get_dm_api(user_id['user_id'])
-
             file_id = request.args.get('file_id')
+            depth = request.args.get('depth')
 
             params = [user_id, file_id]
 
@@ -596,7 +1531,14 @@ class FileHistory(Resource):
                                       'file_id' : file_id
                                   })
 
-            files = dmp_api.get_file_history(user_id['user_id'], file_id)
+            if depth is not None:
+                if not depth.isdigit():
+                    return help_usage('InvalidParameters', 400, ['file_id', 'depth'],
+                                      {'depth' : depth})
+                return self._get_lineage(user_id['user_id'], file_id, int(depth))
+
+            with _get_dm_api(user_id['user_id']) as dmp_api:
+                files = dmp_api.get_file_history(user_id['user_id'], file_id)
 
             return {
                 '_links': {
@@ -608,6 +1550,430 @@ class FileHistory(Resource):
 
         return help_usage('Forbidden', 403, [], {})
 
+    def _get_lineage(self, user_id, file_id, depth):
+        """
+        Get the ancestors of a file as a DAG, following at most `depth`
+        generations, or LINEAGE_MAX_DEPTH if depth is 0.
+        """
+        max_depth = APP.config['LINEAGE_MAX_DEPTH']
+        depth = min(depth, max_depth) if depth > 0 else max_depth
+
+        with _get_dm_api(user_id) as dmp_api:
+            nodes, edges = get_lineage(
+                user_id, file_id,
+                lambda file_ids: get_files_by_ids(
+                    dmp_api, user_id, file_ids,
+                    chunk_size=APP.config['DM_BATCH_SIZE'],
+                    max_workers=APP.config['DM_LOOKUP_WORKERS']),
+                LINEAGE_CACHE, depth)
+
+        return {
+            '_links': {
+                '_self': request.base_url,
+                '_parent' : request.url_root + 'mug/api/dmp'
+            },
+            'nodes': nodes,
+            'edges': edges
+        }
+
+class Track(Resource):
+    """
+    Class to handle the http requests for reading the data within a region
+    from bigWig and bigBed files
+    """
+
+    @authorized
+    @conditional_get(file_arg='file_id', file_stat=True)
+    def get(self, user_id):
+        """
+        GET the values or features for a region of a track file
+
+        Parameters
+        ----------
+        file_id : str
+            ID of a bigWig (bw) or bigBed (bb) file. Files are only read from
+            the directories listed in ORIGINAL_FILE_ROOTS.
+        region : str
+            <chromosome>:<start_pos>:<end_pos>
+        bins : int
+            Number of equal width bins to summarise the region into. For
+            bigWig files the summaries come from the zoom levels of the file
+            when the bins are wide enough. For bigBed files the number of
+            features overlapping each bin is returned.
+        summary : str
+            Summary for each bin of a bigWig file (mean, min, max, std,
+            coverage or sum). Default is mean.
+        format : str
+            json (default) or npz to return the arrays as a NumPy .npz file
+
+        Returns
+        -------
+        dict
+            For bigWig files a `values` list with a value for each base or
+            bin, null where there is no data. For bigBed files `starts`,
+            `ends` and `fields` for each feature, or `counts` for each bin.
+
+        Example
+        -------
+        .. code-block:: none
+           :linenos:
+
+           curl -X GET http://localhost:5002/mug/api/dmp/track?file_id=<file_id>&region=1:1000000:2000000&bins=1000
+
+        """
+        params_required = ['file_id', 'region', 'bins', 'summary', 'format']
+        if user_id is None:
+            return help_usage('Forbidden', 403, params_required, {})
+
+        file_id = request.args.get('file_id')
+        region = request.args.get('region')
+        bins = request.args.get('bins')
+        summary = request.args.get('summary', 'mean')
+        output_format = request.args.get('format', 'json')
+        public = request.args.get('public')
+
+        params = [file_id, region]
+
+        # Display the parameters available
+        if sum([x is None for x in params]) == len(params):
+            return help_usage(None, 200, params_required, {})
+
+        # ERROR - one of the required parameters is NoneType
+        if sum([x is not None for x in params]) != len(params):
+            return help_usage('MissingParameters', 400, params_required,
+                              {'file_id': file_id, 'region': region})
+
+        try:
+            chrom, start, end = parse_region(region)
+            bins = int(bins) if bins is not None else None
+            if bins is not None and bins < 1:
+                raise ValueError('Invalid bins')
+        except ValueError:
+            return help_usage('InvalidParameters', 400, params_required,
+                              {'region': region, 'bins': bins})
+
+        if summary not in SUMMARY_TYPES or output_format not in ('json', 'npz'):
+            return help_usage('InvalidParameters', 400, params_required,
+                              {'summary': summary, 'format': output_format})
+
+        selected_user_id = user_id['user_id']
+        if public is not None:
+            selected_user_id = user_id['public_id']
+
+        file_obj = _get_file_obj(selected_user_id, file_id)
+        if not file_obj:
+            return help_usage('FileNotFound', 404, params_required, {'file_id': file_id})
+
+        if not is_allowed_path(file_obj.get('file_path') or '', APP.config['ORIGINAL_FILE_ROOTS']):
+            return help_usage('Forbidden', 403, params_required, {'file_id': file_id})
+
+        kind = track_type(file_obj.get('file_type'))
+        if kind is None:
+            return help_usage('UnsupportedFileType', 400, params_required,
+                              {'file_type': file_obj.get('file_type')})
+
+        max_values = APP.config['TRACK_MAX_VALUES']
+        try:
+            with METRICS.timer('track', kind):
+                with HANDLE_CACHE.open(file_obj['file_path'], open_track, 'track') as handle:
+                    if kind == 'bigwig':
+                        result = read_bigwig(
+                            handle, chrom, start, end, bins, summary, max_values)
+                    else:
+                        result = read_bigbed(handle, chrom, start, end, bins, max_values)
+        except TrackError as err:
+            return help_usage(str(err), 400, params_required,
+                              {'file_id': file_id, 'region': region, 'bins': bins})
+
+        result['file_id'] = file_id
+        if output_format == 'npz':
+            return Response(to_npz(result), mimetype=NPZ_MIMETYPE)
+
+        result = to_json(result)
+        result['_links'] = {
+            '_self': request.base_url,
+            '_parent' : request.url_root + 'mug/api/dmp'
+        }
+        return result
+
+class Region(Resource):
+    """
+    Class to handle the http requests for reading the lines within a region
+    from tabular files such as BED, GFF, VCF and TSV
+    """
+
+    @authorized
+    @conditional_get(file_arg='file_id', file_stat=True)
+    def get(self, user_id):
+        """
+        GET the lines of a tabular file that overlap a region
+
+        The file must be sorted by chromosome and start, and can be
+        uncompressed or compressed with bgzip. Files with a tabix index (.tbi,
+        or .csi when pysam is installed) are read with it. Otherwise an index
+        is built the first time that the file is read and saved in
+        TABIX_INDEX_DIR, or next to the file if that is set to None. Only the
+        blocks of the file holding the region are read. Files are only read
+        from the directories listed in ORIGINAL_FILE_ROOTS.
+
+        Parameters
+        ----------
+        file_id : str
+            ID of a bed, bedgraph, gff, gtf, vcf or tsv file
+        region : str
+            <chromosome>:<start_pos>:<end_pos>, zero based and half open
+
+        Returns
+        -------
+        text/tab-separated-values
+            The matching lines of the file
+
+        Example
+        -------
+        .. code-block:: none
+           :linenos:
+
+           curl -X GET http://localhost:5002/mug/api/dmp/region?file_id=<file_id>&region=1:1000000:2000000
+
+        """
+        params_required = ['file_id', 'region']
+        if user_id is None:
+            return help_usage('Forbidden', 403, params_required, {})
+
+        file_id = request.args.get('file_id')
+        region = request.args.get('region')
+        public = request.args.get('public')
+
+        params = [file_id, region]
+
+        # Display the parameters available
+        if sum([x is None for x in params]) == len(params):
+            return help_usage(None, 200, params_required, {})
+
+        # ERROR - one of the required parameters is NoneType
+        if sum([x is not None for x in params]) != len(params):
+            return help_usage('MissingParameters', 400, params_required,
+                              {'file_id': file_id, 'region': region})
+
+        try:
+            chrom, start, end = parse_region(region)
+        except ValueError:
+            return help_usage('InvalidParameters', 400, params_required, {'region': region})
+
+        selected_user_id = user_id['user_id']
+        if public is not None:
+            selected_user_id = user_id['public_id']
+
+        file_obj = _get_file_obj(selected_user_id, file_id)
+        if not file_obj or not os.path.isfile(file_obj.get('file_path') or ''):
+            return help_usage('FileNotFound', 404, params_required, {'file_id': file_id})
+
+        if not is_allowed_path(file_obj['file_path'], APP.config['ORIGINAL_FILE_ROOTS']):
+            return help_usage('Forbidden', 403, params_required, {'file_id': file_id})
+
+        columns = tabular_columns(file_obj.get('file_type'))
+        if columns is None:
+            return help_usage('UnsupportedFileType', 400, params_required,
+                              {'file_type': file_obj.get('file_type')})
+
+        file_path = file_obj['file_path']
+        try:
+            with METRICS.timer('tabix', 'open'):
+                with HANDLE_CACHE.open(
+                        file_path,
+                        lambda path: open_index(path, columns, APP.config['TABIX_INDEX_DIR']),
+                        ('tabix', columns)
+                ) as index:
+                    pass
+        except TabixError as err:
+            return help_usage(str(err), 400, params_required,
+                              {'file_id': file_id, 'region': region})
+
+        # The index is not changed by reading, so it can be used once it has
+        # been released back to the cache
+        def _stream():
+            try:
+                for line in index.fetch(file_path, chrom, start, end):
+                    yield line
+            except TabixError:
+                return
+
+        return Response(_stream(), mimetype='text/tab-separated-values')
+
+class Sequence(Resource):
+    """
+    Class to handle the http requests for reading subsequences from FASTA
+    files and previews of the records in FASTQ files
+    """
+
+    @authorized
+    @conditional_get(file_arg='file_id', file_stat=True)
+    def get(self, user_id):
+        """
+        GET a subsequence of a FASTA file or records from a FASTQ file
+
+        FASTA files are read through a samtools style .fai index, which is
+        built the first time that the file is read and saved in
+        SEQUENCE_INDEX_DIR, or next to the file if that is set to None. FASTQ
+        files can be gzipped, and only as much of the file as is needed for
+        the records is read. Files are only read from the directories listed
+        in ORIGINAL_FILE_ROOTS.
+
+        Parameters
+        ----------
+        file_id : str
+            ID of a fasta or fastq file
+        region : str
+            <chromosome>:<start_pos>:<end_pos>, zero based and half open.
+            Required for FASTA files.
+        records : int
+            Number of FASTQ records to return. Default is 10.
+        sample : int
+            1 to return a random sample of the FASTQ records rather than the
+            first records. The sample of a gzipped file is taken from its
+            first FASTQ_SAMPLE_SCAN records.
+        seed : int
+            Seed for the random sample. Default is 0.
+
+        Returns
+        -------
+        dict
+            For FASTA files the `sequence` of the region. For FASTQ files the
+            records are returned as text.
+
+        Example
+        -------
+        .. code-block:: none
+           :linenos:
+
+           curl -X GET http://localhost:5002/mug/api/dmp/sequence?file_id=<file_id>&region=1:1000000:1000100
+
+           curl -X GET http://localhost:5002/mug/api/dmp/sequence?file_id=<file_id>&records=100&sample=1
+
+        """
+        params_required = ['file_id', 'region', 'records', 'sample', 'seed']
+        if user_id is None:
+            return help_usage('Forbidden', 403, params_required, {})
+
+        file_id = request.args.get('file_id')
+        public = request.args.get('public')
+
+        # Display the parameters available
+        if file_id is None:
+            return help_usage(None, 200, params_required, {})
+
+        selected_user_id = user_id['user_id']
+        if public is not None:
+            selected_user_id = user_id['public_id']
+
+        file_obj = _get_file_obj(selected_user_id, file_id)
+        if not file_obj or not os.path.isfile(file_obj.get('file_path') or ''):
+            return help_usage('FileNotFound', 404, params_required, {'file_id': file_id})
+
+        if not is_allowed_path(file_obj['file_path'], APP.config['ORIGINAL_FILE_ROOTS']):
+            return help_usage('Forbidden', 403, params_required, {'file_id': file_id})
+
+        kind = sequence_type(file_obj.get('file_type'))
+        if kind is None:
+            return help_usage('UnsupportedFileType', 400, params_required,
+                              {'file_type': file_obj.get('file_type')})
+
+        try:
+            if kind == 'fasta':
+                return self._get_fasta(file_id, file_obj['file_path'], params_required)
+            return self._get_fastq(file_obj['file_path'], params_required)
+        except SequenceError as err:
+            return help_usage(str(err), 400, params_required, {'file_id': file_id})
+
+    def _get_fasta(self, file_id, file_path, params_required):
+        region = request.args.get('region')
+        if region is None:
+            return help_usage('MissingParameters', 400, params_required,
+                              {'file_id': file_id, 'region': region})
+        try:
+            chrom, start, end = parse_region(region)
+        except ValueError:
+            return help_usage('InvalidParameters', 400, params_required, {'region': region})
+
+        with METRICS.timer('sequence', 'fasta'):
+            with HANDLE_CACHE.open(
+                    file_path,
+                    lambda path: open_fasta(path, APP.config['SEQUENCE_INDEX_DIR']),
+                    'fasta'
+            ) as fasta:
+                result = fasta.fetch(
+                    chrom, start, end, max_bases=APP.config['SEQUENCE_MAX_BASES'])
+
+        result['file_id'] = file_id
+        result['_links'] = {
+            '_self': request.base_url,
+            '_parent' : request.url_root + 'mug/api/dmp'
+        }
+        return result
+
+    def _get_fastq(self, file_path, params_required):
+        records = request.args.get('records', '10')
+        sample = request.args.get('sample')
+        seed = request.args.get('seed', '0')
+        try:
+            records = int(records)
+            sample = int(sample) if sample is not None else 0
+            seed = int(seed)
+        except ValueError:
+            return help_usage('InvalidParameters', 400, params_required,
+                              {'records': records, 'sample': sample, 'seed': seed})
+        if not 0 < records <= APP.config['SEQUENCE_MAX_RECORDS']:
+            return help_usage('InvalidParameters', 400, params_required, {'records': records})
+
+        if sample == 1:
+            with METRICS.timer('sequence', 'fastq_sample'):
+                sampled = fastq_sample(
+                    file_path, records, seed=seed, max_scan=APP.config['FASTQ_SAMPLE_SCAN'])
+            return Response(b''.join(sampled), mimetype='text/plain')
+
+        def _stream():
+            try:
+                for record in fastq_head(file_path, records):
+                    yield record
+            except SequenceError:
+                return
+
+        return Response(_stream(), mimetype='text/plain')
+
+class Token(Resource):
+    """
+    Class to handle the http requests for managing the cache of validated
+    bearer tokens
+    """
+
+    def delete(self):
+        """
+        DELETE Remove the bearer token for the request from the cache so that
+        it is validated by the auth server on its next use. This should be
+        called when a user logs out or their token is revoked.
+
+        Example
+        -------
+        .. code-block:: none
+           :linenos:
+
+           curl -X DELETE
+               -H "Authorization: Bearer teststring"
+               http://localhost:5002/mug/api/dmp/token
+
+        """
+        token = get_bearer_token()
+        if token is None:
+            return help_usage('MissingParameters', 400, [], {})
+
+        return {
+            '_links': {
+                '_self': request.base_url,
+                '_parent' : request.url_root + 'mug/api/dmp'
+            },
+            'purged': TOKEN_CACHE.purge(token)
+        }
+
 class Ping(Resource):
     """
     Class to handle the http requests to ping a service
@@ -639,10 +2005,38 @@ class Ping(Resource):
             "_links" : {
                 '_self' : request.base_url,
                 '_parent' : request.url_root + 'mug/api/dmp'
-            }
+            },
+            "dm_pool": DM_REGISTRY.stats(),
+            "auth_cache": TOKEN_CACHE.stats(),
+            "handle_cache": HANDLE_CACHE.stats()
         }
         return res
 
+class Metrics(Resource):
+    """
+    Class to handle the http requests for the service metrics
+    """
+
+    def get(self):
+        """
+        GET Metrics
+
+        Request counts and latency histograms for each resource, along with
+        the time taken by the DM API, auth server, region index and JSON
+        serialisation, in the Prometheus text format. Each worker process
+        reports its own metrics.
+
+        Example
+        -------
+        .. code-block:: none
+           :linenos:
+
+           curl -X GET http://localhost:5002/mug/api/dmp/metrics
+
+        """
+        return Response(METRICS.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
 #
 # For the services where there needs to be an extra layer (adjacency lists),
 # then there needs to be a way of forwarding for this. But the majority of
@@ -653,6 +2047,8 @@ sys._auth_meta_json = os.path.dirname(os.path.realpath(__file__)) + '/auth_meta.
 
 # Define the URIs and their matching methods
 REST_API = Api(APP)
+REST_API.representation('application/json')(
+    METRICS.timed('serialization', 'json')(output_json))
 
 #   List the available end points for this service
 REST_API.add_resource(EndPoints, "/mug/api/dmp", endpoint='dmp_root')
@@ -666,6 +2062,21 @@ REST_API.add_resource(Files, "/mug/api/dmp/files", endpoint='files')
 #   List file history
 REST_API.add_resource(FileHistory, "/mug/api/dmp/file_history", endpoint='file_history')
 
+#   Get the data for a region of a track
+REST_API.add_resource(Track, "/mug/api/dmp/track", endpoint='track')
+
+#   Lines from tabular files within a region
+REST_API.add_resource(Region, "/mug/api/dmp/region", endpoint='region')
+
+#   Subsequences from FASTA files and records from FASTQ files
+REST_API.add_resource(Sequence, "/mug/api/dmp/sequence", endpoint='sequence')
+
+#   Remove a cached bearer token
+REST_API.add_resource(Token, "/mug/api/dmp/token", endpoint='dmp-token')
+
+#   Prometheus metrics
+REST_API.add_resource(Metrics, "/mug/api/dmp/metrics", endpoint='dmp-metrics')
+
 #   Service ping
 REST_API.add_resource(Ping, "/mug/api/dmp/ping", endpoint='dmp-ping')
 
@@ -0,0 +1,208 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request
+
+
+def get_bearer_token():
+    """
+    Get the bearer token from the Authorization header of the current request
+
+    Returns
+    -------
+    str
+        The token, or None if there is no Authorization header
+    """
+    header = request.headers.get('Authorization')
+    if not header:
+        return None
+    return header.split()[-1]
+
+
+class _Resolved(object):
+    """
+    Wrapper for the user_id passed on by the authorization decorator so that
+    it can be told apart from an error response
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+class TokenCache(object):
+    """
+    Bounded LRU cache of validated bearer tokens and the user_id dict that
+    they resolved to. Entries expire after `ttl` seconds, or earlier if the
+    auth server included an expiry time for the token.
+    """
+
+    def __init__(self, max_size=1024, ttl=300.0):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of tokens to hold
+        ttl : float
+            Maximum number of seconds that a token is held for
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _expires_at(self, user_id):
+        expires_at = time.time() + self.ttl
+        for key in ('exp', 'expires_at'):
+            try:
+                expires_at = min(expires_at, float(user_id[key]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return expires_at
+
+    def get(self, token):
+        """
+        Get the user_id dict for a token
+
+        Returns
+        -------
+        dict
+            None if the token is not cached or has expired
+        """
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            if entry[0] <= time.time():
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[1]
+
+    def put(self, token, user_id):
+        """
+        Cache the user_id dict for a validated token
+        """
+        expires_at = self._expires_at(user_id)
+        if expires_at <= time.time():
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def purge(self, token):
+        """
+        Remove a token from the cache
+
+        Returns
+        -------
+        bool
+            True if the token was cached
+        """
+        with self._lock:
+            return self._entries.pop(self._key(token), None) is not None
+
+    def clear(self):
+        """
+        Remove all tokens from the cache
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Usage figures for the cache
+
+        Returns
+        -------
+        dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations
+            }
+
+    def decorator(self, authorize):
+        """
+        Wrap an authorization decorator so that it is only called for tokens
+        that are not already in the cache.
+
+        Parameters
+        ----------
+        authorize : function
+            Decorator that validates the request and passes the user_id dict
+            on to the function it wraps, e.g. mg_rest_util.mg_auth.authorized
+
+        Returns
+        -------
+        function
+            Decorator with the same behaviour as `authorize`
+        """
+        def _resolve(*args, **kwargs):
+            if 'user_id' in kwargs:
+                return _Resolved(kwargs['user_id'])
+            return _Resolved(args[-1])
+
+        resolve = authorize(_resolve)
+
+        def _decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                token = get_bearer_token()
+                if token is not None:
+                    user_id = self.get(token)
+                    if user_id is not None:
+                        return func(user_id=user_id, *args, **kwargs)
+
+                result = resolve(*args, **kwargs)
+                if not isinstance(result, _Resolved):
+                    return result
+
+                if token is not None and result.user_id is not None:
+                    self.put(token, result.user_id)
+                return func(user_id=result.user_id, *args, **kwargs)
+            return wrapper
+        return _decorator
@@ -0,0 +1,225 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ENCODINGS = ['br', 'gzip', 'deflate'] if brotli is not None else ['gzip', 'deflate']
+
+
+def encoded_etag(etag, encoding):
+    """
+    ETag for the encoded form of a response. Strong ETags need to be
+    different for each content encoding.
+    """
+    return '{}-{}'.format(etag, encoding)
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check an If-None-Match header against an ETag and its encoded forms
+
+    Parameters
+    ----------
+    if_none_match : werkzeug.datastructures.ETags
+    etag : str
+        Unquoted ETag for the uncompressed response
+
+    Returns
+    -------
+    str
+        The ETag, or the encoded form of it, that matched so that it can be
+        returned with the 304 response, or None if there is no match
+    """
+    for candidate in [etag] + [encoded_etag(etag, encoding) for encoding in ENCODINGS]:
+        if if_none_match.contains(candidate):
+            return candidate
+    return None
+
+
+class _Brotli(object):
+    """
+    Wrapper giving brotli the same interface as a zlib compression object
+    """
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def _compressobj(encoding, level):
+    if encoding == 'br':
+        return _Brotli(min(level, 11))
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+
+def _compress_stream(iterable, encoding, level):
+    compressor = _compressobj(encoding, level)
+    try:
+        for chunk in iterable:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compressor(object):
+    """
+    Compresses responses with the best encoding accepted by the client.
+
+    Responses smaller than the `COMPRESS_MIN_SIZE` config value are left as
+    they are, and `COMPRESS_LEVEL` sets the compression level. Both are read
+    from the config of the app on each request, so they can be changed after
+    the compressor has been created. Streamed
+    responses are compressed chunk by chunk as they are sent. The compressed
+    bytes of responses with an ETag are cached so that repeated requests for
+    an unchanged response are not compressed again.
+    """
+
+    def __init__(self, app=None, min_size=1024, level=6, cache_size=256,
+                 mimetypes=('application/json', 'application/x-ndjson', 'text/plain')):
+        """
+        Parameters
+        ----------
+        app : Flask
+        min_size : int
+            Smallest response, in bytes, that is compressed if the app config
+            does not set `COMPRESS_MIN_SIZE`
+        level : int
+            Compression level (1-9 for gzip and deflate, up to 11 for brotli)
+            if the app config does not set `COMPRESS_LEVEL`
+        cache_size : int
+            Maximum number of compressed responses to cache
+        mimetypes : tuple
+            Mimetypes that are compressed
+        """
+        self.min_size = min_size
+        self.level = level
+        self.cache_size = cache_size
+        self.mimetypes = mimetypes
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Register the compressor to run after each request
+        """
+        app.after_request(self.after_request)
+
+    def _cache_get(self, key):
+        with self._lock:
+            data = self._cache.pop(key, None)
+            if data is None:
+                self._misses += 1
+                return None
+            self._cache[key] = data
+            self._hits += 1
+            return data
+
+    def _cache_put(self, key, data):
+        with self._lock:
+            self._cache[key] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def after_request(self, response):
+        """
+        Compress the response if the client accepts a supported encoding
+        """
+        if response.mimetype not in self.mimetypes:
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        if (response.status_code != 200 or response.direct_passthrough or
+                'Content-Encoding' in response.headers):
+            return response
+
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        if encoding is None:
+            return response
+
+        min_size = current_app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        level = current_app.config.get('COMPRESS_LEVEL', self.level)
+
+        etag, weak = response.get_etag()
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+
+            key = (etag, encoding, level) if etag is not None and not weak else None
+            compressed = self._cache_get(key) if key is not None else None
+            if compressed is None:
+                compressor = _compressobj(encoding, level)
+                compressed = compressor.compress(data) + compressor.flush()
+                if key is not None:
+                    self._cache_put(key, compressed)
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            response.set_etag(encoded_etag(etag, encoding), weak)
+        return response
+
+    def stats(self):
+        """
+        Usage figures for the compressed response cache
+
+        Returns
+        -------
+        dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'max_size': self.cache_size,
+                'hits': self._hits,
+                'misses': self._misses
+            }
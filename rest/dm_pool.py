@@ -0,0 +1,345 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from rest.dm_store import shutdown_lookup_pool
+
+
+class DMClientPool(object):
+    """
+    Bounded pool of DM API client instances for a single mode (live|test).
+
+    Clients are created lazily by the factory, handed out to one thread at a
+    time and returned to the pool once the request has finished with them.
+    Clearing the pool bumps its generation so that clients that are checked
+    out at that point are closed when they are returned rather than reused.
+    """
+
+    def __init__(self, mode, factory, max_size=4, timeout=30.0):
+        """
+        Parameters
+        ----------
+        mode : str
+            Either 'live' or 'test'
+        factory : function
+            Called with the mode to create a new DM API client
+        max_size : int
+            Maximum number of clients that can exist at any one time
+        timeout : float
+            Number of seconds to wait for a free client before giving up
+        """
+        self.mode = mode
+        self.max_size = max(1, int(max_size))
+        self.timeout = timeout
+        self._factory = factory
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._generation = 0
+        self._size = 0
+        self._in_use = 0
+        self._created = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._peak_in_use = 0
+
+    def acquire(self):
+        """
+        Check out a client, creating one if the pool is not at capacity
+
+        Returns
+        -------
+        tuple
+            (client, generation) - the generation needs to be passed back to
+            release()
+        """
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError(
+                        "Timed out waiting for a {} DM API client".format(self.mode))
+                self._waits += 1
+                self._cond.wait(remaining)
+
+            self._checkouts += 1
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            generation = self._generation
+            if self._idle:
+                return self._idle.pop(), generation
+            self._size += 1
+
+        try:
+            client = self._factory(self.mode)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._created += 1
+        return client, generation
+
+    def release(self, client, generation):
+        """
+        Return a client to the pool. Clients from an older generation are
+        closed instead.
+        """
+        stale = False
+        with self._cond:
+            self._in_use -= 1
+            if generation != self._generation:
+                self._size -= 1
+                stale = True
+            else:
+                self._idle.append(client)
+            self._cond.notify()
+
+        if stale:
+            _close_client(client)
+
+    def clear(self):
+        """
+        Close all idle clients and retire any that are currently checked out
+        """
+        with self._cond:
+            self._generation += 1
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for client in idle:
+            _close_client(client)
+
+    def stats(self):
+        """
+        Current usage figures for the pool
+
+        Returns
+        -------
+        dict
+        """
+        with self._cond:
+            return {
+                'mode': self.mode,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'peak_in_use': self._peak_in_use,
+                'created': self._created,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'generation': self._generation
+            }
+
+
+class DMClientRegistry(object):
+    """
+    Process wide registry of DM API client pools keyed by mode.
+
+    The live pool is used when the mongodb.cnf file is present, otherwise the
+    test pool is used. The config file is re-checked at most once every
+    `check_interval` seconds and the live pool is cleared when its mtime
+    changes so that new connection details are picked up without a restart.
+    """
+
+    def __init__(self, cnf_loc, factory, max_size=4, test_max_size=1,
+                 check_interval=1.0, timeout=30.0):
+        """
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the mongodb.cnf file
+        factory : function
+            Called with (cnf_loc, mode) to create a new DM API client
+        max_size : int
+            Maximum number of live clients. This should match the number of
+            threads that the server is running with.
+        test_max_size : int
+            Maximum number of test clients. The test client holds its data in
+            memory so this defaults to a single shared client.
+        check_interval : float
+            Minimum number of seconds between checks of the config file
+        timeout : float
+            Number of seconds to wait for a free client
+        """
+        self.cnf_loc = cnf_loc
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._cnf_mtime = self._get_mtime()
+        self._pools = {
+            'live': DMClientPool(
+                'live', lambda mode: factory(cnf_loc, mode), max_size, timeout),
+            'test': DMClientPool(
+                'test', lambda mode: factory(cnf_loc, mode), test_max_size, timeout),
+        }
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.cnf_loc).st_mtime
+        except OSError:
+            return None
+
+    def _check_config(self):
+        """
+        Clear the live pool if the config file has been created, modified or
+        removed since it was last checked
+        """
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return
+
+        with self._lock:
+            if now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            mtime = self._get_mtime()
+            changed = mtime != self._cnf_mtime
+            self._cnf_mtime = mtime
+
+        if changed:
+            self._pools['live'].clear()
+
+    def get_mode(self, user_id=None):
+        """
+        Identify which pool should be used for a given user
+
+        Parameters
+        ----------
+        user_id : str
+            User identifier
+
+        Returns
+        -------
+        str
+            'live' or 'test'
+        """
+        self._check_config()
+        if user_id == 'test' or self._cnf_mtime is None:
+            return 'test'
+        return 'live'
+
+    @contextmanager
+    def client(self, user_id=None):
+        """
+        Check out a DM API client for the duration of a with block
+
+        Parameters
+        ----------
+        user_id : str
+            User identifier
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           with DM_REGISTRY.client(user_id) as dmp_api:
+               dmp_api.get_files_by_user(user_id)
+        """
+        pool = self._pools[self.get_mode(user_id)]
+        client, generation = pool.acquire()
+        try:
+            yield client
+        finally:
+            pool.release(client, generation)
+
+    def resize(self, max_size, mode='live'):
+        """
+        Change the maximum number of clients in a pool, e.g. to match the
+        number of server threads
+        """
+        pool = self._pools[mode]
+        with pool._cond:  # pylint: disable=protected-access
+            pool.max_size = max(1, int(max_size))
+            pool._cond.notify_all()  # pylint: disable=protected-access
+
+    def warm(self, user_id=None, count=None):
+        """
+        Create clients ahead of the first requests
+
+        Parameters
+        ----------
+        user_id : str
+            User identifier used to select the pool
+        count : int
+            Number of clients to create. Defaults to the size of the pool.
+        """
+        pool = self._pools[self.get_mode(user_id)]
+        clients = []
+        try:
+            for _ in range(count or pool.max_size):
+                clients.append(pool.acquire())
+        finally:
+            for client, generation in clients:
+                pool.release(client, generation)
+
+    def reload(self):
+        """
+        Force all pools to be recreated on their next use
+        """
+        with self._lock:
+            self._cnf_mtime = self._get_mtime()
+            self._last_check = time.time()
+        for pool in self._pools.values():
+            pool.clear()
+
+    def shutdown(self):
+        """
+        Close all idle clients and stop the threads used for single id
+        lookups. Clients that are still checked out are closed as they are
+        returned.
+        """
+        for pool in self._pools.values():
+            pool.clear()
+        shutdown_lookup_pool()
+
+    def stats(self):
+        """
+        Usage figures for each of the pools
+
+        Returns
+        -------
+        dict
+        """
+        return {mode: pool.stats() for mode, pool in self._pools.items()}
+
+
+def _close_client(client):
+    """
+    Close the database connection held by a DM API client if it exposes one
+    """
+    for close in (getattr(client, 'close', None),
+                  getattr(getattr(getattr(client, 'db', None), 'client', None), 'close', None)):
+        if callable(close):
+            try:
+                close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+            return
@@ -0,0 +1,684 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+# Compound indexes backing the filtered file listings. Equality filters are
+# always scoped to a user, so each index leads with user_id.
+FILE_INDEXES = [
+    [('user_id', 1), ('meta_data.assembly', 1), ('file_type', 1), ('data_type', 1)],
+    [('user_id', 1), ('meta_data.assembly', 1), ('data_type', 1)],
+    [('user_id', 1), ('file_type', 1), ('data_type', 1)],
+    [('user_id', 1), ('data_type', 1)],
+    [('user_id', 1), ('taxon_id', 1)],
+]
+
+# Mapping of the filter parameters to the fields within the store
+FILTER_FIELDS = {
+    'assembly': 'meta_data.assembly',
+    'file_type': 'file_type',
+    'data_type': 'data_type',
+    'taxon_id': 'taxon_id',
+}
+
+# Keys that have to be provided when registering a file
+REQUIRED_FILE_KEYS = [
+    'file_path', 'file_type', 'data_type', 'taxon_id', 'source_id', 'meta_data'
+]
+
+# Filters that can be used to select files for deletion
+DELETE_FILTER_FIELDS = ['source_id', 'parent_dir', 'data_type']
+
+
+try:
+    _JSON_TYPES = (bool, int, long, float, str, unicode)  # pylint: disable=undefined-variable
+except NameError:
+    _JSON_TYPES = (bool, int, float, str)
+
+
+class QueryTooBroad(Exception):
+    """
+    Raised when a query matches more records than the allowed maximum
+    """
+    pass
+
+
+def get_collection(dmp_api):
+    """
+    Get the collection holding the file entries from a DM API client
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+
+    Returns
+    -------
+    Collection
+        The entries collection, or None if the client does not expose its
+        database
+    """
+    return getattr(getattr(dmp_api, 'db', None), 'entries', None)
+
+
+def get_bulk_store(dmp_api):
+    """
+    Get the client if it provides its own bulk operations, as
+    rest.sqlite_store.SQLiteStore does
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+
+    Returns
+    -------
+    object
+        The client, or None if it only provides the DM API methods
+    """
+    return dmp_api if getattr(dmp_api, 'supports_bulk', False) is True else None
+
+
+def _format_value(value):
+    if isinstance(value, dict):
+        return {k: _format_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_format_value(v) for v in value]
+    if value is None or isinstance(value, _JSON_TYPES):
+        return value
+    # ObjectIds, datetimes and any other values that cannot be serialised
+    # as JSON
+    return str(value)
+
+
+def format_record(record):
+    """
+    Convert a raw store record into the form returned by the DM API, with
+    every value that cannot be serialised as JSON, such as the `_id` and
+    `creation_time`, converted to a string
+
+    Parameters
+    ----------
+    record : dict
+
+    Returns
+    -------
+    dict
+    """
+    if record is None:
+        return None
+    return _format_value(record)
+
+
+def to_object_ids(file_ids):
+    """
+    Convert file ids into ObjectIds where they are valid so that they match
+    the `_id` values held in the store
+    """
+    from bson.objectid import ObjectId
+
+    return [ObjectId(f_id) if ObjectId.is_valid(f_id) else f_id for f_id in file_ids]
+
+
+def unique_ids(*id_lists):
+    """
+    Merge lists of file ids, removing duplicates while keeping the order in
+    which each id was first seen
+
+    Returns
+    -------
+    list
+    """
+    seen = set()
+    merged = []
+    for id_list in id_lists:
+        for f_id in id_list:
+            if f_id not in seen:
+                seen.add(f_id)
+                merged.append(f_id)
+    return merged
+
+
+def _chunks(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+_LOOKUP_LOCK = threading.Lock()
+_LOOKUP_POOL = {}
+
+
+def get_lookup_pool(size):
+    """
+    Get the thread pool that single id lookups are run on. The pool is
+    created on first use, so that a process that forks before serving
+    requests does not share its threads, and is replaced if the requested
+    size changes.
+
+    Parameters
+    ----------
+    size : int
+        Number of threads in the pool
+
+    Returns
+    -------
+    ThreadPool
+    """
+    key = (os.getpid(), size)
+    with _LOOKUP_LOCK:
+        pool = _LOOKUP_POOL.get(key)
+        if pool is None:
+            _close_lookup_pools()
+            pool = _LOOKUP_POOL[key] = ThreadPool(size)
+    return pool
+
+
+def _close_lookup_pools():
+    """
+    Let the threads of the existing pools finish their work and exit. Must be
+    called with the lock held.
+    """
+    for (pid, _), pool in _LOOKUP_POOL.items():
+        # Threads inherited from the parent process no longer exist
+        if pid == os.getpid():
+            pool.close()
+    _LOOKUP_POOL.clear()
+
+
+def shutdown_lookup_pool():
+    """
+    Stop the threads used for single id lookups
+    """
+    with _LOOKUP_LOCK:
+        _close_lookup_pools()
+
+
+def get_files_by_ids(dmp_api, user_id, file_ids, chunk_size=1000, max_workers=8):
+    """
+    Get the records for a list of file ids with as few round trips to the
+    store as possible.
+
+    If the DM API client exposes its database the records are fetched with a
+    single `$in` query per chunk of ids. Otherwise each id is looked up with
+    `get_file_by_id`, running at most `max_workers` lookups at the same time
+    on a pool that is shared by all requests.
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    user_id : str
+        User identifier
+    file_ids : list
+        File ids to retrieve. Duplicates are removed.
+    chunk_size : int
+        Maximum number of ids in a single query
+    max_workers : int
+        Maximum number of concurrent single id lookups
+
+    Returns
+    -------
+    list
+        File records in the same order as `file_ids`. Ids that could not be
+        found are not included.
+    """
+    file_ids = unique_ids(file_ids)
+    if not file_ids:
+        return []
+
+    store = get_bulk_store(dmp_api)
+    if store is not None:
+        return store.get_files_by_ids(user_id, file_ids)
+
+    entries = get_collection(dmp_api)
+    found = {}
+    if entries is not None:
+        for chunk in _chunks(file_ids, chunk_size):
+            for record in entries.find(
+                    {'_id': {'$in': to_object_ids(chunk)}, 'user_id': user_id}):
+                record = format_record(record)
+                found[record['_id']] = record
+    else:
+        def _lookup(f_id):
+            return f_id, dmp_api.get_file_by_id(user_id, f_id)
+
+        if max_workers <= 1 or len(file_ids) == 1:
+            results = [_lookup(f_id) for f_id in file_ids]
+        else:
+            results = get_lookup_pool(max_workers).map(_lookup, file_ids)
+        found = {f_id: record for f_id, record in results if record is not None}
+
+    return [found[f_id] for f_id in file_ids if f_id in found]
+
+
+def is_valid_id(dmp_api, file_id):
+    """
+    Check that a value could be the id of a file in the store, e.g. before
+    it is used as the cursor for a listing
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    file_id : str
+
+    Returns
+    -------
+    bool
+    """
+    store = get_bulk_store(dmp_api)
+    if store is not None:
+        return store.is_valid_id(file_id)
+
+    if get_collection(dmp_api) is not None:
+        from bson.objectid import ObjectId
+        return ObjectId.is_valid(file_id)
+
+    return True
+
+
+def iter_files_by_user(dmp_api, user_id, after=None, limit=None):
+    """
+    Iterate over the files for a user ordered by their file id
+
+    When the DM API client exposes its database the records are read from a
+    store cursor so that only one batch is held in memory at a time.
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    user_id : str
+        User identifier
+    after : str
+        Only return files with an id greater than this
+    limit : int
+        Maximum number of files to return
+
+    Returns
+    -------
+    generator
+        File records
+    """
+    store = get_bulk_store(dmp_api)
+    if store is not None:
+        for record in store.iter_files_by_user(user_id, after, limit):
+            yield record
+        return
+
+    entries = get_collection(dmp_api)
+    if entries is not None:
+        query = {'user_id': user_id}
+        if after is not None:
+            query['_id'] = {'$gt': to_object_ids([after])[0]}
+        cursor = entries.find(query).sort('_id', 1)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        for record in cursor:
+            yield format_record(record)
+        return
+
+    records = sorted(dmp_api.get_files_by_user(user_id), key=lambda r: str(r['_id']))
+    if after is not None:
+        records = [r for r in records if str(r['_id']) > after]
+    if limit is not None:
+        records = records[:limit]
+    for record in records:
+        yield format_record(record)
+
+
+def ensure_indexes(dmp_api):
+    """
+    Create the indexes used by the filtered listings if they do not already
+    exist
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    """
+    entries = get_collection(dmp_api)
+    if entries is None:
+        return
+    for keys in FILE_INDEXES:
+        entries.create_index(keys, background=True)
+
+
+def _get_field(record, field):
+    value = record
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def find_files(dmp_api, user_id, filters, max_results=None):
+    """
+    Get the files for a user that match all of the given filters
+
+    When the DM API client exposes its database the filters are sent to the
+    store as a single query, otherwise the files for the assembly (or user)
+    are filtered once they have been retrieved.
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    user_id : str
+        User identifier
+    filters : dict
+        Any of assembly, file_type, data_type and taxon_id
+    max_results : int
+        Maximum number of matching files. QueryTooBroad is raised as soon as
+        more files than this are found.
+
+    Returns
+    -------
+    list
+        Matching file records, normalised with format_record()
+    """
+    query = {FILTER_FIELDS[k]: v for k, v in filters.items() if v is not None}
+
+    store = get_bulk_store(dmp_api)
+    entries = get_collection(dmp_api)
+    if store is not None:
+        records = store.find_files(
+            user_id, filters, limit=max_results + 1 if max_results is not None else None)
+    elif entries is not None:
+        query['user_id'] = user_id
+        cursor = entries.find(query)
+        if max_results is not None:
+            cursor = cursor.limit(max_results + 1)
+        records = cursor
+    else:
+        if 'meta_data.assembly' in query:
+            records = dmp_api.get_files_by_assembly(user_id, query['meta_data.assembly'])
+        else:
+            records = dmp_api.get_files_by_user(user_id)
+        records = (
+            record for record in records
+            if all(_get_field(record, k) == v for k, v in query.items())
+        )
+
+    files = []
+    for record in records:
+        if max_results is not None and len(files) >= max_results:
+            raise QueryTooBroad()
+        files.append(format_record(record))
+    return files
+
+
+def patch_file_metadata(dmp_api, user_id, file_ids, add_meta=None, remove_meta=None):
+    """
+    Add and remove meta data keys for a set of files in a single update
+
+    When the DM API client exposes its database all of the changes for all of
+    the files are sent as one update, otherwise each key is changed with a
+    separate DM API call.
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    user_id : str
+        User identifier
+    file_ids : list
+        IDs of the files to update
+    add_meta : dict
+        Key-value pairs to add to the meta data
+    remove_meta : list
+        Keys to remove from the meta data
+
+    Returns
+    -------
+    list
+        The ids of the files that were updated
+    """
+    add_meta = add_meta or {}
+    remove_meta = remove_meta or []
+
+    if set(add_meta).intersection(remove_meta):
+        raise ValueError('Meta data keys cannot be both added and removed')
+
+    store = get_bulk_store(dmp_api)
+    if store is not None:
+        return store.patch_file_metadata(user_id, file_ids, add_meta, remove_meta)
+
+    entries = get_collection(dmp_api)
+    if entries is not None:
+        update = {}
+        if add_meta:
+            update['$set'] = {'meta_data.' + k: v for k, v in add_meta.items()}
+        if remove_meta:
+            update['$unset'] = {'meta_data.' + k: '' for k in remove_meta}
+        if update:
+            entries.update_many(
+                {'_id': {'$in': to_object_ids(file_ids)}, 'user_id': user_id}, update)
+        return file_ids
+
+    for file_id in file_ids:
+        for key in add_meta:
+            dmp_api.add_file_metadata(user_id, file_id, key, add_meta[key])
+        for key in remove_meta:
+            dmp_api.remove_file_metadata(user_id, file_id, key)
+    return file_ids
+
+
+def validate_files(records):
+    """
+    Check a list of file descriptors for the keys needed to register them
+
+    Parameters
+    ----------
+    records : list
+        File descriptors
+
+    Returns
+    -------
+    list
+        None for each valid record, or a dict describing the error
+    """
+    errors = []
+    for record in records:
+        if not isinstance(record, dict):
+            errors.append({'error': 'InvalidRecord'})
+            continue
+        missing = [k for k in REQUIRED_FILE_KEYS if record.get(k) is None]
+        errors.append({'error': 'MissingParameters', 'missing': missing} if missing else None)
+    return errors
+
+
+def insert_files(dmp_api, user_id, records, chunk_size=1000):
+    """
+    Register a batch of validated files
+
+    When the DM API client is backed by a bulk store the files are inserted
+    in a single transaction. When it exposes its database the files are
+    inserted with an unordered bulk insert for each chunk of records, with
+    the same fields that `set_file` stores. Otherwise each file is
+    registered with `set_file`.
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    user_id : str
+        User identifier
+    records : list
+        File descriptors that have passed validate_files()
+    chunk_size : int
+        Maximum number of records in a single insert
+
+    Returns
+    -------
+    list
+        (file_id, error) for each record
+    """
+    store = get_bulk_store(dmp_api)
+    if store is not None:
+        return store.insert_files(user_id, records)
+
+    entries = get_collection(dmp_api)
+    if entries is None:
+        results = []
+        for record in records:
+            try:
+                results.append((dmp_api.set_file(
+                    user_id,
+                    record['file_path'],
+                    record['file_type'],
+                    record.get('size'),
+                    record.get('parent_dir'),
+                    record['data_type'],
+                    record['taxon_id'],
+                    record.get('compressed'),
+                    record['source_id'],
+                    record['meta_data']
+                ), None))
+            except Exception as err:  # pylint: disable=broad-except
+                results.append((None, str(err)))
+        return results
+
+    # Stored as a date, as set_file does. Records read from the store are
+    # passed through format_record before they are returned.
+    creation_time = datetime.datetime.utcnow()
+    results = []
+    for chunk in _chunks(records, chunk_size):
+        docs = [{
+            'user_id': user_id,
+            'file_path': record['file_path'],
+            'file_type': record['file_type'],
+            'size': record.get('size'),
+            'parent_dir': record.get('parent_dir'),
+            'data_type': record['data_type'],
+            'taxon_id': record['taxon_id'],
+            'compressed': record.get('compressed'),
+            'source_id': record['source_id'],
+            'meta_data': record['meta_data'],
+            'creation_time': creation_time
+        } for record in chunk]
+
+        errors = {}
+        try:
+            entries.insert_many(docs, ordered=False)
+        except Exception as err:  # pylint: disable=broad-except
+            details = getattr(err, 'details', None)
+            if not details:
+                raise
+            for write_error in details.get('writeErrors', []):
+                errors[write_error['index']] = write_error.get('errmsg', 'InsertFailed')
+
+        results.extend(
+            (None, errors[i]) if i in errors else (str(doc['_id']), None)
+            for i, doc in enumerate(docs))
+    return results
+
+
+def find_file_ids(dmp_api, user_id, filters):
+    """
+    Get the ids of the files for a user that match all of the given filters
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    user_id : str
+        User identifier
+    filters : dict
+        Any of source_id, parent_dir and data_type. Files match source_id if
+        it is one of the files that they were generated from.
+
+    Returns
+    -------
+    list
+        File ids
+    """
+    query = {k: v for k, v in filters.items() if k in DELETE_FILTER_FIELDS}
+
+    store = get_bulk_store(dmp_api)
+    if store is not None:
+        return store.find_file_ids(user_id, query)
+
+    entries = get_collection(dmp_api)
+    if entries is not None:
+        query['user_id'] = user_id
+        return [str(record['_id']) for record in entries.find(query, {'_id': 1})]
+
+    def _match(record, key, value):
+        if key == 'source_id':
+            return value in (record.get('source_id') or [])
+        return record.get(key) == value
+
+    return [
+        str(record['_id']) for record in dmp_api.get_files_by_user(user_id)
+        if all(_match(record, k, v) for k, v in query.items())
+    ]
+
+
+def delete_files(dmp_api, user_id, file_ids, chunk_size=1000, dry_run=False):
+    """
+    Remove a list of files in chunks
+
+    Parameters
+    ----------
+    dmp_api : dmp
+        DM API client
+    user_id : str
+        User identifier
+    file_ids : list
+        IDs of the files to remove
+    chunk_size : int
+        Maximum number of files to remove in a single delete
+    dry_run : bool
+        If True the files are only checked for and are not removed
+
+    Returns
+    -------
+    generator
+        (file_id, status) where the status is 'deleted', 'would_delete' or
+        'not_found'
+    """
+    found_status = 'would_delete' if dry_run else 'deleted'
+    store = get_bulk_store(dmp_api)
+    entries = get_collection(dmp_api)
+
+    for chunk in _chunks(unique_ids(file_ids), chunk_size):
+        if store is not None:
+            found = store.remove_files(user_id, chunk, dry_run=dry_run)
+        elif entries is not None:
+            query = {'_id': {'$in': to_object_ids(chunk)}, 'user_id': user_id}
+            found = set(str(record['_id']) for record in entries.find(query, {'_id': 1}))
+            if found and not dry_run:
+                entries.delete_many(query)
+        else:
+            found = set(
+                f_id for f_id in chunk
+                if dmp_api.get_file_by_id(user_id, f_id) is not None
+            )
+            if not dry_run:
+                for f_id in chunk:
+                    if f_id in found:
+                        dmp_api.remove_file(user_id, f_id)
+
+        for f_id in chunk:
+            yield f_id, found_status if f_id in found else 'not_found'
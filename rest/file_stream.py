@@ -0,0 +1,223 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import calendar
+import hashlib
+import mimetypes
+import os
+import uuid
+
+from flask import Response
+from werkzeug.wsgi import wrap_file
+
+# Requests for more ranges than this are sent the whole file
+MAX_RANGES = 64
+
+CHUNK_SIZE = 64 * 1024
+
+
+def is_allowed_path(file_path, roots):
+    """
+    Check that a file is within one of the directories that files can be
+    served from
+
+    Parameters
+    ----------
+    file_path : str
+    roots : list
+        Directories that files can be served from
+
+    Returns
+    -------
+    bool
+    """
+    real_path = os.path.realpath(file_path)
+    for root in roots or []:
+        root = os.path.join(os.path.realpath(root), '')
+        if real_path.startswith(root):
+            return True
+    return False
+
+
+def file_etag(file_path, stat):
+    """
+    Strong ETag for the current contents of a file, based on its size and
+    modification time
+    """
+    key = '{}\n{}\n{}'.format(file_path, stat.st_size, repr(stat.st_mtime))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _resolve_ranges(ranges, size):
+    """
+    Convert the ranges from a Range header into (start, stop) byte offsets
+    within a file, dropping ranges that start beyond the end of the file
+    """
+    resolved = []
+    for start, stop in ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            resolved.append((start, stop))
+    return resolved
+
+
+def _read_range(handle, start, stop):
+    handle.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = handle.read(min(CHUNK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _file_body(environ, file_path, start, stop):
+    """
+    Body for a byte range of a file. The server's wsgi.file_wrapper is used
+    when there is one, as it sends from the current position of the file for
+    the Content-Length of the response. Otherwise the range is read in chunks.
+    """
+    handle = open(file_path, 'rb')
+    if 'wsgi.file_wrapper' in environ:
+        handle.seek(start)
+        return wrap_file(environ, handle, CHUNK_SIZE)
+
+    def _read():
+        try:
+            for data in _read_range(handle, start, stop):
+                yield data
+        finally:
+            handle.close()
+    return _read()
+
+
+def _multipart(file_path, parts, boundary):
+    with open(file_path, 'rb') as handle:
+        for header, start, stop in parts:
+            yield header
+            for data in _read_range(handle, start, stop):
+                yield data
+        yield '\r\n--{}--\r\n'.format(boundary).encode('ascii')
+
+
+def send_original(request, file_path):
+    """
+    Send the whole of a file, or the byte ranges given in the Range header.
+
+    The whole file and single ranges are sent through the server's
+    wsgi.file_wrapper, so that servers that support it can send the file
+    without it passing through Python. Several ranges are sent as a
+    multipart/byteranges response.
+
+    Parameters
+    ----------
+    request : flask.Request
+    file_path : str
+        Location of the file to send
+
+    Returns
+    -------
+    flask.Response
+    """
+    stat = os.stat(file_path)
+    size = stat.st_size
+    etag = file_etag(file_path, stat)
+    mimetype, encoding = mimetypes.guess_type(file_path)
+    if mimetype is None or encoding is not None:
+        mimetype = 'application/octet-stream'
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': 'attachment; filename="{}"'.format(
+            os.path.basename(file_path).replace('"', ''))
+    }
+
+    def _response(*args, **kwargs):
+        response = Response(*args, **kwargs)
+        response.headers.extend(headers)
+        response.set_etag(etag)
+        response.last_modified = int(stat.st_mtime)
+        return response
+
+    if request.if_none_match:
+        if request.if_none_match.contains(etag):
+            return _response(status=304)
+    elif request.if_modified_since is not None:
+        if int(stat.st_mtime) <= _timestamp(request.if_modified_since):
+            return _response(status=304)
+
+    ranges = None
+    if request.range is not None and request.range.units == 'bytes':
+        if_range = request.if_range
+        if (if_range.etag is None and if_range.date is None) or if_range.etag == etag or (
+                if_range.date is not None and
+                int(stat.st_mtime) <= _timestamp(if_range.date)):
+            ranges = request.range.ranges
+
+    if ranges is not None and len(ranges) <= MAX_RANGES:
+        resolved = _resolve_ranges(ranges, size)
+        if not resolved:
+            response = _response(status=416)
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+
+        if len(resolved) == 1:
+            start, stop = resolved[0]
+            response = _response(
+                _file_body(request.environ, file_path, start, stop), status=206,
+                mimetype=mimetype, direct_passthrough=True)
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+            response.headers['Content-Length'] = str(stop - start)
+            return response
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        length = 0
+        for start, stop in resolved:
+            header = (
+                '\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                    boundary, mimetype, start, stop - 1, size)
+            ).encode('ascii')
+            parts.append((header, start, stop))
+            length += len(header) + stop - start
+        length += len('\r\n--{}--\r\n'.format(boundary))
+
+        response = _response(
+            _multipart(file_path, parts, boundary), status=206,
+            content_type='multipart/byteranges; boundary=' + boundary,
+            direct_passthrough=True)
+        response.headers['Content-Length'] = str(length)
+        return response
+
+    response = _response(
+        _file_body(request.environ, file_path, 0, size), mimetype=mimetype,
+        direct_passthrough=True)
+    response.headers['Content-Length'] = str(size)
+    return response
+
+
+def _timestamp(value):
+    """
+    Seconds since the epoch for a datetime parsed from an HTTP date header
+    """
+    return calendar.timegm(value.utctimetuple())
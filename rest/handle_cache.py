@@ -0,0 +1,263 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _close(handle, closer):
+    try:
+        if closer is not None:
+            closer(handle)
+        elif callable(getattr(handle, 'close', None)):
+            handle.close()
+    except Exception:  # pylint: disable=broad-except
+        pass
+
+
+class _Entry(object):
+    """
+    An open handle along with the lock that serialises its use
+    """
+
+    def __init__(self, key, handle, closer):
+        self.key = key
+        self.handle = handle
+        self.closer = closer
+        self.lock = threading.Lock()
+        self.users = 1
+        self.opened_at = time.time()
+        self.last_used = self.opened_at
+        self.retired = False
+
+
+class HandleCache(object):
+    """
+    Bounded LRU cache of open file handles, e.g. pyBigWig or HDF5 readers.
+
+    Handles are keyed by the path, the kind of handle and the modification
+    time of the file, so that a file that is read in more than one way gets
+    a handle of the right type and a file that is replaced on disk is opened
+    again. Each handle has its
+    own lock and is only used by one thread at a time, as the readers are not
+    thread safe. When more than `max_open` handles are open the least
+    recently used idle handles are closed, and handles that have not been
+    used for `idle_timeout` seconds are closed on the next access. A handle
+    that is evicted while it is in use is closed once it is released.
+    """
+
+    def __init__(self, max_open=64, idle_timeout=300.0):
+        """
+        Parameters
+        ----------
+        max_open : int
+            Maximum number of idle handles to keep open
+        idle_timeout : float
+            Number of seconds after which an unused handle is closed
+        """
+        self.max_open = max(1, int(max_open))
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._paths = {}
+        self._last_sweep = time.time()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._reopens = 0
+
+    def _retire(self, entry, to_close):
+        """
+        Remove an entry from the cache, closing it now if it is idle or once
+        it is released otherwise. Must be called with the lock held.
+        """
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        if self._paths.get(entry.key[:2]) == entry.key:
+            del self._paths[entry.key[:2]]
+        entry.retired = True
+        if entry.users == 0:
+            to_close.append(entry)
+
+    def _evict(self, now, to_close):
+        """
+        Close idle handles that have timed out and the least recently used
+        idle handles above the limit. Must be called with the lock held.
+        """
+        if now - self._last_sweep >= min(self.idle_timeout, 1.0):
+            self._last_sweep = now
+            for entry in list(self._entries.values()):
+                if entry.users == 0 and now - entry.last_used > self.idle_timeout:
+                    self._retire(entry, to_close)
+                    self._evictions += 1
+
+        if len(self._entries) > self.max_open:
+            for entry in list(self._entries.values()):
+                if len(self._entries) <= self.max_open:
+                    break
+                if entry.users == 0:
+                    self._retire(entry, to_close)
+                    self._evictions += 1
+
+    @contextmanager
+    def open(self, path, opener, kind=None, closer=None, max_age=None):
+        """
+        Check out the handle for a file for the duration of a with block,
+        opening the file if there is no cached handle for it
+
+        Parameters
+        ----------
+        path : str
+            Location of the file, also used as the cache key for handles that
+            are not backed by a single file
+        opener : function
+            Called with the path to open a new handle
+        kind : hashable
+            Type of handle that the opener returns, e.g. 'track' or 'fasta',
+            so that a path opened by different readers has a handle for each
+        closer : function
+            Called with the handle to close it. Defaults to handle.close()
+        max_age : float
+            Reopen the handle once it has been open for this many seconds,
+            for files that can change without their mtime being visible
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           with HANDLE_CACHE.open(file_path, pyBigWig.open, 'track') as handle:
+               values = handle.values(chrom, start, end)
+        """
+        key = (path, kind, _mtime(path))
+        now = time.time()
+        to_close = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and max_age is not None and now - entry.opened_at > max_age:
+                self._retire(entry, to_close)
+                self._reopens += 1
+                entry = None
+            if entry is not None:
+                # Move to the most recently used end
+                del self._entries[key]
+                self._entries[key] = entry
+                entry.users += 1
+                self._hits += 1
+            else:
+                self._misses += 1
+
+        for stale in to_close:
+            _close(stale.handle, stale.closer)
+        to_close = []
+
+        if entry is None:
+            handle = opener(path)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    # Another thread opened the same file in the meantime
+                    entry.users += 1
+                    to_close.append(_Entry(key, handle, closer))
+                else:
+                    entry = _Entry(key, handle, closer)
+                    previous = self._entries.get(self._paths.get(key[:2]))
+                    if previous is not None:
+                        # The file has changed since it was last opened
+                        self._retire(previous, to_close)
+                        self._reopens += 1
+                    self._entries[key] = entry
+                    self._paths[key[:2]] = key
+                self._evict(now, to_close)
+
+            for stale in to_close:
+                _close(stale.handle, stale.closer)
+
+        try:
+            with entry.lock:
+                yield entry.handle
+        finally:
+            self._release(entry)
+
+    def _release(self, entry):
+        to_close = []
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.time()
+            if entry.retired and entry.users == 0:
+                to_close.append(entry)
+            else:
+                self._evict(entry.last_used, to_close)
+
+        for stale in to_close:
+            _close(stale.handle, stale.closer)
+
+    def discard(self, path):
+        """
+        Close the cached handles of every kind for a path so that they are
+        opened again on their next use
+        """
+        to_close = []
+        with self._lock:
+            for key in [key for key in self._paths.values() if key[0] == path]:
+                self._retire(self._entries[key], to_close)
+        for stale in to_close:
+            _close(stale.handle, stale.closer)
+
+    def clear(self):
+        """
+        Close all of the cached handles
+        """
+        to_close = []
+        with self._lock:
+            for entry in list(self._entries.values()):
+                self._retire(entry, to_close)
+        for stale in to_close:
+            _close(stale.handle, stale.closer)
+
+    def stats(self):
+        """
+        Usage figures for the cache
+
+        Returns
+        -------
+        dict
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'open': len(self._entries),
+                'in_use': sum(1 for entry in self._entries.values() if entry.users),
+                'max_open': self.max_open,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': float(self._hits) / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'reopens': self._reopens
+            }
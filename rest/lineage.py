@@ -0,0 +1,170 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict
+
+
+class LineageCache(object):
+    """
+    Bounded LRU cache of the source_id links for each file. Entries need to be
+    invalidated whenever the source_id of a file is changed or the file is
+    removed.
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of files to hold the links for
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._links = OrderedDict()
+        self._users = {}
+
+    def get(self, user_id, file_id):
+        """
+        Returns
+        -------
+        tuple
+            The source_ids for the file, or None if they are not cached
+        """
+        key = (user_id, file_id)
+        with self._lock:
+            sources = self._links.pop(key, None)
+            if sources is not None:
+                self._links[key] = sources
+            return sources
+
+    def put(self, user_id, file_id, source_ids):
+        """
+        Cache the source_ids for a file
+        """
+        if not isinstance(source_ids, (list, tuple)):
+            source_ids = [source_ids] if source_ids else []
+
+        key = (user_id, file_id)
+        with self._lock:
+            self._links.pop(key, None)
+            self._links[key] = tuple(source_ids)
+            self._users.setdefault(user_id, set()).add(file_id)
+            while len(self._links) > self.max_size:
+                self._forget(self._links.popitem(last=False)[0])
+
+    def _forget(self, key):
+        file_ids = self._users.get(key[0])
+        if file_ids is not None:
+            file_ids.discard(key[1])
+            if not file_ids:
+                del self._users[key[0]]
+
+    def invalidate(self, user_id, file_id):
+        """
+        Remove the cached links for a file
+        """
+        with self._lock:
+            self._links.pop((user_id, file_id), None)
+            self._forget((user_id, file_id))
+
+    def invalidate_users(self, stale):
+        """
+        Remove the cached links for the users selected by a function
+
+        Parameters
+        ----------
+        stale : function
+            Called with each user id, returns True if the links for the user
+            are to be removed
+        """
+        with self._lock:
+            for user_id in [u for u in self._users if stale(u)]:
+                for file_id in self._users.pop(user_id):
+                    self._links.pop((user_id, file_id), None)
+
+    def clear(self):
+        """
+        Remove all cached links
+        """
+        with self._lock:
+            self._links.clear()
+            self._users.clear()
+
+
+def get_lineage(user_id, file_id, lookup, cache, depth=None):
+    """
+    Breadth first traversal of the files that were used to generate a file.
+
+    Each level of the traversal is resolved with a single call to `lookup`
+    for the files whose links are not already cached. The records for any
+    remaining files are then fetched in one final call.
+
+    Parameters
+    ----------
+    user_id : str
+        User identifier
+    file_id : str
+        File to start from
+    lookup : function
+        Called with a list of file ids, returning the matching file records
+    cache : LineageCache
+        Cache of source_id links
+    depth : int
+        Maximum number of generations to follow. None follows every
+        generation.
+
+    Returns
+    -------
+    tuple
+        (nodes, edges) where nodes is the list of file records within the
+        lineage in the order they were reached, starting with the requested
+        file, and edges is the list of {'file_id', 'source_id'} links
+        between them
+    """
+    records = {}
+    visited = set([file_id])
+    order = [file_id]
+    level = [file_id]
+    edges = []
+    generation = 0
+
+    while level and (depth is None or generation < depth):
+        uncached = [f_id for f_id in level if cache.get(user_id, f_id) is None]
+        for record in lookup(uncached) if uncached else []:
+            records[record['_id']] = record
+            cache.put(user_id, record['_id'], record.get('source_id'))
+
+        next_level = []
+        for f_id in level:
+            for source_id in cache.get(user_id, f_id) or ():
+                edges.append({'file_id': f_id, 'source_id': source_id})
+                if source_id not in visited:
+                    visited.add(source_id)
+                    order.append(source_id)
+                    next_level.append(source_id)
+        level = next_level
+        generation += 1
+
+    missing = [f_id for f_id in order if f_id not in records]
+    for record in lookup(missing) if missing else []:
+        records[record['_id']] = record
+
+    nodes = [records[f_id] for f_id in order if f_id in records]
+    return nodes, edges
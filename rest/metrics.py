@@ -0,0 +1,378 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import inspect
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class _Token(object):
+    """
+    Stored alongside a thread's values so that the end of the thread can be
+    detected with a weak reference
+    """
+    __slots__ = ('__weakref__',)
+
+
+class _Shards(object):
+    """
+    Per-thread lists of values that are summed when they are read. Each
+    thread only ever writes to its own list, so updates do not need a lock.
+
+    The values of threads that have finished are folded into a single list,
+    so short lived threads do not leave a list behind.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._base = [0] * size
+        self._shards = {}
+        self._dead = []
+
+    def get(self):
+        """
+        Get the list of values for the current thread
+        """
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = [0] * self._size
+            token = _Token()
+            with self._lock:
+                self._fold()
+                # The callback only queues the reference, as it can run in
+                # any thread, including one that is holding the lock
+                self._shards[weakref.ref(token, self._dead.append)] = shard
+            self._local.token = token
+            self._local.shard = shard
+        return shard
+
+    def _fold(self):
+        """
+        Add the values of the threads that have finished to the base values.
+        Must be called with the lock held.
+        """
+        while self._dead:
+            shard = self._shards.pop(self._dead.pop(), None)
+            if shard is not None:
+                self._base = [a + b for a, b in zip(self._base, shard)]
+
+    def total(self):
+        """
+        Sum of the values across all threads
+        """
+        with self._lock:
+            self._fold()
+            shards = list(self._shards.values()) + [self._base]
+        return [sum(values) for values in zip(*shards)]
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs
+    ) + '}'
+
+
+class _Metric(object):
+    def __init__(self, name, description, label_names, size):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._size = size
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _shard(self, label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(label_values, _Shards(self._size))
+        return series.get()
+
+    def _totals(self):
+        with self._lock:
+            series = list(self._series.items())
+        return sorted((labels, shards.total()) for labels, shards in series)
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count for each set of label values
+    """
+
+    def __init__(self, name, description, label_names=()):
+        super(Counter, self).__init__(name, description, label_names, 1)
+
+    def inc(self, *label_values):
+        """
+        Increment the count for the label values by one
+        """
+        self._shard(label_values)[0] += 1
+
+    def render(self):
+        """
+        Prometheus text format lines for the counter
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} counter'.format(self.name)
+        ]
+        for labels, (value,) in self._totals():
+            lines.append('{}{} {}'.format(
+                self.name, _format_labels(self.label_names, labels), value))
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values for each set of label values
+    """
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # One slot per bucket, one for values above the last bucket and one
+        # for the sum of the values
+        super(Histogram, self).__init__(
+            name, description, label_names, len(self.buckets) + 2)
+
+    def observe(self, value, *label_values):
+        """
+        Record a value for the label values
+        """
+        shard = self._shard(label_values)
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Observe the time taken to run a with block
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *label_values)
+
+    def render(self):
+        """
+        Prometheus text format lines for the histogram
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} histogram'.format(self.name)
+        ]
+        for labels, totals in self._totals():
+            cumulative = 0
+            bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, totals[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.label_names, labels, [('le', bound)]),
+                    cumulative))
+            label_str = _format_labels(self.label_names, labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_str, totals[-1]))
+            lines.append('{}_count{} {}'.format(self.name, label_str, cumulative))
+        return lines
+
+
+class _TimedProxy(object):
+    """
+    Proxy that times every method call made on the wrapped object
+    """
+
+    def __init__(self, target, histogram, backend):
+        self._target = target
+        self._histogram = histogram
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        histogram = self._histogram
+        backend = self._backend
+
+        @wraps(attr)
+        def _timed(*args, **kwargs):
+            with histogram.time(backend, name):
+                return attr(*args, **kwargs)
+        return _timed
+
+
+class MetricsRegistry(object):
+    """
+    Request and backend call metrics for the service.
+
+    Each process keeps its own metrics, so when the service runs as several
+    worker processes every worker needs to be scraped separately.
+    """
+
+    def __init__(self, app=None, resource_names=None):
+        """
+        Parameters
+        ----------
+        app : Flask
+        resource_names : function
+            Called with the endpoint name to get the resource to report the
+            request against. Defaults to the endpoint name.
+        """
+        self.requests = Counter(
+            'dmp_http_requests_total',
+            'Number of HTTP requests by resource, method and status code',
+            ('resource', 'method', 'status'))
+        self.request_duration = Histogram(
+            'dmp_http_request_duration_seconds',
+            'Time taken to handle HTTP requests by resource and method',
+            ('resource', 'method'))
+        self.backend_duration = Histogram(
+            'dmp_backend_call_duration_seconds',
+            'Time taken by calls to the DM API, auth server and indexes',
+            ('backend', 'call'))
+        self._gauges = []
+        self._resource_names = resource_names or (lambda endpoint: endpoint)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Register the request timing hooks
+        """
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        from flask import g
+        g.metrics_start = time.time()
+
+    def _after_request(self, response):
+        from flask import g, request
+        start = getattr(g, 'metrics_start', None)
+        if start is not None:
+            resource = self._resource_names(request.endpoint)
+            self.request_duration.observe(time.time() - start, resource, request.method)
+            self.requests.inc(resource, request.method, str(response.status_code))
+        return response
+
+    def timer(self, backend, call):
+        """
+        Context manager that times a backend call
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           with METRICS.timer('region_index', 'query'):
+               file_ids = REGION_INDEX.query(...)
+        """
+        return self.backend_duration.time(backend, call)
+
+    def timed(self, backend, call):
+        """
+        Decorator that times calls to a function. For generator functions the
+        time until the generator is exhausted or closed is recorded.
+        """
+        def _decorator(func):
+            if inspect.isgeneratorfunction(func):
+                @wraps(func)
+                def _timed_generator(*args, **kwargs):
+                    with self.timer(backend, call):
+                        for item in func(*args, **kwargs):
+                            yield item
+                return _timed_generator
+
+            @wraps(func)
+            def _timed(*args, **kwargs):
+                with self.timer(backend, call):
+                    return func(*args, **kwargs)
+            return _timed
+        return _decorator
+
+    def instrument(self, target, backend):
+        """
+        Wrap an object so that all of its method calls are timed
+        """
+        return _TimedProxy(target, self.backend_duration, backend)
+
+    def add_gauges(self, name, description, label_name, collect):
+        """
+        Report the values from a stats() function as gauges
+
+        Parameters
+        ----------
+        name : str
+            Prefix for the gauge names
+        description : str
+        label_name : str
+            Name of the label for the keys of the stats dict, or None if the
+            stats are not nested
+        collect : function
+            Returns a dict of numeric values, or a dict of such dicts
+        """
+        self._gauges.append((name, description, label_name, collect))
+
+    def _render_gauges(self):
+        lines = []
+        for name, description, label_name, collect in self._gauges:
+            stats = collect()
+            series = stats.items() if label_name is not None else [(None, stats)]
+            values = {}
+            for label, group in series:
+                for key, value in group.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        values.setdefault(key, []).append((label, value))
+            for key in sorted(values):
+                gauge = '{}_{}'.format(name, key)
+                lines.append('# HELP {} {} ({})'.format(gauge, description, key))
+                lines.append('# TYPE {} gauge'.format(gauge))
+                for label, value in values[key]:
+                    label_str = _format_labels(
+                        (label_name,), (label,)) if label_name is not None else ''
+                    lines.append('{}{} {}'.format(gauge, label_str, value))
+        return lines
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+
+        Returns
+        -------
+        str
+        """
+        lines = (self.requests.render() + self.request_duration.render() +
+                 self.backend_duration.render() + self._render_gauges())
+        return '\n'.join(lines) + '\n'
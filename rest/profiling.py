@@ -0,0 +1,257 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+
+PROFILE_MODES = {
+    '1': ('cprofile', 'sample'),
+    'all': ('cprofile', 'sample'),
+    'cprofile': ('cprofile',),
+    'sample': ('sample',),
+}
+
+PROFILE_EXTENSIONS = ('.pstats', '.collapsed')
+
+
+class StackSampler(object):
+    """
+    Samples the stack of a single thread at a fixed interval and counts how
+    often each stack is seen. The counts are written out in the collapsed
+    stack format used by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        """
+        Parameters
+        ----------
+        thread_id : int
+            Identifier of the thread to sample, from threading.current_thread()
+        interval : float
+            Number of seconds between samples
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        """
+        Start sampling in a background thread
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and wait for the background thread to finish
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def dump(self, path):
+        """
+        Write the sampled stacks in the collapsed stack format
+        """
+        with open(path, 'w') as handle:
+            for stack, count in sorted(self.stacks.items()):
+                handle.write('{} {}\n'.format(stack, count))
+
+
+def rotate(directory, max_files, max_bytes):
+    """
+    Remove the oldest profiles from a directory until there are no more than
+    `max_files` of them taking up no more than `max_bytes`
+    """
+    profiles = []
+    for name in os.listdir(directory):
+        if name.endswith(PROFILE_EXTENSIONS):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            profiles.append((stat.st_mtime, name, stat.st_size, path))
+
+    profiles.sort()
+    total = sum(p[2] for p in profiles)
+    while profiles and (len(profiles) > max_files or total > max_bytes):
+        _, _, size, path = profiles.pop(0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+class _ProfiledResponse(object):
+    """
+    Response iterable that keeps the profile running until the response has
+    been sent
+    """
+
+    def __init__(self, result, finish):
+        self._result = result
+        self._finish = finish
+
+    def __iter__(self):
+        for chunk in self._result:
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self._result, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._finish()
+
+
+class RequestProfiler(object):
+    """
+    WSGI middleware that profiles single requests on demand.
+
+    A request is profiled when PROFILE_ENABLED is set, PROFILE_DIR names a
+    directory, the client address is in PROFILE_ALLOW and the request has an
+    `X-Profile` header or a `profile` query parameter. The value selects the
+    profilers that are run:
+
+    ========  ==================================================
+    cprofile  Deterministic profile written as a .pstats file
+    sample    Sampled stacks written as a .collapsed file
+    1 | all   Both
+    ========  ==================================================
+
+    Only one request is profiled at a time, other requests are served
+    without a profile. The name of the profile is returned in the
+    `X-Profile-Id` header of the response.
+    """
+
+    def __init__(self, wsgi_app, config):
+        """
+        Parameters
+        ----------
+        wsgi_app : function
+            WSGI application to profile
+        config : dict
+            Application config, read on each request so that profiling can be
+            switched on and off while the service is running
+        """
+        self.wsgi_app = wsgi_app
+        self.config = config
+        self._lock = threading.Lock()
+
+    def _modes(self, environ):
+        config = self.config
+        if not config.get('PROFILE_ENABLED') or not config.get('PROFILE_DIR'):
+            return None
+
+        value = environ.get('HTTP_X_PROFILE')
+        if value is None:
+            value = parse_qs(environ.get('QUERY_STRING', '')).get('profile', [None])[0]
+        if value is None or value.lower() not in PROFILE_MODES:
+            return None
+
+        if environ.get('REMOTE_ADDR') not in config.get('PROFILE_ALLOW', ()):
+            return None
+
+        return PROFILE_MODES[value.lower()]
+
+    def __call__(self, environ, start_response):
+        modes = self._modes(environ)
+        if modes is None or not self._lock.acquire(False):
+            return self.wsgi_app(environ, start_response)
+
+        config = self.config
+        directory = config['PROFILE_DIR']
+        name = '{}-{}-{}{}'.format(
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(), threading.current_thread().ident,
+            re.sub(r'[^A-Za-z0-9]+', '_', environ.get('PATH_INFO', '')))
+
+        profiler = cProfile.Profile() if 'cprofile' in modes else None
+        sampler = StackSampler(
+            threading.current_thread().ident,
+            config.get('PROFILE_SAMPLE_INTERVAL', 0.005)) if 'sample' in modes else None
+
+        def _start_response(status, headers, exc_info=None):
+            return start_response(status, list(headers) + [('X-Profile-Id', name)], exc_info)
+
+        def _finish():
+            try:
+                if profiler is not None:
+                    profiler.disable()
+                if sampler is not None:
+                    sampler.stop()
+
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if profiler is not None:
+                    profiler.dump_stats(os.path.join(directory, name + '.pstats'))
+                if sampler is not None:
+                    sampler.dump(os.path.join(directory, name + '.collapsed'))
+                rotate(directory, config.get('PROFILE_MAX_FILES', 50),
+                       config.get('PROFILE_MAX_BYTES', 100 * 1024 * 1024))
+            finally:
+                self._lock.release()
+
+        if sampler is not None:
+            sampler.start()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiling tool is already active in this process
+                profiler = None
+
+        try:
+            result = self.wsgi_app(environ, _start_response)
+        except Exception:
+            _finish()
+            raise
+
+        return _ProfiledResponse(result, _finish)
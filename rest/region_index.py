@@ -0,0 +1,852 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# Meta data keys that determine where a file is within the index
+INTERVAL_KEYS = ('assembly', 'chrom', 'start', 'end', 'regions')
+
+# Maximum number of candidate intervals compared in one pass of a batch query,
+# which bounds the size of the temporary arrays
+BATCH_CANDIDATES = 1 << 22
+
+# File within a snapshot recording the user, assembly and chromosomes that it
+# holds, as the directory names are sanitised
+MANIFEST = 'manifest.json'
+
+LOGGER = logging.getLogger(__name__)
+
+
+def record_intervals(meta_data):
+    """
+    Get the genomic intervals that a file covers from its meta data.
+
+    Intervals can either be given as a list of [chrom, start, end] in the
+    `regions` key or as a single interval using the `chrom`, `start` and `end`
+    keys.
+
+    Parameters
+    ----------
+    meta_data : dict
+        Meta data for the file
+
+    Returns
+    -------
+    list
+        List of (chrom, start, end) tuples
+    """
+    if not meta_data:
+        return []
+
+    if 'regions' in meta_data:
+        return [(str(r[0]), int(r[1]), int(r[2])) for r in meta_data['regions']]
+
+    if all(k in meta_data for k in ('chrom', 'start', 'end')):
+        return [(str(meta_data['chrom']), int(meta_data['start']), int(meta_data['end']))]
+
+    return []
+
+
+def _region(chrom, start, end, name, error):
+    try:
+        start, end = int(start), int(end)
+    except (TypeError, ValueError):
+        raise ValueError(error)
+    if start < 0 or end < start:
+        raise ValueError(error)
+    return str(chrom), start, end, name
+
+
+def parse_regions(regions):
+    """
+    Parse a list of query regions, each either a chrom:start:end string or a
+    [chrom, start, end] list with an optional name
+
+    Returns
+    -------
+    list
+        List of (chrom, start, end, name) tuples
+
+    Raises
+    ------
+    ValueError
+        If one of the regions is not valid
+    """
+    parsed = []
+    for number, region in enumerate(regions):
+        error = 'Invalid region {}'.format(number)
+        if isinstance(region, list):
+            if not 3 <= len(region) <= 4:
+                raise ValueError(error)
+            parsed.append(_region(region[0], region[1], region[2],
+                                  region[3] if len(region) > 3 else None, error))
+        else:
+            fields = str(region).split(':')
+            if len(fields) != 3:
+                raise ValueError(error)
+            parsed.append(_region(fields[0], fields[1], fields[2], None, error))
+    return parsed
+
+
+def parse_bed(lines):
+    """
+    Parse the regions from the lines of a BED file. Header, comment and blank
+    lines are skipped and the name is taken from the fourth column.
+
+    Returns
+    -------
+    list
+        List of (chrom, start, end, name) tuples
+
+    Raises
+    ------
+    ValueError
+        If one of the lines is not valid
+    """
+    parsed = []
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line or line.startswith(('#', 'track', 'browser')):
+            continue
+        fields = line.split('\t') if '\t' in line else line.split()
+        if len(fields) < 3:
+            raise ValueError('Invalid BED line {}'.format(number))
+        parsed.append(_region(
+            fields[0], fields[1], fields[2], fields[3] if len(fields) > 3 else None,
+            'Invalid BED line {}'.format(number)))
+    return parsed
+
+
+def covered_bases(groups, starts, ends, start, end):
+    """
+    Count the bases of a region covered by each group of intervals, counting
+    overlapping intervals within a group once
+
+    Parameters
+    ----------
+    groups : numpy.ndarray
+        Group number of each interval, from 0
+    starts : numpy.ndarray
+    ends : numpy.ndarray
+    start : int
+    end : int
+        Region the intervals are clipped to
+
+    Returns
+    -------
+    numpy.ndarray
+        Number of bases covered for each group
+    """
+    size = int(groups.max()) + 1 if len(groups) else 0
+    if size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    starts = np.clip(np.asarray(starts, dtype=np.int64), start, end) - start
+    ends = np.clip(np.asarray(ends, dtype=np.int64), start, end) - start
+    order = np.lexsort((starts, groups))
+    groups, starts, ends = groups[order], starts[order], ends[order]
+
+    # Running maximum of the ends within each group. Offsetting each group
+    # beyond the range of the previous one lets a single accumulate be used.
+    width = end - start + 1
+    reach = np.maximum.accumulate(groups * width + ends)
+    previous = np.empty_like(reach)
+    previous[0] = -1
+    previous[1:] = reach[:-1]
+    previous = np.maximum(previous - groups * width, 0)
+
+    added = np.maximum(ends - np.maximum(starts, previous), 0)
+    return np.bincount(groups, weights=added, minlength=size).astype(np.int64)
+
+
+def _safe_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(name))
+
+
+class ChromIntervals(object):
+    """
+    Intervals for a single chromosome held as NumPy arrays sorted by start.
+
+    Instances are immutable so that queries can run against them without
+    holding a lock. Updates create a new instance.
+    """
+
+    def __init__(self, starts, ends, file_ids):
+        self.starts = starts
+        self.ends = ends
+        self.file_ids = file_ids
+        self.max_len = int((ends - starts).max()) if len(starts) else 0
+
+    @classmethod
+    def build(cls, starts, ends, file_ids):
+        """
+        Create a sorted set of intervals from unsorted arrays
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        file_ids = np.asarray(file_ids, dtype=np.str_)
+        order = np.argsort(starts, kind='mergesort')
+        return cls(starts[order], ends[order], file_ids[order])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlap_slice(self, start, end):
+        """
+        Get the positions of intervals overlapping start-end (inclusive).
+
+        As no interval is longer than `max_len` only the intervals starting
+        between `start - max_len` and `end` need to be checked.
+
+        Returns
+        -------
+        numpy.ndarray
+            Positions within the sorted arrays
+        """
+        low = np.searchsorted(self.starts, start - self.max_len, side='left')
+        high = np.searchsorted(self.starts, end, side='right')
+        hits = np.nonzero(self.ends[low:high] >= start)[0]
+        return hits + low
+
+    def overlap_many(self, starts, ends):
+        """
+        Get the intervals overlapping each of a set of regions (inclusive).
+
+        The regions must be sorted by start so that the candidate ranges found
+        with searchsorted advance through the intervals together with the
+        regions, as in a merge join. Candidates are checked in blocks of at
+        most BATCH_CANDIDATES.
+
+        Parameters
+        ----------
+        starts : numpy.ndarray
+        ends : numpy.ndarray
+
+        Returns
+        -------
+        tuple
+            (regions, positions) arrays with a pair for each overlap, ordered
+            by region and then by the position within the sorted arrays
+        """
+        low = np.searchsorted(self.starts, starts - self.max_len, side='left')
+        high = np.searchsorted(self.starts, ends, side='right')
+        counts = high - low
+        totals = np.cumsum(counts)
+
+        found_regions = []
+        found_positions = []
+        first = 0
+        while first < len(starts):
+            done = totals[first - 1] if first else 0
+            last = max(int(np.searchsorted(totals, done + BATCH_CANDIDATES, side='right')),
+                       first + 1)
+            block = counts[first:last]
+            regions = np.repeat(np.arange(first, last), block)
+            # Offset of each candidate from the first candidate of its region
+            offsets = np.arange(int(block.sum())) - np.repeat(np.cumsum(block) - block, block)
+            positions = np.repeat(low[first:last], block) + offsets
+            keep = self.ends[positions] >= starts[regions]
+            found_regions.append(regions[keep])
+            found_positions.append(positions[keep])
+            first = last
+
+        if not found_regions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(found_regions), np.concatenate(found_positions)
+
+    def add(self, starts, ends, file_ids):
+        """
+        Returns
+        -------
+        ChromIntervals
+            New instance with the extra intervals
+        """
+        return ChromIntervals.build(
+            np.concatenate([self.starts, np.asarray(starts, dtype=np.int64)]),
+            np.concatenate([self.ends, np.asarray(ends, dtype=np.int64)]),
+            np.concatenate([self.file_ids, np.asarray(file_ids, dtype=np.str_)])
+        )
+
+    def remove(self, file_ids):
+        """
+        Returns
+        -------
+        ChromIntervals
+            New instance without the intervals for the file ids, or the same
+            instance if there were none
+        """
+        keep = ~np.isin(self.file_ids, np.asarray(list(file_ids), dtype=np.str_))
+        if keep.all():
+            return self
+        return ChromIntervals(self.starts[keep], self.ends[keep], self.file_ids[keep])
+
+
+class AssemblyIndex(object):
+    """
+    Interval index for all files of a user on a given assembly
+    """
+
+    def __init__(self, chroms=None):
+        self.chroms = chroms or {}
+        self.dirty = False
+
+    def __len__(self):
+        return sum(len(c) for c in self.chroms.values())
+
+    def file_ids(self):
+        """
+        Set of all file ids within the index
+        """
+        ids = set()
+        for intervals in self.chroms.values():
+            ids.update(intervals.file_ids.tolist())
+        return ids
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build an index from a list of DM API file records
+        """
+        grouped = {}
+        for record in records:
+            for chrom, start, end in record_intervals(record.get('meta_data')):
+                starts, ends, ids = grouped.setdefault(chrom, ([], [], []))
+                starts.append(start)
+                ends.append(end)
+                ids.append(str(record['_id']))
+
+        return cls({
+            chrom: ChromIntervals.build(*arrays) for chrom, arrays in grouped.items()
+        })
+
+    def add(self, file_id, intervals):
+        """
+        Add the intervals for a file
+        """
+        grouped = {}
+        for chrom, start, end in intervals:
+            starts, ends = grouped.setdefault(chrom, ([], []))
+            starts.append(start)
+            ends.append(end)
+
+        chroms = dict(self.chroms)
+        for chrom, (starts, ends) in grouped.items():
+            ids = [file_id] * len(starts)
+            if chrom in chroms:
+                chroms[chrom] = chroms[chrom].add(starts, ends, ids)
+            else:
+                chroms[chrom] = ChromIntervals.build(starts, ends, ids)
+        self.chroms = chroms
+        self.dirty = True
+
+    def remove(self, file_ids):
+        """
+        Remove all intervals for a list of files
+
+        Returns
+        -------
+        bool
+            True if any intervals were removed
+        """
+        chroms = {}
+        changed = False
+        for chrom, intervals in self.chroms.items():
+            updated = intervals.remove(file_ids)
+            changed = changed or updated is not intervals
+            if len(updated):
+                chroms[chrom] = updated
+        if changed:
+            self.chroms = chroms
+            self.dirty = True
+        return changed
+
+    def query(self, chrom, start, end):
+        """
+        Get the ids of files with intervals overlapping a region
+
+        Returns
+        -------
+        list
+            File ids ordered by the start of their first overlapping interval
+        """
+        intervals = self.chroms.get(str(chrom))
+        if intervals is None:
+            return []
+        hits = intervals.file_ids[intervals.overlap_slice(start, end)]
+        _, first = np.unique(hits, return_index=True)
+        return hits[np.sort(first)].tolist()
+
+    def overlap_stats(self, chrom, start, end):
+        """
+        Get the number of intervals and bases of a region covered by each
+        file with intervals overlapping the region
+
+        Returns
+        -------
+        dict
+            file_id: {'features': int, 'bases_covered': int}
+        """
+        intervals = self.chroms.get(str(chrom))
+        if intervals is None:
+            return {}
+        positions = intervals.overlap_slice(start, end)
+        names, groups = np.unique(intervals.file_ids[positions], return_inverse=True)
+        features = np.bincount(groups, minlength=len(names))
+        bases = covered_bases(
+            groups, intervals.starts[positions], intervals.ends[positions], start, end)
+        return {
+            name: {'features': int(count), 'bases_covered': int(covered)}
+            for name, count, covered in zip(names.tolist(), features, bases)
+        }
+
+    def query_many(self, regions):
+        """
+        Get the ids of files with intervals overlapping each of a list of
+        regions. The regions on each chromosome are sorted and matched against
+        the intervals in a single pass.
+
+        Parameters
+        ----------
+        regions : list
+            List of (chrom, start, end) tuples
+
+        Returns
+        -------
+        list
+            List of file ids for each region, in the same order as `query`
+        """
+        results = [[] for _ in regions]
+        by_chrom = {}
+        for position, region in enumerate(regions):
+            by_chrom.setdefault(str(region[0]), []).append(position)
+
+        for chrom, positions in by_chrom.items():
+            intervals = self.chroms.get(chrom)
+            if intervals is None or not len(intervals):
+                continue
+            starts = np.array([regions[p][1] for p in positions], dtype=np.int64)
+            ends = np.array([regions[p][2] for p in positions], dtype=np.int64)
+            order = np.argsort(starts, kind='mergesort')
+            matched, hits = intervals.overlap_many(starts[order], ends[order])
+
+            # Keep the first hit on each file for each region
+            names, codes = np.unique(intervals.file_ids[hits], return_inverse=True)
+            _, first = np.unique(matched * max(len(names), 1) + codes, return_index=True)
+            first.sort()
+            matched = matched[first]
+            codes = codes[first].tolist()
+            names = names.tolist()
+
+            bounds = np.searchsorted(matched, np.arange(len(order) + 1)).tolist()
+            for rank, position in enumerate(order.tolist()):
+                results[positions[position]] = [
+                    names[c] for c in codes[bounds[rank]:bounds[rank + 1]]]
+        return results
+
+    def save(self, path, key):
+        """
+        Write the index as a set of .npy files that can be memory mapped
+
+        The files are written to a new temporary directory next to `path`,
+        so that processes saving the same index at once do not write over
+        each other, which then replaces the previous snapshot.
+
+        Parameters
+        ----------
+        path : str
+        key : tuple
+            (user_id, assembly) recorded in the manifest
+        """
+        parent, name = os.path.split(path)
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+
+        tmp_path = tempfile.mkdtemp(prefix='.' + name + '.', suffix='.tmp', dir=parent)
+        try:
+            chroms = {}
+            for chrom, intervals in self.chroms.items():
+                chrom_name = _safe_name(chrom)
+                chroms[chrom_name] = chrom
+                np.save(os.path.join(tmp_path, chrom_name + '.starts.npy'), intervals.starts)
+                np.save(os.path.join(tmp_path, chrom_name + '.ends.npy'), intervals.ends)
+                np.save(os.path.join(tmp_path, chrom_name + '.ids.npy'), intervals.file_ids)
+            with open(os.path.join(tmp_path, MANIFEST), 'w') as f_out:
+                json.dump({'user_id': key[0], 'assembly': key[1], 'chroms': chroms}, f_out)
+
+            if os.path.isdir(path):
+                # Move the old snapshot out of the way, as a directory can
+                # only be renamed over an empty one
+                old_path = tempfile.mkdtemp(prefix='.' + name + '.', suffix='.old', dir=parent)
+                os.rename(path, os.path.join(old_path, name))
+                shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self.dirty = False
+
+    @staticmethod
+    def read_key(path):
+        """
+        Get the user and assembly of a saved index
+
+        Returns
+        -------
+        tuple
+            (user_id, assembly), or None if there is no readable snapshot
+        """
+        try:
+            with open(os.path.join(path, MANIFEST)) as f_in:
+                manifest = json.load(f_in)
+            return manifest['user_id'], manifest['assembly']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved index with the arrays memory mapped
+        """
+        with open(os.path.join(path, MANIFEST)) as f_in:
+            manifest = json.load(f_in)
+
+        chroms = {}
+        for name, chrom in manifest['chroms'].items():
+            chroms[chrom] = ChromIntervals(
+                np.load(os.path.join(path, name + '.starts.npy'), mmap_mode='r'),
+                np.load(os.path.join(path, name + '.ends.npy'), mmap_mode='r'),
+                np.load(os.path.join(path, name + '.ids.npy'), mmap_mode='r')
+            )
+        return cls(chroms)
+
+
+class RegionIndex(object):
+    """
+    Resident interval indexes for region queries keyed by user and assembly.
+
+    Each index is loaded once, either from a snapshot in `snapshot_dir` or
+    from the DM API, and is then kept up to date as files are added and
+    removed. Dirty indexes are not written while a request is being served
+    but by save_pending() once it has finished, at most once every
+    `save_interval` seconds, and when the index is flushed.
+    """
+
+    def __init__(self, snapshot_dir=None, save_interval=60.0):
+        """
+        Parameters
+        ----------
+        snapshot_dir : str
+            Directory for the memory mapped snapshots. If None the indexes are
+            only held in memory.
+        save_interval : float
+            Minimum number of seconds between writes of a snapshot
+        """
+        self.snapshot_dir = snapshot_dir
+        self.save_interval = save_interval
+        self._lock = threading.RLock()
+        self._indexes = {}
+        self._last_save = {}
+        # Indexes whose snapshots may be out of date and which are to be
+        # rebuilt from the DM API
+        self._rebuild = set()
+
+    def _snapshot_path(self, user_id, assembly):
+        if self.snapshot_dir is None:
+            return None
+        return os.path.join(self.snapshot_dir, _safe_name(user_id), _safe_name(assembly))
+
+    def _snapshot_keys(self, user_id=None):
+        """
+        Get the user and assembly of each snapshot, optionally only for one
+        user, from their manifests
+        """
+        if self.snapshot_dir is None or not os.path.isdir(self.snapshot_dir):
+            return []
+        if user_id is not None:
+            user_dirs = [_safe_name(user_id)]
+        else:
+            user_dirs = os.listdir(self.snapshot_dir)
+
+        keys = []
+        for user_dir in user_dirs:
+            user_dir = os.path.join(self.snapshot_dir, user_dir)
+            if not os.path.isdir(user_dir):
+                continue
+            for name in os.listdir(user_dir):
+                # Snapshots that are being written start with a '.'
+                if name.startswith('.'):
+                    continue
+                key = AssemblyIndex.read_key(os.path.join(user_dir, name))
+                if key is not None and (user_id is None or key[0] == user_id):
+                    keys.append(key)
+        return keys
+
+    def _get(self, user_id, assembly, loader=None):
+        """
+        Get the index for a user and assembly, loading it from the snapshot or
+        the loader if it is not already resident.
+        """
+        key = (user_id, assembly)
+        index = self._indexes.get(key)
+        if index is not None:
+            return index
+
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                return index
+
+            path = self._snapshot_path(user_id, assembly)
+            # Different users or assemblies can have the same sanitised
+            # name, so the snapshot is only used if it is for this key
+            if (key not in self._rebuild and path is not None and
+                    AssemblyIndex.read_key(path) == key):
+                index = AssemblyIndex.load(path)
+            elif loader is not None:
+                index = AssemblyIndex.from_records(loader())
+                index.dirty = True
+                self._last_save.pop(key, None)
+                # The new snapshot replaces the old one once it is saved
+                self._rebuild.discard(key)
+            else:
+                return None
+
+            self._indexes[key] = index
+            return index
+
+    def _save(self, key, index, force=False):
+        """
+        Write an index to its snapshot. Errors are logged rather than raised,
+        as the snapshot is only a cache of the DM API.
+        """
+        path = self._snapshot_path(*key)
+        if path is None or not index.dirty:
+            return
+        now = time.time()
+        if (not force and key in self._last_save and
+                now - self._last_save[key] < self.save_interval):
+            return
+        self._last_save[key] = now
+        try:
+            index.save(path, key)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Unable to save the region index snapshot for %s', key)
+
+    def save_pending(self):
+        """
+        Write the dirty indexes that were built or changed since they were
+        last written, or that have not been written for `save_interval`
+        seconds. Called once a request has finished so that its response is
+        not held up by the write.
+        """
+        if self.snapshot_dir is None:
+            return
+        with self._lock:
+            for key, index in list(self._indexes.items()):
+                self._save(key, index)
+
+    def query(self, user_id, assembly, chrom, start, end, loader=None):
+        """
+        Get the ids of the files that overlap a region
+
+        Parameters
+        ----------
+        user_id : str
+            User identifier
+        assembly : str
+            Genome assembly
+        chrom : str
+        start : int
+        end : int
+        loader : function
+            Returns the DM API records for the user and assembly. Only called
+            if the index is not resident and there is no snapshot.
+
+        Returns
+        -------
+        list
+            File ids, or None if there are no indexed intervals for the
+            assembly
+        """
+        index = self._get(user_id, assembly, loader)
+        if index is None or not index.chroms:
+            return None
+        return index.query(chrom, int(start), int(end))
+
+    def query_many(self, user_id, assembly, regions, loader=None):
+        """
+        Get the ids of the files that overlap each of a list of regions
+
+        Parameters
+        ----------
+        user_id : str
+            User identifier
+        assembly : str
+            Genome assembly
+        regions : list
+            List of (chrom, start, end) tuples
+        loader : function
+            Returns the DM API records for the user and assembly
+
+        Returns
+        -------
+        list
+            List of file ids for each region, or None if there are no indexed
+            intervals for the assembly
+        """
+        index = self._get(user_id, assembly, loader)
+        if index is None or not index.chroms:
+            return None
+        return index.query_many(regions)
+
+    def overlap_stats(self, user_id, assembly, chrom, start, end, loader=None):
+        """
+        Get the number of intervals and bases of a region covered by each of
+        the files that overlap it
+
+        Returns
+        -------
+        dict
+            file_id: {'features': int, 'bases_covered': int}, or None if
+            there are no indexed intervals for the assembly
+        """
+        index = self._get(user_id, assembly, loader)
+        if index is None or not index.chroms:
+            return None
+        return index.overlap_stats(chrom, int(start), int(end))
+
+    def add_file(self, user_id, file_id, meta_data):
+        """
+        Add a newly registered file to the index for its assembly. Indexes
+        that are neither resident nor snapshotted are left to be built by
+        their loader.
+        """
+        intervals = record_intervals(meta_data)
+        if not intervals or 'assembly' not in meta_data:
+            return
+
+        key = (user_id, meta_data['assembly'])
+        with self._lock:
+            index = self._get(*key)
+            if index is None:
+                return
+            index.add(str(file_id), intervals)
+
+    def remove_file(self, user_id, file_id):
+        """
+        Remove a file from all of the indexes for a user
+        """
+        self.remove_files(user_id, [file_id])
+
+    def remove_files(self, user_id, file_ids):
+        """
+        Remove a list of files from all of the indexes for a user, updating
+        each index once
+        """
+        file_ids = [str(file_id) for file_id in file_ids]
+        if not file_ids:
+            return
+        with self._lock:
+            keys = [key for key in self._indexes if key[0] == user_id]
+            keys += [key for key in self._snapshot_keys(user_id) if key not in keys]
+
+            for key in keys:
+                index = self._get(*key)
+                if index is not None:
+                    index.remove(file_ids)
+
+    def update_file(self, user_id, file_id, meta_data):
+        """
+        Replace the intervals for a file after its meta data has changed
+        """
+        with self._lock:
+            self.remove_file(user_id, file_id)
+            self.add_file(user_id, file_id, meta_data)
+
+    def invalidate(self, stale=None):
+        """
+        Drop resident indexes, e.g. after another process has changed the
+        files. The dropped indexes are then rebuilt from the DM API rather
+        than from their snapshots, which may also be out of date, and the
+        new snapshots replace the old ones.
+
+        Parameters
+        ----------
+        stale : function
+            Called with the user id and assembly of each index, returns True
+            if the index is to be dropped. If None all indexes are dropped.
+        """
+        with self._lock:
+            keys = [key for key in self._indexes if stale is None or stale(*key)]
+            for key in keys:
+                del self._indexes[key]
+            self._rebuild.update(keys)
+
+    def warm(self):
+        """
+        Load all of the snapshots so that the first queries do not need to
+        """
+        for key in self._snapshot_keys():
+            self._get(*key)
+
+    def clear(self):
+        """
+        Write all dirty indexes to their snapshots and drop the resident
+        indexes, so that they are loaded again as they would be by a new
+        process
+        """
+        with self._lock:
+            self.flush()
+            self._indexes = {}
+            self._last_save = {}
+
+    def flush(self):
+        """
+        Write all dirty indexes to their snapshots
+        """
+        with self._lock:
+            for key, index in self._indexes.items():
+                self._save(key, index, force=True)
+
+    def stats(self):
+        """
+        Number of intervals held for each resident index
+
+        Returns
+        -------
+        dict
+        """
+        with self._lock:
+            return {
+                '{}:{}'.format(*key): len(index) for key, index in self._indexes.items()
+            }
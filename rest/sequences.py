@@ -0,0 +1,358 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import gzip
+import mmap
+import os
+import random
+import tempfile
+
+from rest.tabix import index_path
+
+SEQUENCE_FILE_TYPES = {
+    'fasta': 'fasta',
+    'fa': 'fasta',
+    'fna': 'fasta',
+    'fastq': 'fastq',
+    'fq': 'fastq',
+}
+
+FAI_SUFFIX = '.fai'
+
+# Number of lines checked for the start of a record after a random seek
+_RESYNC_LINES = 8
+
+
+class SequenceError(Exception):
+    """
+    Raised when a sequence file cannot be indexed or read. The message is
+    returned to the client as the error.
+    """
+    pass
+
+
+def sequence_type(file_type):
+    """
+    Get the kind of sequence file for a file type
+
+    Returns
+    -------
+    str
+        'fasta', 'fastq' or None if the file type is not a sequence file
+    """
+    return SEQUENCE_FILE_TYPES.get(str(file_type).lower())
+
+
+def _is_gzip(file_path):
+    with open(file_path, 'rb') as handle:
+        return handle.read(2) == b'\x1f\x8b'
+
+
+def build_fai(file_path):
+    """
+    Index a FASTA file in the samtools .fai format. Every line of a sequence
+    apart from the last must have the same length.
+
+    Returns
+    -------
+    list
+        (name, length, offset, line bases, line width) for each sequence
+    """
+    entries = []
+    current = None
+    offset = 0
+    with open(file_path, 'rb') as handle:
+        for line in iter(handle.readline, b''):
+            if line.startswith(b'>'):
+                if current is not None:
+                    entries.append(tuple(current[:5]))
+                fields = line[1:].split()
+                name = fields[0].decode('utf-8') if fields else ''
+                # name, length, offset, line bases, line width, ended
+                current = [name, 0, offset + len(line), 0, 0, False]
+            elif current is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases:
+                    if current[5] or (current[3] and bases > current[3]):
+                        raise SequenceError('InconsistentLineLength')
+                    if not current[3]:
+                        current[3], current[4] = bases, len(line)
+                    elif bases < current[3] or len(line) != current[4]:
+                        current[5] = True
+                    current[1] += bases
+                else:
+                    current[5] = True
+            elif line.strip():
+                raise SequenceError('InvalidFasta')
+            offset += len(line)
+    if current is not None:
+        entries.append(tuple(current[:5]))
+    return entries
+
+
+def _read_fai(fai_path):
+    entries = []
+    with open(fai_path) as handle:
+        for line in handle:
+            fields = line.rstrip('\r\n').split('\t')
+            entries.append((fields[0],) + tuple(int(f) for f in fields[1:5]))
+    return entries
+
+
+def _write_fai(fai_path, entries):
+    index_dir = os.path.dirname(fai_path)
+    try:
+        os.makedirs(index_dir)
+    except OSError:
+        if not os.path.isdir(index_dir):
+            raise
+    # Each process writes its own temporary file
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        prefix='.' + os.path.basename(fai_path) + '.', suffix='.tmp', dir=index_dir)
+    try:
+        with os.fdopen(tmp_fd, 'w') as handle:
+            for entry in entries:
+                handle.write('\t'.join(str(field) for field in entry) + '\n')
+        os.rename(tmp_path, fai_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class FastaFile(object):
+    """
+    Memory mapped FASTA file with its .fai index. A subsequence is read by
+    calculating the offsets of its first and last bases from the line length
+    of the sequence, so only the pages holding it are read.
+    """
+
+    def __init__(self, file_path, entries):
+        self.entries = {entry[0]: entry for entry in entries}
+        self._handle = open(file_path, 'rb')
+        size = os.fstat(self._handle.fileno()).st_size
+        self._map = mmap.mmap(
+            self._handle.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def fetch(self, chrom, start, end, max_bases=None):
+        """
+        Read a subsequence
+
+        Parameters
+        ----------
+        chrom : str
+        start : int
+        end : int
+            Zero based, half open region. The end is clipped to the length
+            of the sequence.
+        max_bases : int
+            Longest subsequence that can be read
+
+        Returns
+        -------
+        dict
+            `chrom`, `start`, `end` and the `sequence`
+        """
+        entry = self.entries.get(chrom)
+        if entry is None:
+            raise SequenceError('UnknownChromosome')
+        _, length, offset, line_bases, line_width = entry
+        end = min(end, length)
+        if start >= end:
+            raise SequenceError('InvalidRegion')
+        if max_bases is not None and end - start > max_bases:
+            raise SequenceError('RegionTooLarge')
+
+        first = offset + (start // line_bases) * line_width + start % line_bases
+        last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+        data = self._map[first:last].replace(b'\n', b'').replace(b'\r', b'')
+        return {'chrom': chrom, 'start': start, 'end': end, 'sequence': data.decode('ascii')}
+
+    def close(self):
+        """
+        Unmap and close the file
+        """
+        if self._map is not None:
+            self._map.close()
+        self._handle.close()
+
+
+def open_fasta(file_path, index_dir=None):
+    """
+    Open a FASTA file, using its .fai index if it is up to date or building
+    the index otherwise. New indexes are saved in `index_dir`, or next to the
+    file if it is None, and are only kept in memory if they cannot be saved.
+
+    Returns
+    -------
+    FastaFile
+    """
+    if _is_gzip(file_path):
+        raise SequenceError('CompressedFasta')
+
+    fai_path = index_path(file_path, index_dir, FAI_SUFFIX)
+    entries = None
+    if (os.path.isfile(fai_path) and
+            os.stat(fai_path).st_mtime >= os.stat(file_path).st_mtime):
+        try:
+            entries = _read_fai(fai_path)
+        except (IOError, OSError, ValueError, IndexError):
+            entries = None
+
+    if entries is None:
+        entries = build_fai(file_path)
+        try:
+            _write_fai(fai_path, entries)
+        except (IOError, OSError):
+            pass
+    return FastaFile(file_path, entries)
+
+
+def _open_fastq(file_path):
+    if _is_gzip(file_path):
+        return gzip.open(file_path, 'rb'), True
+    return open(file_path, 'rb'), False
+
+
+def _read_record(handle):
+    """
+    Read the next FASTQ record
+
+    Returns
+    -------
+    bytes
+        The four lines of the record, or None at the end of the file
+    """
+    header = handle.readline()
+    while header and not header.strip():
+        header = handle.readline()
+    if not header:
+        return None
+    sequence, separator, quality = handle.readline(), handle.readline(), handle.readline()
+    if not header.startswith(b'@') or not separator.startswith(b'+') or not quality:
+        raise SequenceError('InvalidFastq')
+    if not quality.endswith(b'\n'):
+        quality += b'\n'
+    return header + sequence + separator + quality
+
+
+def fastq_head(file_path, count):
+    """
+    Read the first records of a FASTQ file, which can be gzipped. Reading
+    stops once `count` records have been read.
+
+    Yields
+    ------
+    bytes
+        Each record
+    """
+    handle, _ = _open_fastq(file_path)
+    try:
+        for _ in range(count):
+            record = _read_record(handle)
+            if record is None:
+                break
+            yield record
+    finally:
+        handle.close()
+
+
+def _record_at(handle, offset):
+    """
+    Find the first complete record after a byte offset. A header line is
+    recognised by the + line that follows its sequence and a quality line of
+    the same length as the sequence, as quality lines can also start with @.
+
+    Returns
+    -------
+    tuple
+        (offset of the record, record), or (None, None)
+    """
+    handle.seek(offset)
+    if offset:
+        offset += len(handle.readline())
+    for _ in range(_RESYNC_LINES):
+        handle.seek(offset)
+        lines = [handle.readline() for _ in range(4)]
+        if not lines[3]:
+            break
+        if (lines[0].startswith(b'@') and lines[2].startswith(b'+') and
+                len(lines[1].rstrip(b'\r\n')) == len(lines[3].rstrip(b'\r\n'))):
+            return offset, b''.join(lines)
+        offset += len(lines[0])
+    return None, None
+
+
+def fastq_sample(file_path, count, seed=0, max_scan=100000):
+    """
+    Read a random sample of the records of a FASTQ file, in the order that
+    they are in the file.
+
+    For uncompressed files the records are found by seeking to random
+    offsets, so only the records in the sample are read. Records are picked
+    in proportion to their length, which is uniform for fixed length reads.
+    Gzipped files cannot be seeked into, so the sample is taken uniformly
+    from the first `max_scan` records and reading stops there.
+
+    Parameters
+    ----------
+    file_path : str
+    count : int
+        Number of records to return
+    seed : int
+        Seed for the random sample, so the same sample is returned each time
+    max_scan : int
+        Number of records to sample from for gzipped files
+
+    Returns
+    -------
+    list
+        Records
+    """
+    rng = random.Random(seed)
+    handle, compressed = _open_fastq(file_path)
+    try:
+        if compressed:
+            sample = []
+            for number in range(max_scan):
+                record = _read_record(handle)
+                if record is None:
+                    break
+                if number < count:
+                    sample.append((number, record))
+                else:
+                    slot = rng.randint(0, number)
+                    if slot < count:
+                        sample[slot] = (number, record)
+            return [record for _, record in sorted(sample)]
+
+        size = os.fstat(handle.fileno()).st_size
+        found = {}
+        # Offsets that land in the same record give it once, so a few more
+        # rounds are taken to make up the sample
+        for _ in range(4):
+            missing = count - len(found)
+            if missing <= 0 or size == 0:
+                break
+            for offset in sorted(rng.randrange(size) for _ in range(missing)):
+                record_offset, record = _record_at(handle, offset)
+                if record is not None:
+                    found[record_offset] = record
+        return [found[offset] for offset in sorted(found)[:count]]
+    finally:
+        handle.close()
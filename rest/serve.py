@@ -0,0 +1,387 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import _thread as thread
+except ImportError:
+    import thread
+
+from waitress import create_server
+
+from rest import app
+from rest.versioning import VERSION_SLOTS
+
+# Exit status of a worker that could not be set up
+START_FAILED = 3
+
+# Seconds before a worker that exited unexpectedly is replaced, doubled for
+# each consecutive worker that failed to start
+RESPAWN_DELAY = 0.5
+MAX_RESPAWN_DELAY = 30.0
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the DMP REST server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5002)
+    parser.add_argument(
+        '--threads', type=int, default=4,
+        help='Number of request threads in each worker process')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of worker processes sharing the listening socket')
+    parser.add_argument(
+        '--connection-limit', type=int, default=100,
+        help='Maximum number of open connections in each worker process')
+    parser.add_argument(
+        '--backlog', type=int, default=1024,
+        help='Size of the listen queue of the socket')
+    parser.add_argument(
+        '--channel-timeout', type=int, default=120,
+        help='Seconds that an inactive connection is kept open')
+    parser.add_argument(
+        '--drain-timeout', type=float, default=30.0,
+        help='Seconds to wait for running requests on shutdown')
+    parser.add_argument(
+        '--backend', choices=['dmp', 'sqlite'], default=None,
+        help='Storage backend, defaults to the DM_BACKEND config value')
+    parser.add_argument(
+        '--sqlite-path', default=None,
+        help='Location of the database file for the sqlite backend')
+    parser.add_argument(
+        '--no-warm', action='store_true',
+        help='Do not create DM API clients or load indexes before serving')
+    parser.add_argument(
+        '--max-start-failures', type=int, default=5,
+        help='Stop once this many worker processes in a row have failed to start')
+    return parser.parse_args(argv)
+
+
+def warm():
+    """
+    Create the DM API clients and load the region index snapshots so that
+    the first requests do not pay for them
+    """
+    app.DM_REGISTRY.warm()
+    app.REGION_INDEX.warm()
+
+
+def _wait_for_requests(server, timeout):
+    """
+    Wait for the open requests to complete
+
+    Returns
+    -------
+    bool
+        False if requests were still running after `timeout` seconds
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if not any(channel.requests for channel in list(server.active_channels.values())):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def _drain(server, timeout):
+    """
+    Stop accepting connections and wait for the open requests to complete
+    before stopping the server
+    """
+    server.accepting = False
+
+    def _wait():
+        _wait_for_requests(server, timeout)
+        thread.interrupt_main()
+
+    drain_thread = threading.Thread(target=_wait)
+    drain_thread.daemon = True
+    drain_thread.start()
+
+
+def _start(options):
+    """
+    Apply the options and load the DM API clients and caches for a server
+    process. This is run when a process starts, which is how the pre-fork
+    master reloads, and when a single process server is reloaded.
+    """
+    if options.backend is not None:
+        app.APP.config['DM_BACKEND'] = options.backend
+    if options.sqlite_path is not None:
+        app.APP.config['DM_SQLITE_PATH'] = options.sqlite_path
+    app.DM_REGISTRY.reload()
+
+    app.DM_REGISTRY.resize(options.threads)
+    if app.APP.config['DM_BACKEND'] == 'sqlite':
+        # Each SQLite client has its own connection so the test pool does not
+        # need to be limited to a single shared client
+        app.DM_REGISTRY.resize(options.threads, mode='test')
+    if not options.no_warm:
+        warm()
+
+
+def _reload(server, options):
+    """
+    Reload a single process server in the same way that the pre-fork master
+    replaces its workers. New connections wait while the open requests
+    complete, then the process is set up again as a new worker would be and
+    starts accepting connections.
+    """
+    server.accepting = False
+
+    def _run():
+        try:
+            _wait_for_requests(server, options.drain_timeout)
+            app.REGION_INDEX.clear()
+            app.LINEAGE_CACHE.clear()
+            app.HANDLE_CACHE.clear()
+            _start(options)
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+        finally:
+            server.accepting = True
+
+    reload_thread = threading.Thread(target=_run)
+    reload_thread.daemon = True
+    reload_thread.start()
+    return reload_thread
+
+
+def _serve(options, sock=None):
+    """
+    Run a single server process that has been set up with `_start` until it
+    is asked to stop
+    """
+    kwargs = {
+        'threads': options.threads,
+        'connection_limit': options.connection_limit,
+        'backlog': options.backlog,
+        'channel_timeout': options.channel_timeout,
+    }
+    if sock is not None:
+        kwargs['sockets'] = [sock]
+    else:
+        kwargs['host'] = options.host
+        kwargs['port'] = options.port
+    server = create_server(app.APP, **kwargs)
+
+    def _on_term(signum, frame):  # pylint: disable=unused-argument
+        _drain(server, options.drain_timeout)
+
+    def _on_hup(signum, frame):  # pylint: disable=unused-argument
+        _reload(server, options)
+
+    signal.signal(signal.SIGTERM, _on_term)
+    # Workers of the pre-fork master are replaced by the master instead
+    signal.signal(signal.SIGHUP, _on_hup if sock is None else signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    try:
+        server.run()
+    finally:
+        app.REGION_INDEX.flush()
+        app.DM_REGISTRY.shutdown()
+
+
+class Master(object):
+    """
+    Pre-forks worker processes that share a single listening socket.
+
+    SIGHUP starts a new set of workers and then drains the old ones, so that
+    the DM API configuration and the options are applied again and the
+    caches are rebuilt without dropping requests. The workers are forked
+    from the master, which has already imported the app, so changes to the
+    code or to the app config need the master to be restarted.
+    SIGTERM and SIGINT drain all of the workers and then exit.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((options.host, options.port))
+        self.sock.listen(options.backlog)
+        self.shared = multiprocessing.Value('L', 0)
+        self.slots = multiprocessing.Array('L', VERSION_SLOTS, lock=False)
+        # Number of workers that have started, used to reset the failures
+        self.started = multiprocessing.Value('L', 0)
+        self.started_seen = 0
+        self.failures = 0
+        self.respawn_at = []
+        self.workers = set()
+        self.retiring = set()
+        self.stopping = False
+        self.reloading = False
+        self.failed = False
+
+    def spawn(self):
+        """
+        Fork a new worker process
+        """
+        pid = os.fork()
+        if pid == 0:
+            # Drop the handlers of the master so that it can stop the worker
+            # while it is still starting
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            status = START_FAILED
+            try:
+                app.VERSIONS.share(self.shared, self.slots)
+                _start(self.options)
+                with self.started.get_lock():
+                    self.started.value += 1
+                status = 1
+                _serve(self.options, self.sock)
+                status = 0
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                os._exit(status)  # pylint: disable=protected-access
+        self.workers.add(pid)
+
+    def _stop(self, signum, frame):  # pylint: disable=unused-argument
+        self.stopping = True
+
+    def _reload(self, signum, frame):  # pylint: disable=unused-argument
+        self.reloading = True
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+            self.workers.discard(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif not self.stopping:
+                self._replace(status)
+
+    def _replace(self, status):
+        """
+        Schedule a replacement for a worker that exited unexpectedly, backing
+        off while the workers are failing to start and stopping once
+        `max_start_failures` have failed in a row
+        """
+        started = self.started.value
+        if started != self.started_seen:
+            self.started_seen = started
+            self.failures = 0
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == START_FAILED:
+            self.failures += 1
+            if self.failures >= self.options.max_start_failures:
+                print('{} workers failed to start in a row, stopping'.format(
+                    self.failures), file=sys.stderr)
+                self.failed = True
+                self.stopping = True
+                return
+        delay = min(RESPAWN_DELAY * 2 ** self.failures, MAX_RESPAWN_DELAY)
+        self.respawn_at.append(time.time() + delay)
+
+    def _respawn(self):
+        now = time.time()
+        due = [t for t in self.respawn_at if t <= now]
+        self.respawn_at = [t for t in self.respawn_at if t > now]
+        for _ in due:
+            self.spawn()
+
+    def _terminate(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """
+        Start the workers and supervise them until asked to stop
+
+        Returns
+        -------
+        int
+            Exit status, 1 if the workers kept failing to start
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+
+        for _ in range(self.options.workers):
+            self.spawn()
+
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                old_workers = set(self.workers)
+                for _ in range(self.options.workers):
+                    self.spawn()
+                self.retiring.update(old_workers)
+                self._terminate(old_workers)
+            self._reap()
+            self._respawn()
+            time.sleep(0.2)
+
+        self._terminate(self.workers)
+        deadline = time.time() + self.options.drain_timeout + 5
+        while self.workers and time.time() < deadline:
+            self._reap()
+            time.sleep(0.2)
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.sock.close()
+        return 1 if self.failed else 0
+
+
+def main(argv=None):
+    """
+    Entry point for running the service with waitress
+
+    Example
+    -------
+    .. code-block:: none
+       :linenos:
+
+       mg-rest-dm-serve --host 0.0.0.0 --port 5002 --threads 8 --workers 4
+    """
+    options = _parse_args(argv)
+    if options.workers > 1:
+        return Master(options).run()
+    _start(options)
+    _serve(options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import threading
+
+
+class _Call(object):
+    """
+    A call that is in progress and the threads waiting for its result
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiting = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key so that only the first
+    thread makes the call and the others wait for and share its result.
+
+    Nothing is cached once the call has finished, so a call that starts after
+    another has finished makes its own call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._leaders = 0
+        self._followers = 0
+
+    def do(self, key, func):
+        """
+        Call func, or wait for the result of a call with the same key that is
+        already in progress. If the call raises an exception it is raised in
+        every thread waiting for it.
+
+        Parameters
+        ----------
+        key : hashable
+        func : function
+            Called with no arguments
+
+        Returns
+        -------
+        tuple
+            (shared, result) where shared is True if the result came from a
+            call made by another thread
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._leaders += 1
+            else:
+                call.waiting += 1
+                self._followers += 1
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as err:  # pylint: disable=broad-except
+                call.error = err
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return False, call.result
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return True, call.result
+
+    def stats(self):
+        """
+        Usage figures
+
+        Returns
+        -------
+        dict
+        """
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'waiting': sum(call.waiting for call in self._calls.values()),
+                'leaders': self._leaders,
+                'followers': self._followers
+            }
@@ -0,0 +1,503 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import datetime
+import json
+import sqlite3
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        file_path TEXT,
+        file_type TEXT,
+        size INTEGER,
+        parent_dir TEXT,
+        data_type TEXT,
+        taxon_id INTEGER,
+        compressed TEXT,
+        assembly TEXT,
+        meta_data TEXT NOT NULL,
+        creation_time TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS file_sources (
+        file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        source_id TEXT NOT NULL,
+        source_row INTEGER,
+        PRIMARY KEY (file_id, position)
+    )
+    """,
+    # Mirrors the compound indexes created for the Mongo store, each leading
+    # with user_id as every query is scoped to a user
+    "CREATE INDEX IF NOT EXISTS files_assembly ON files "
+    "(user_id, assembly, file_type, data_type)",
+    "CREATE INDEX IF NOT EXISTS files_assembly_data_type ON files "
+    "(user_id, assembly, data_type)",
+    "CREATE INDEX IF NOT EXISTS files_file_type ON files (user_id, file_type, data_type)",
+    "CREATE INDEX IF NOT EXISTS files_data_type ON files (user_id, data_type)",
+    "CREATE INDEX IF NOT EXISTS files_taxon_id ON files (user_id, taxon_id)",
+    "CREATE INDEX IF NOT EXISTS files_parent_dir ON files (user_id, parent_dir)",
+    "CREATE INDEX IF NOT EXISTS file_sources_source_id ON file_sources (source_id, file_id)",
+]
+
+# Columns that can be filtered on, keyed by the filter parameter
+FILTER_COLUMNS = {
+    'assembly': 'assembly',
+    'file_type': 'file_type',
+    'data_type': 'data_type',
+    'taxon_id': 'taxon_id',
+    'parent_dir': 'parent_dir',
+}
+
+# Columns that can be changed with modify_column
+MODIFIABLE_COLUMNS = [
+    'file_path', 'file_type', 'size', 'parent_dir', 'data_type', 'taxon_id',
+    'compressed'
+]
+
+COLUMNS = (
+    'id, user_id, file_path, file_type, size, parent_dir, data_type, taxon_id, '
+    'compressed, meta_data, creation_time'
+)
+
+# Keeps the number of bound parameters below the SQLite limit
+MAX_VARIABLES = 500
+
+# Largest row id that SQLite can store
+MAX_ROW_ID = 2 ** 63 - 1
+
+
+def format_id(row_id):
+    """
+    Format a row id as a file id. The ids are zero padded hex strings so that
+    they sort in the order that the files were registered.
+    """
+    return '{:024x}'.format(row_id)
+
+
+def parse_id(file_id):
+    """
+    Get the row id from a file id
+
+    Returns
+    -------
+    int
+        None if the file id was not generated by this store
+    """
+    try:
+        row_id = int(str(file_id), 16)
+    except ValueError:
+        return None
+    # Row ids are signed 64 bit integers, and larger values cannot be bound
+    return row_id if 0 <= row_id <= MAX_ROW_ID else None
+
+
+def _chunks(items, chunk_size=MAX_VARIABLES):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def _placeholders(count):
+    return ','.join('?' * count)
+
+
+class SQLiteStore(object):
+    """
+    Local storage backend for single node deployments, CI and offline
+    development with the same interface as the DM API client (dmp).
+
+    Files are held in an SQLite database in WAL mode so that readers are not
+    blocked by writers. The meta data is stored as JSON, with the assembly
+    copied into its own column so that it can be indexed, and the links to
+    source files are held in a separate table indexed in both directions.
+
+    Each instance holds its own connection and is intended to be used by one
+    thread at a time, as the DM API client pool does. Several instances can
+    share a database file.
+
+    The store also provides the bulk operations used by rest.dm_store so that
+    listings, filters, metadata patches and deletes run as single queries.
+    """
+
+    supports_bulk = True
+
+    def __init__(self, path, timeout=30.0):
+        """
+        Parameters
+        ----------
+        path : str
+            Location of the database file, created if it does not exist
+        timeout : float
+            Number of seconds to wait for a lock held by another connection
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        with self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self.conn.close()
+
+    def _sources(self, row_ids):
+        sources = {}
+        for chunk in _chunks(list(row_ids)):
+            for row in self.conn.execute(
+                    'SELECT file_id, source_id FROM file_sources WHERE file_id IN ({}) '
+                    'ORDER BY file_id, position'.format(_placeholders(len(chunk))), chunk):
+                sources.setdefault(row[0], []).append(row[1])
+        return sources
+
+    def _records(self, rows):
+        rows = list(rows)
+        sources = self._sources(row['id'] for row in rows)
+        return [{
+            '_id': format_id(row['id']),
+            'user_id': row['user_id'],
+            'file_path': row['file_path'],
+            'file_type': row['file_type'],
+            'size': row['size'],
+            'parent_dir': row['parent_dir'],
+            'data_type': row['data_type'],
+            'taxon_id': row['taxon_id'],
+            'compressed': row['compressed'],
+            'source_id': sources.get(row['id'], []),
+            'meta_data': json.loads(row['meta_data']),
+            'creation_time': row['creation_time']
+        } for row in rows]
+
+    def _select(self, where, params, suffix=''):
+        return self._records(self.conn.execute(
+            'SELECT {} FROM files WHERE {} {}'.format(COLUMNS, where, suffix), params))
+
+    def _insert(self, user_id, record, creation_time):
+        meta_data = record.get('meta_data') or {}
+        cursor = self.conn.execute(
+            'INSERT INTO files (user_id, file_path, file_type, size, parent_dir, '
+            'data_type, taxon_id, compressed, assembly, meta_data, creation_time) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (user_id, record.get('file_path'), record.get('file_type'), record.get('size'),
+             record.get('parent_dir'), record.get('data_type'), record.get('taxon_id'),
+             record.get('compressed'), meta_data.get('assembly'), json.dumps(meta_data),
+             creation_time))
+        self._set_sources(cursor.lastrowid, record.get('source_id'))
+        return format_id(cursor.lastrowid)
+
+    def _set_sources(self, row_id, source_ids):
+        self.conn.execute('DELETE FROM file_sources WHERE file_id = ?', (row_id,))
+        self.conn.executemany(
+            'INSERT INTO file_sources (file_id, position, source_id, source_row) '
+            'VALUES (?, ?, ?, ?)',
+            [(row_id, i, str(s_id), parse_id(s_id))
+             for i, s_id in enumerate(source_ids or [])])
+
+    def _user_row_ids(self, user_id, file_ids):
+        row_ids = [r_id for r_id in (parse_id(f_id) for f_id in file_ids) if r_id is not None]
+        found = []
+        for chunk in _chunks(row_ids):
+            found.extend(row[0] for row in self.conn.execute(
+                'SELECT id FROM files WHERE user_id = ? AND id IN ({})'.format(
+                    _placeholders(len(chunk))), [user_id] + chunk))
+        return found
+
+    def _where(self, user_id, filters):
+        clauses = ['files.user_id = ?']
+        params = [user_id]
+        for key, value in sorted(filters.items()):
+            if value is None:
+                continue
+            if key == 'source_id':
+                clauses.append(
+                    'files.id IN (SELECT file_id FROM file_sources WHERE source_id = ?)')
+                params.append(str(value))
+            else:
+                clauses.append('files.{} = ?'.format(FILTER_COLUMNS[key]))
+                params.append(value)
+        return ' AND '.join(clauses), params
+
+    # DM API interface
+
+    @staticmethod
+    def is_valid_id(file_id):
+        """
+        Check that a value could be a file id generated by this store
+        """
+        return parse_id(file_id) is not None
+
+    def get_file_by_id(self, user_id, file_id, rest=False):  # pylint: disable=unused-argument
+        """
+        Get the record for a file
+
+        Returns
+        -------
+        dict
+            None if the user has no file with that id
+        """
+        row_id = parse_id(file_id)
+        if row_id is None:
+            return None
+        records = self._select('user_id = ? AND id = ?', (user_id, row_id))
+        return records[0] if records else None
+
+    def get_files_by_user(self, user_id, rest=False):  # pylint: disable=unused-argument
+        """
+        Get all of the files for a user
+        """
+        return self._select('user_id = ?', (user_id,), 'ORDER BY id')
+
+    def get_files_by_assembly(self, user_id, assembly, rest=False):  # pylint: disable=unused-argument
+        """
+        Get the files for a user on an assembly
+        """
+        return self._select('user_id = ? AND assembly = ?', (user_id, assembly), 'ORDER BY id')
+
+    def get_files_by_file_type(self, user_id, file_type=None, rest=False):  # pylint: disable=unused-argument
+        """
+        Get the files for a user of a file type, or all files if no type is given
+        """
+        return self.find_files(user_id, {'file_type': file_type})
+
+    def get_files_by_data_type(self, user_id, data_type=None, rest=False):  # pylint: disable=unused-argument
+        """
+        Get the files for a user of a data type, or all files if no type is given
+        """
+        return self.find_files(user_id, {'data_type': data_type})
+
+    def get_file_history(self, user_id, file_id):
+        """
+        Get the ids of all of the files that a file was generated from,
+        following the source links back through every generation
+
+        Returns
+        -------
+        list
+            File ids, nearest generation first
+        """
+        row_id = parse_id(file_id)
+        if row_id is None or not self._user_row_ids(user_id, [file_id]):
+            return []
+
+        rows = self.conn.execute(
+            """
+            WITH RECURSIVE history (source_id, source_row, depth) AS (
+                SELECT source_id, source_row, 1 FROM file_sources WHERE file_id = ?
+                UNION
+                SELECT s.source_id, s.source_row, h.depth + 1
+                FROM history h JOIN file_sources s ON s.file_id = h.source_row
+            )
+            SELECT source_id, MIN(depth) AS depth FROM history
+            GROUP BY source_id ORDER BY depth, source_id
+            """, (row_id,))
+        return [row[0] for row in rows]
+
+    def set_file(self, user_id, file_path, file_type, size, parent_dir, data_type,
+                 taxon_id, compressed=None, source_id=None, meta_data=None, **kwargs):  # pylint: disable=unused-argument
+        """
+        Register a file
+
+        Returns
+        -------
+        str
+            File id
+        """
+        record = {
+            'file_path': file_path, 'file_type': file_type, 'size': size,
+            'parent_dir': parent_dir, 'data_type': data_type, 'taxon_id': taxon_id,
+            'compressed': compressed, 'source_id': source_id, 'meta_data': meta_data
+        }
+        with self.conn:
+            return self._insert(user_id, record, datetime.datetime.utcnow().isoformat())
+
+    def add_file_metadata(self, user_id, file_id, key, value):
+        """
+        Add a key-value pair to the meta data of a file
+        """
+        self.patch_file_metadata(user_id, [file_id], {key: value}, [])
+        return file_id
+
+    def remove_file_metadata(self, user_id, file_id, key):
+        """
+        Remove a key from the meta data of a file
+        """
+        self.patch_file_metadata(user_id, [file_id], {}, [key])
+        return file_id
+
+    def modify_column(self, user_id, file_id, key, value):
+        """
+        Change the value of one of the columns of a file
+        """
+        row_ids = self._user_row_ids(user_id, [file_id])
+        if not row_ids:
+            return None
+
+        with self.conn:
+            if key == 'source_id':
+                self._set_sources(row_ids[0], value)
+            elif key == 'meta_data':
+                self.conn.execute(
+                    'UPDATE files SET meta_data = ?, assembly = ? WHERE id = ?',
+                    (json.dumps(value), value.get('assembly'), row_ids[0]))
+            elif key in MODIFIABLE_COLUMNS:
+                self.conn.execute(
+                    'UPDATE files SET {} = ? WHERE id = ?'.format(key), (value, row_ids[0]))
+            else:
+                raise ValueError('Column {} cannot be modified'.format(key))
+        return file_id
+
+    def remove_file(self, user_id, file_id):
+        """
+        Remove a file
+        """
+        self.remove_files(user_id, [file_id])
+        return file_id
+
+    # Bulk operations used by rest.dm_store
+
+    def get_files_by_ids(self, user_id, file_ids):
+        """
+        Get the records for a list of file ids
+
+        Returns
+        -------
+        list
+            Records in the same order as `file_ids`, skipping unknown ids
+        """
+        found = {}
+        row_ids = [r_id for r_id in (parse_id(f_id) for f_id in file_ids) if r_id is not None]
+        for chunk in _chunks(row_ids):
+            for record in self._select(
+                    'user_id = ? AND id IN ({})'.format(_placeholders(len(chunk))),
+                    [user_id] + chunk):
+                found[parse_id(record['_id'])] = record
+        return [found[r_id] for r_id in row_ids if r_id in found]
+
+    def iter_files_by_user(self, user_id, after=None, limit=None, batch_size=1000):
+        """
+        Iterate over the files for a user ordered by file id, reading them in
+        batches
+
+        Returns
+        -------
+        generator
+        """
+        after_id = parse_id(after) if after is not None else -1
+        if after_id is None:
+            return
+        remaining = limit
+        while remaining is None or remaining > 0:
+            count = batch_size if remaining is None else min(batch_size, remaining)
+            records = self._select(
+                'user_id = ? AND id > ?', (user_id, after_id), 'ORDER BY id LIMIT {:d}'.format(count))
+            for record in records:
+                yield record
+            if len(records) < count:
+                return
+            after_id = parse_id(records[-1]['_id'])
+            if remaining is not None:
+                remaining -= len(records)
+
+    def find_files(self, user_id, filters, limit=None):
+        """
+        Get the files matching all of the given filters
+
+        Parameters
+        ----------
+        filters : dict
+            Any of assembly, file_type, data_type, taxon_id, parent_dir and
+            source_id
+        limit : int
+            Maximum number of records to return
+        """
+        where, params = self._where(user_id, filters)
+        suffix = 'ORDER BY id' + (' LIMIT {:d}'.format(limit) if limit is not None else '')
+        return self._select(where, params, suffix)
+
+    def find_file_ids(self, user_id, filters):
+        """
+        Get the ids of the files matching all of the given filters
+        """
+        where, params = self._where(user_id, filters)
+        return [format_id(row[0]) for row in self.conn.execute(
+            'SELECT id FROM files WHERE {} ORDER BY id'.format(where), params)]
+
+    def insert_files(self, user_id, records):
+        """
+        Register a batch of files in a single transaction
+
+        Returns
+        -------
+        list
+            (file_id, error) for each record
+        """
+        creation_time = datetime.datetime.utcnow().isoformat()
+        with self.conn:
+            return [(self._insert(user_id, record, creation_time), None) for record in records]
+
+    def patch_file_metadata(self, user_id, file_ids, add_meta, remove_meta):
+        """
+        Add and remove meta data keys for a set of files in a single
+        transaction
+        """
+        with self.conn:
+            updates = []
+            row_ids = self._user_row_ids(user_id, file_ids)
+            for chunk in _chunks(row_ids):
+                for row in self.conn.execute(
+                        'SELECT id, meta_data FROM files WHERE id IN ({})'.format(
+                            _placeholders(len(chunk))), chunk):
+                    meta_data = json.loads(row['meta_data'])
+                    meta_data.update(add_meta)
+                    for key in remove_meta:
+                        meta_data.pop(key, None)
+                    updates.append(
+                        (json.dumps(meta_data), meta_data.get('assembly'), row['id']))
+            self.conn.executemany(
+                'UPDATE files SET meta_data = ?, assembly = ? WHERE id = ?', updates)
+        return file_ids
+
+    def remove_files(self, user_id, file_ids, dry_run=False):
+        """
+        Remove a list of files
+
+        Returns
+        -------
+        set
+            The ids of the files that were found
+        """
+        with self.conn:
+            row_ids = self._user_row_ids(user_id, file_ids)
+            if not dry_run:
+                for chunk in _chunks(row_ids):
+                    self.conn.execute(
+                        'DELETE FROM files WHERE id IN ({})'.format(
+                            _placeholders(len(chunk))), chunk)
+        row_ids = set(row_ids)
+        return set(f_id for f_id in file_ids if parse_id(f_id) in row_ids)
@@ -0,0 +1,482 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import gzip
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+
+# Columns holding the location of each line. `seq`, `start` and `end` are the
+# positions of the chromosome, start and end columns from 0. Lines without an
+# end column span the length of the `ref` column, or a single base.
+Columns = namedtuple('Columns', ['seq', 'start', 'end', 'zero_based', 'ref'])
+
+PRESETS = {
+    'bed': Columns(0, 1, 2, True, None),
+    'tsv': Columns(0, 1, 2, False, None),
+    'gff': Columns(0, 3, 4, False, None),
+    'vcf': Columns(0, 1, None, False, 3),
+}
+
+TABULAR_FILE_TYPES = {
+    'bed': 'bed',
+    'bedgraph': 'bed',
+    'tsv': 'tsv',
+    'gff': 'gff',
+    'gff3': 'gff',
+    'gtf': 'gff',
+    'vcf': 'vcf',
+}
+
+# Width of the windows of the linear index, the same as tabix
+WINDOW_SHIFT = 14
+
+INDEX_SUFFIX = '.dmi'
+
+_SKIP_PREFIXES = (b'#', b'track', b'browser')
+
+
+class TabixError(Exception):
+    """
+    Raised when a file cannot be indexed or read by region. The message is
+    returned to the client as the error.
+    """
+    pass
+
+
+def tabular_columns(file_type):
+    """
+    Get the location columns for a file type
+
+    Returns
+    -------
+    Columns
+        None if the file type is not tabular
+    """
+    preset = TABULAR_FILE_TYPES.get(str(file_type).lower())
+    return PRESETS[preset] if preset is not None else None
+
+
+def is_bgzf(file_path):
+    """
+    Check whether a file is block compressed with bgzip
+    """
+    with open(file_path, 'rb') as handle:
+        header = handle.read(18)
+    return (len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and
+            header[12:14] == b'BC')
+
+
+def _read_block(handle, coffset):
+    """
+    Read and decompress the BGZF block at a file offset
+
+    Returns
+    -------
+    tuple
+        (data, compressed size), or None at the end of the file
+    """
+    handle.seek(coffset)
+    header = handle.read(12)
+    if len(header) < 12:
+        return None
+    if header[:4] != b'\x1f\x8b\x08\x04':
+        raise TabixError('NotBlockCompressed')
+    extra = handle.read(struct.unpack('<H', header[10:12])[0])
+
+    size = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        length = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b'BC':
+            size = struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + length
+    if size is None:
+        raise TabixError('NotBlockCompressed')
+
+    body = handle.read(size - 12 - len(extra))
+    return zlib.decompress(body[:-8], -15), size
+
+
+def _bgzf_lines(handle, voffset):
+    """
+    Iterate over the lines of a BGZF file from a virtual offset
+
+    Yields
+    ------
+    tuple
+        (virtual offset, line)
+    """
+    coffset, uoffset = voffset >> 16, voffset & 0xffff
+    pending = b''
+    pending_voffset = None
+    while True:
+        block = _read_block(handle, coffset)
+        if block is None:
+            break
+        data, size = block
+        pos = uoffset
+        uoffset = 0
+        while True:
+            newline = data.find(b'\n', pos)
+            if newline < 0:
+                if pos < len(data):
+                    if not pending:
+                        pending_voffset = (coffset << 16) | pos
+                    pending += data[pos:]
+                break
+            if pending:
+                yield pending_voffset, pending + data[pos:newline + 1]
+                pending = b''
+            else:
+                yield (coffset << 16) | pos, data[pos:newline + 1]
+            pos = newline + 1
+        coffset += size
+    if pending:
+        yield pending_voffset, pending
+
+
+def _plain_lines(handle, offset):
+    """
+    Iterate over the lines of an uncompressed file from a byte offset
+    """
+    handle.seek(offset)
+    for line in iter(handle.readline, b''):
+        yield offset, line
+        offset += len(line)
+
+
+def _interval(line, columns):
+    """
+    Get the location of a line as a zero based, half open interval
+
+    Returns
+    -------
+    tuple
+        (chrom, start, end), or None for header and comment lines
+    """
+    if not line.strip() or line.startswith(_SKIP_PREFIXES):
+        return None
+    fields = line.rstrip(b'\r\n').split(b'\t')
+    try:
+        start = int(fields[columns.start]) - (0 if columns.zero_based else 1)
+        if columns.end is not None:
+            end = int(fields[columns.end])
+        elif columns.ref is not None:
+            end = start + len(fields[columns.ref])
+        else:
+            end = start + 1
+    except (IndexError, ValueError):
+        raise TabixError('InvalidLine')
+    return fields[columns.seq].decode('utf-8'), start, end
+
+
+class TabixIndex(object):
+    """
+    Linear index of the offsets of the lines of a sorted tabular file.
+
+    For each chromosome the offset of the first line overlapping each 16kb
+    window is held, as in the linear index of tabix. A region is read by
+    seeking to the offset for the window holding its start and reading lines
+    until they start beyond its end. Offsets are virtual offsets for BGZF
+    files and byte offsets for uncompressed files.
+    """
+
+    def __init__(self, columns, offsets, compressed):
+        """
+        Parameters
+        ----------
+        columns : Columns
+        offsets : dict
+            Chromosome: numpy.ndarray of the offset for each window
+        compressed : bool
+            True for BGZF files
+        """
+        self.columns = columns
+        self.offsets = offsets
+        self.compressed = compressed
+
+    @classmethod
+    def build(cls, file_path, columns):
+        """
+        Index a file by reading it once. The lines must be sorted by
+        chromosome and start.
+        """
+        compressed = is_bgzf(file_path)
+        if not compressed and file_path.endswith('.gz'):
+            raise TabixError('NotBlockCompressed')
+
+        offsets = {}
+        chrom = None
+        windows = None
+        last_start = 0
+        with open(file_path, 'rb') as handle:
+            lines = _bgzf_lines(handle, 0) if compressed else _plain_lines(handle, 0)
+            for offset, line in lines:
+                interval = _interval(line, columns)
+                if interval is None:
+                    continue
+                if interval[0] != chrom:
+                    if interval[0] in offsets:
+                        raise TabixError('FileNotSorted')
+                    chrom = interval[0]
+                    windows = offsets[chrom] = []
+                    last_start = 0
+                if interval[1] < last_start:
+                    raise TabixError('FileNotSorted')
+                last_start = interval[1]
+
+                # The first line to reach a window has the lowest offset for it
+                last = max(interval[2] - 1, interval[1]) >> WINDOW_SHIFT
+                if last >= len(windows):
+                    windows.extend([None] * (last + 1 - len(windows)))
+                for window in range(interval[1] >> WINDOW_SHIFT, last + 1):
+                    if windows[window] is None:
+                        windows[window] = offset
+
+        return cls(columns, {c: _fill(w) for c, w in offsets.items()}, compressed)
+
+    @classmethod
+    def from_tbi(cls, index_path):
+        """
+        Load the linear index from a tabix .tbi file
+        """
+        with gzip.open(index_path, 'rb') as handle:
+            data = handle.read()
+        if data[:4] != b'TBI\x01':
+            raise TabixError('IndexUnreadable')
+
+        n_ref, fmt, col_seq, col_beg, col_end, _, _, l_nm = struct.unpack('<8i', data[4:36])
+        names = data[36:36 + l_nm].split(b'\x00')[:n_ref]
+        columns = Columns(
+            col_seq - 1, col_beg - 1, col_end - 1 if col_end > 0 else None,
+            bool(fmt & 0x10000), 3 if fmt & 0xffff == 2 else None)
+
+        pos = 36 + l_nm
+        offsets = {}
+        for name in names:
+            n_bin = struct.unpack('<i', data[pos:pos + 4])[0]
+            pos += 4
+            for _ in range(n_bin):
+                n_chunk = struct.unpack('<i', data[pos + 4:pos + 8])[0]
+                pos += 8 + 16 * n_chunk
+            n_intv = struct.unpack('<i', data[pos:pos + 4])[0]
+            pos += 4
+            offsets[name.decode('utf-8')] = np.frombuffer(
+                data, dtype='<u8', count=n_intv, offset=pos).copy()
+            pos += 8 * n_intv
+        return cls(columns, offsets, True)
+
+    @classmethod
+    def load(cls, index_path, stat):
+        """
+        Load a native index, or return None if it was made from a different
+        version of the file
+        """
+        with np.load(index_path, allow_pickle=False) as arrays:
+            if arrays['source'].tolist() != [float(stat.st_size), stat.st_mtime]:
+                return None
+            seq, start, end, zero_based, ref = arrays['columns'].tolist()
+            columns = Columns(
+                seq, start, end if end >= 0 else None, bool(zero_based),
+                ref if ref >= 0 else None)
+            bounds = np.cumsum(np.concatenate([[0], arrays['lengths']]))
+            all_offsets = arrays['offsets']
+            offsets = {
+                chrom: all_offsets[bounds[i]:bounds[i + 1]]
+                for i, chrom in enumerate(arrays['chroms'].tolist())
+            }
+            return cls(columns, offsets, bool(arrays['compressed']))
+
+    def save(self, index_path, stat):
+        """
+        Write the index with the size and modification time of the file it
+        was made from
+        """
+        chroms = list(self.offsets)
+        columns = self.columns
+        index_dir = os.path.dirname(index_path)
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            if not os.path.isdir(index_dir):
+                raise
+        # Each process writes its own temporary file
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            prefix='.' + os.path.basename(index_path) + '.', suffix='.tmp', dir=index_dir)
+        try:
+            with os.fdopen(tmp_fd, 'wb') as handle:
+                np.savez(
+                    handle,
+                    chroms=np.array(chroms, dtype=np.str_),
+                    lengths=np.array([len(self.offsets[c]) for c in chroms], dtype=np.int64),
+                    offsets=np.concatenate(
+                        [self.offsets[c] for c in chroms] + [np.zeros(0, dtype=np.uint64)]),
+                    columns=np.array([
+                        columns.seq, columns.start,
+                        columns.end if columns.end is not None else -1,
+                        int(columns.zero_based),
+                        columns.ref if columns.ref is not None else -1]),
+                    compressed=np.array(self.compressed),
+                    source=np.array([stat.st_size, stat.st_mtime], dtype=np.float64))
+            os.rename(tmp_path, index_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def fetch(self, file_path, chrom, start, end):
+        """
+        Iterate over the lines of the file overlapping a region
+
+        Parameters
+        ----------
+        file_path : str
+        chrom : str
+        start : int
+        end : int
+            Zero based, half open region
+
+        Yields
+        ------
+        bytes
+            Each line, including the line end
+        """
+        offsets = self.offsets.get(chrom)
+        window = start >> WINDOW_SHIFT
+        if offsets is None or window >= len(offsets):
+            return
+
+        with open(file_path, 'rb') as handle:
+            offset = int(offsets[window])
+            lines = _bgzf_lines(handle, offset) if self.compressed else _plain_lines(handle, offset)
+            # The offset can be before the first line of the chromosome, e.g.
+            # for the leading windows of a tabix index
+            found = False
+            for _, line in lines:
+                interval = _interval(line, self.columns)
+                if interval is None:
+                    continue
+                if interval[0] != chrom:
+                    if found:
+                        break
+                    continue
+                found = True
+                if interval[1] >= end:
+                    break
+                if interval[2] > start:
+                    yield line if line.endswith(b'\n') else line + b'\n'
+
+
+class PysamIndex(object):
+    """
+    Reads regions with pysam, for files with a tabix .tbi or .csi index
+    """
+
+    def fetch(self, file_path, chrom, start, end):
+        """
+        Iterate over the lines of the file overlapping a region
+        """
+        tabix_file = pysam.TabixFile(file_path)
+        try:
+            if chrom not in tabix_file.contigs:
+                return
+            for line in tabix_file.fetch(chrom, start, end):
+                yield line.encode('utf-8') + b'\n'
+        finally:
+            tabix_file.close()
+
+
+def _fill(windows):
+    """
+    Give windows without any lines the offset of the next window with lines,
+    as no line overlapping a region that starts within them comes before it
+    """
+    filled = np.zeros(len(windows), dtype=np.uint64)
+    following = 0
+    for window in range(len(windows) - 1, -1, -1):
+        if windows[window] is not None:
+            following = windows[window]
+        filled[window] = following
+    return filled
+
+
+def index_path(file_path, index_dir=None, suffix=INDEX_SUFFIX):
+    """
+    Location of an index for a file, either next to the file or in
+    `index_dir`
+    """
+    if index_dir is None:
+        return file_path + suffix
+    digest = hashlib.sha1(os.path.realpath(file_path).encode('utf-8')).hexdigest()
+    return os.path.join(index_dir, digest + suffix)
+
+
+def open_index(file_path, columns, index_dir=None):
+    """
+    Get an index for reading regions from a file. An existing tabix index is
+    used where there is one, read by pysam if it is installed. Otherwise the
+    native index is loaded, or built and saved if it is missing or out of
+    date. The index is only kept in memory if it cannot be saved.
+
+    Parameters
+    ----------
+    file_path : str
+    columns : Columns
+        Location columns used when building a native index
+    index_dir : str
+        Directory for the native indexes. If None they are saved next to
+        the files.
+
+    Returns
+    -------
+    TabixIndex or PysamIndex
+    """
+    tabix_paths = [file_path + '.tbi', file_path + '.csi']
+    if pysam is not None and any(os.path.isfile(p) for p in tabix_paths):
+        return PysamIndex()
+    if os.path.isfile(tabix_paths[0]) and is_bgzf(file_path):
+        return TabixIndex.from_tbi(tabix_paths[0])
+
+    stat = os.stat(file_path)
+    path = index_path(file_path, index_dir)
+    if os.path.isfile(path):
+        try:
+            index = TabixIndex.load(path, stat)
+        except (IOError, OSError, ValueError, KeyError):
+            index = None
+        if index is not None:
+            return index
+
+    index = TabixIndex.build(file_path, columns)
+    try:
+        index.save(path, stat)
+    except (IOError, OSError):
+        pass
+    return index
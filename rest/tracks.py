@@ -0,0 +1,271 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import io
+
+import numpy as np
+
+from rest.region_index import covered_bases
+
+try:
+    import pyBigWig
+except ImportError:
+    pyBigWig = None
+
+
+TRACK_FILE_TYPES = {
+    'bw': 'bigwig',
+    'bigwig': 'bigwig',
+    'bb': 'bigbed',
+    'bigbed': 'bigbed',
+}
+
+SUMMARY_TYPES = ['mean', 'min', 'max', 'std', 'coverage', 'sum']
+
+NPZ_MIMETYPE = 'application/x-npz'
+
+
+class TrackError(Exception):
+    """
+    Raised when the requested region cannot be read from a track file. The
+    message is returned to the client as the error.
+    """
+    pass
+
+
+def parse_region(region):
+    """
+    Parse a region in the form chrom:start:end
+
+    Returns
+    -------
+    tuple
+        (chrom, start, end)
+
+    Raises
+    ------
+    ValueError
+        If the region is not valid
+    """
+    chrom, start, end = region.split(':')
+    start, end = int(start), int(end)
+    if start < 0 or end <= start:
+        raise ValueError('Invalid region')
+    return chrom, start, end
+
+
+def track_type(file_type):
+    """
+    Get the kind of track for a file type
+
+    Returns
+    -------
+    str
+        'bigwig', 'bigbed' or None if the file type is not a track
+    """
+    return TRACK_FILE_TYPES.get(str(file_type).lower())
+
+
+def open_track(file_path):
+    """
+    Open a bigWig or bigBed file with pyBigWig
+    """
+    if pyBigWig is None:
+        raise TrackError('TrackReaderUnavailable')
+    try:
+        handle = pyBigWig.open(file_path)
+    except RuntimeError:
+        handle = None
+    if handle is None:
+        raise TrackError('TrackUnreadable')
+    return handle
+
+
+def _clip(handle, chrom, start, end):
+    chrom_size = handle.chroms(chrom)
+    if chrom_size is None:
+        raise TrackError('UnknownChromosome')
+    end = min(end, chrom_size)
+    if start >= end:
+        raise TrackError('InvalidRegion')
+    return end
+
+
+def read_bigwig(handle, chrom, start, end, bins=None, summary='mean', max_values=1000000):
+    """
+    Read the signal for a region of a bigWig file
+
+    Without bins the value of every base is returned. With bins the region is
+    summarised into that many equal width bins. When the bins are wider than
+    the resolution of one of the zoom levels in the file the summaries are
+    read from that zoom level rather than from the raw data.
+
+    Parameters
+    ----------
+    handle : pyBigWig
+        Open bigWig file
+    chrom : str
+    start : int
+    end : int
+    bins : int
+        Number of bins to summarise the region into
+    summary : str
+        One of SUMMARY_TYPES
+    max_values : int
+        Largest number of values or bins that can be returned
+
+    Returns
+    -------
+    dict
+        The region that was read and a float32 `values` array, with NaN for
+        bases or bins without data
+    """
+    end = _clip(handle, chrom, start, end)
+    if bins is None:
+        if end - start > max_values:
+            raise TrackError('RegionTooLarge')
+        values = handle.values(chrom, start, end, numpy=True)
+    else:
+        if bins > max_values:
+            raise TrackError('TooManyBins')
+        bins = min(bins, end - start)
+        values = handle.stats(chrom, start, end, type=summary, nBins=bins, exact=False)
+    return {
+        'chrom': chrom,
+        'start': start,
+        'end': end,
+        'bins': bins,
+        'values': np.asarray(values, dtype=np.float32)
+    }
+
+
+def read_bigbed(handle, chrom, start, end, bins=None, max_values=1000000):
+    """
+    Read the features overlapping a region of a bigBed file
+
+    Without bins the features are returned as `starts`, `ends` and the
+    remaining BED `fields` of each feature. With bins the number of features
+    overlapping each of the equal width bins is returned as `counts`.
+
+    Returns
+    -------
+    dict
+    """
+    end = _clip(handle, chrom, start, end)
+    entries = handle.entries(chrom, start, end) or []
+    starts = np.fromiter((e[0] for e in entries), dtype=np.int64, count=len(entries))
+    ends = np.fromiter((e[1] for e in entries), dtype=np.int64, count=len(entries))
+
+    result = {'chrom': chrom, 'start': start, 'end': end, 'bins': bins}
+    if bins is None:
+        if len(entries) > max_values:
+            raise TrackError('RegionTooLarge')
+        result['starts'] = starts
+        result['ends'] = ends
+        result['fields'] = [e[2] if len(e) > 2 else '' for e in entries]
+        return result
+
+    if bins > max_values:
+        raise TrackError('TooManyBins')
+    bins = min(bins, end - start)
+    result['bins'] = bins
+
+    # Each feature covers the bins from the one holding its start to the one
+    # holding its last base, counted with a difference array
+    width = (end - start) / float(bins)
+    first = np.clip(((np.maximum(starts, start) - start) / width).astype(np.int64), 0, bins - 1)
+    last = np.clip(((np.minimum(ends, end) - 1 - start) / width).astype(np.int64), 0, bins - 1)
+    diff = np.zeros(bins + 1, dtype=np.int64)
+    np.add.at(diff, first, 1)
+    np.add.at(diff, last + 1, -1)
+    result['counts'] = np.cumsum(diff[:-1]).astype(np.int32)
+    return result
+
+
+def bigwig_stats(handle, chrom, start, end):
+    """
+    Summarise the signal of a bigWig file over a region, using the zoom
+    levels of the file where possible
+
+    Returns
+    -------
+    dict
+        `min`, `mean` and `max` of the signal, None if there is no data, and
+        the number of bases with data as `bases_covered`
+    """
+    end = _clip(handle, chrom, start, end)
+    stats = {}
+    for summary in ('min', 'mean', 'max', 'coverage'):
+        value = handle.stats(chrom, start, end, type=summary, nBins=1, exact=False)[0]
+        stats[summary] = None if value is None or np.isnan(value) else float(value)
+    coverage = stats.pop('coverage') or 0.0
+    stats['bases_covered'] = int(round(coverage * (end - start)))
+    return stats
+
+
+def bigbed_stats(handle, chrom, start, end):
+    """
+    Count the features of a bigBed file overlapping a region and the bases of
+    the region that they cover
+
+    Returns
+    -------
+    dict
+    """
+    result = read_bigbed(handle, chrom, start, end, max_values=np.inf)
+    starts = result['starts']
+    return {
+        'features': len(starts),
+        'bases_covered': int(covered_bases(
+            np.zeros(len(starts), dtype=np.int64), starts, result['ends'],
+            start, result['end']).sum())
+    }
+
+
+def to_json(result):
+    """
+    Convert the arrays in a result into lists, with NaN as None
+    """
+    converted = {}
+    for key, value in result.items():
+        if isinstance(value, np.ndarray):
+            if value.dtype.kind == 'f':
+                value = np.where(np.isnan(value), None, value.astype(object))
+            value = value.tolist()
+        converted[key] = value
+    return converted
+
+
+def to_npz(result):
+    """
+    Serialise the arrays in a result as an uncompressed .npz file that can be
+    read with numpy.load. The other values are included as 0-d arrays.
+
+    Returns
+    -------
+    bytes
+    """
+    arrays = {}
+    for key, value in result.items():
+        if value is None:
+            continue
+        arrays[key] = value if isinstance(value, np.ndarray) else np.array(value)
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
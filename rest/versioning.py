@@ -0,0 +1,195 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import threading
+import time
+import zlib
+
+# Number of shared counters that users, and their assemblies, are hashed to
+# when the service runs as several processes
+VERSION_SLOTS = 4096
+
+
+class VersionTracker(object):
+    """
+    Version counters for each user and file that are bumped whenever the
+    files are changed through the API. The counters are combined with the
+    request to build ETags, so a response stays valid until one of the write
+    paths bumps a counter that it depends on.
+
+    The epoch is unique to each instance so that ETags handed out before a
+    restart are never matched.
+
+    When the service runs as several processes a shared generation counter
+    can be attached with share(). Every write in any process then bumps the
+    shared counter, which is included in all ETags, so that a process never
+    returns 304 for a response that another process has changed. Writes also
+    bump shared counters for the user and assemblies that were changed, so
+    that other processes only drop the caches for those.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch = '{:x}.{}'.format(int(time.time() * 1e6), os.getpid())
+        self._users = {}
+        self._files = {}
+        self._shared = None
+        self._seen = 0
+        self._slots = None
+        self._seen_slots = None
+
+    def share(self, shared, slots=None):
+        """
+        Attach a generation counter shared between processes
+
+        Parameters
+        ----------
+        shared : multiprocessing.Value
+            Integer value created before the worker processes are forked
+        slots : multiprocessing.Array
+            VERSION_SLOTS integers, without their own lock, created before
+            the worker processes are forked. If None any change made by
+            another process is taken to affect every user.
+        """
+        self._shared = shared
+        self._epoch = 'shared'
+        with shared.get_lock():
+            self._seen = shared.value
+            self._slots = slots
+            self._seen_slots = slots[:] if slots is not None else None
+
+    def generation(self):
+        """
+        Current value of the shared generation counter, or 0 if there is none
+        """
+        return self._shared.value if self._shared is not None else 0
+
+    @staticmethod
+    def _slot(user_id, assembly=None):
+        """
+        Shared counter for the files of a user on an assembly, or for any of
+        the files of the user if the assembly is None
+        """
+        key = str(user_id) + '\n' + (str(assembly) if assembly is not None else '')
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % VERSION_SLOTS
+
+    def changed_elsewhere(self):
+        """
+        Check whether another process has made changes since the last call
+
+        Returns
+        -------
+        function
+            Called with a user id, and optionally an assembly, it returns True
+            if another process may have changed the files for them. Without an
+            assembly it is True only for changes that could affect any of
+            the files of the user, such as removing files. None if no changes
+            have been made.
+        """
+        if self._shared is None:
+            return None
+        with self._lock:
+            with self._shared.get_lock():
+                generation = self._shared.value
+                if generation == self._seen:
+                    return None
+                self._seen = generation
+                if self._slots is None:
+                    return lambda user_id, assembly=None: True
+                current = self._slots[:]
+
+            changed = set(
+                slot for slot, (now, seen) in enumerate(zip(current, self._seen_slots))
+                if now != seen)
+            self._seen_slots = current
+
+        def _stale(user_id, assembly=None):
+            if self._slot(user_id) in changed:
+                return True
+            return assembly is not None and self._slot(user_id, assembly) in changed
+        return _stale
+
+    def bump(self, user_id, file_ids=None, assemblies=None):
+        """
+        Record that files for a user have changed
+
+        Parameters
+        ----------
+        user_id : str
+            User identifier
+        file_ids : list
+            IDs of the files that have been changed or removed
+        assemblies : list
+            Assemblies of the files that have been added or whose intervals
+            have changed. If None the change can affect any of the files of
+            the user.
+        """
+        if assemblies is None:
+            slots = [self._slot(user_id)]
+        else:
+            slots = [self._slot(user_id, a) for a in set(assemblies) if a is not None]
+
+        with self._lock:
+            self._users[user_id] = self._users.get(user_id, 0) + 1
+            for file_id in file_ids or []:
+                self._files[file_id] = self._files.get(file_id, 0) + 1
+
+            if self._shared is not None:
+                with self._shared.get_lock():
+                    if self._slots is not None:
+                        # Changes made by this process are not stale here
+                        for slot in slots:
+                            self._slots[slot] += 1
+                            self._seen_slots[slot] += 1
+                    self._shared.value += 1
+                    # Only skip ahead if no other process has changed anything
+                    if self._shared.value == self._seen + 1:
+                        self._seen = self._shared.value
+
+    def etag(self, request_key, user_id, file_id=None):
+        """
+        Build an ETag for a response
+
+        Parameters
+        ----------
+        request_key : str
+            Identifies the request, e.g. the path and query string
+        user_id : str
+            User whose files the response is built from
+        file_id : str
+            If the response only depends on a single file, the ID of that file.
+            Otherwise the response depends on all files for the user.
+
+        Returns
+        -------
+        str
+            ETag value without quotes
+        """
+        with self._lock:
+            if self._shared is not None:
+                version = 'g{}'.format(self._shared.value)
+            elif file_id is None:
+                version = 'u{}'.format(self._users.get(user_id, 0))
+            else:
+                version = 'f{}'.format(self._files.get(file_id, 0))
+
+        key = '\n'.join([self._epoch, request_key, str(user_id), version])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
@@ -24,7 +24,7 @@ setup(
     packages=['rest'],
     include_package_data=True,
     install_requires=[
-        'flask', 'flask_restful', 'waitress', 'pytest', 'pylint'
+        'flask', 'flask_restful', 'waitress', 'numpy', 'pytest', 'pylint'
     ],
     setup_requires=[
         'pytest-runner',
@@ -32,4 +32,9 @@ setup(
     tests_require=[
         'pytest',
     ],
+    entry_points={
+        'console_scripts': [
+            'mg-rest-dm-serve = rest.serve:main',
+        ],
+    },
 )
@@ -21,3 +21,7 @@ BASEDIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, BASEDIR + '/../')
 
 from rest import app
+
+# The files of the test user are held in memory, so snapshots of their region
+# indexes would be out of date in the next test run
+app.REGION_INDEX.snapshot_dir = None
@@ -0,0 +1,122 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import tempfile
+import json
+import zlib
+import pytest
+
+from context import app
+
+@pytest.fixture
+def client(request, monkeypatch):
+    """
+    Definges the client object to make requests against
+    """
+    db_fd, app.APP.config['DATABASE'] = tempfile.mkstemp()
+    app.APP.config['TESTING'] = True
+    client = app.APP.test_client()
+    # Compress every response, however small
+    monkeypatch.setitem(app.APP.config, 'COMPRESS_MIN_SIZE', 0)
+
+    def teardown():
+        """
+        Close the client once testing has completed
+        """
+        os.close(db_fd)
+        os.unlink(app.APP.config['DATABASE'])
+    request.addfinalizer(teardown)
+
+    return client
+
+def _vary(rest_value):
+    """
+    Header names listed in the Vary header
+    """
+    return [h.strip().lower() for h in rest_value.headers.get('Vary', '').split(',')]
+
+def test_compression_01(client):
+    """
+    Test that responses are compressed with the encoding that the client
+    accepts and that the ETag differs for each encoding
+    """
+    url = '/mug/api/dmp/files?by_user=1'
+    headers = dict(Authorization='Authorization: Bearer teststring')
+
+    rest_value = client.get(url, headers=headers)
+    assert 'Content-Encoding' not in rest_value.headers
+    assert _vary(rest_value).count('accept-encoding') == 1
+    details = json.loads(rest_value.data)
+    etag = rest_value.headers['ETag']
+
+    for encoding, wbits in [('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)]:
+        rest_value = client.get(url, headers=dict(headers, **{'Accept-Encoding': encoding}))
+        assert rest_value.status_code == 200
+        assert rest_value.headers['Content-Encoding'] == encoding
+        assert _vary(rest_value).count('accept-encoding') == 1
+        assert rest_value.headers['ETag'] == etag[:-1] + '-' + encoding + '"'
+        assert json.loads(zlib.decompress(rest_value.data, wbits)) == details
+
+    # Streamed responses are compressed as they are sent
+    rest_value = client.get(
+        url + '&stream=1', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+    assert rest_value.headers['Content-Encoding'] == 'gzip'
+    streamed = json.loads(zlib.decompress(rest_value.data, 16 + zlib.MAX_WBITS))
+    assert streamed['files'] == details['files']
+
+def test_compression_02(client):
+    """
+    Test that a 304 returns the ETag that matched and the Vary header
+    """
+    url = '/mug/api/dmp/files?by_user=1'
+    headers = dict(Authorization='Authorization: Bearer teststring')
+
+    for accept_encoding in ['identity', 'gzip']:
+        request_headers = dict(headers, **{'Accept-Encoding': accept_encoding})
+        rest_value = client.get(url, headers=request_headers)
+        etag = rest_value.headers['ETag']
+
+        rest_value = client.get(url, headers=dict(request_headers, **{'If-None-Match': etag}))
+        assert rest_value.status_code == 304
+        assert rest_value.headers['ETag'] == etag
+        assert 'accept-encoding' in _vary(rest_value)
+
+def test_compression_03(client, monkeypatch):
+    """
+    Test that changes to the compression config apply to the next request
+    """
+    url = '/mug/api/dmp/files?by_user=1'
+    headers = {
+        'Authorization': 'Authorization: Bearer teststring', 'Accept-Encoding': 'gzip'}
+
+    monkeypatch.setitem(app.APP.config, 'COMPRESS_MIN_SIZE', 10 ** 9)
+    rest_value = client.get(url, headers=headers)
+    assert 'Content-Encoding' not in rest_value.headers
+    details = json.loads(rest_value.data)
+
+    monkeypatch.setitem(app.APP.config, 'COMPRESS_MIN_SIZE', 0)
+    sizes = []
+    for level in [1, 9]:
+        monkeypatch.setitem(app.APP.config, 'COMPRESS_LEVEL', level)
+        rest_value = client.get(url, headers=headers)
+        assert rest_value.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(zlib.decompress(rest_value.data, 16 + zlib.MAX_WBITS)) == details
+        sizes.append(len(rest_value.data))
+    assert sizes[0] >= sizes[1]
@@ -18,6 +18,7 @@
 from __future__ import print_function
 
 import os
+import shutil
 import tempfile
 import json
 import bson
@@ -78,3 +79,224 @@ def test_file_02(client):
         print(rest_value.status_code, details["_id"])
         print("ObjectId:", str(ObjectId(str(file_id))))
         assert str(details["_id"]) == str(ObjectId(str(file_id)))
+
+def test_file_03(client, request):
+    """
+    Test that the original file is returned whole and as byte ranges
+    """
+    file_dir = tempfile.mkdtemp()
+    file_path = os.path.join(file_dir, 'test.fastq')
+    with open(file_path, 'wb') as handle:
+        handle.write(b'0123456789' * 10)
+
+    def teardown():
+        app.APP.config['ORIGINAL_FILE_ROOTS'] = None
+        shutil.rmtree(file_dir)
+    request.addfinalizer(teardown)
+
+    headers = dict(Authorization='Authorization: Bearer teststring')
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps({
+            'file_path': file_path, 'file_type': 'fastq', 'data_type': 'RNA-seq',
+            'taxon_id': 9606, 'source_id': [], 'meta_data': {'assembly': 'GRCh38'}
+        }),
+        headers=headers, content_type='application/json')
+    url = '/mug/api/dmp/file_meta?output=original&file_id=' + json.loads(rest_value.data)
+
+    # Files are only served from the configured directories
+    rest_value = client.get(url, headers=headers)
+    assert json.loads(rest_value.data)['status_code'] == 403
+
+    app.APP.config['ORIGINAL_FILE_ROOTS'] = [file_dir]
+    rest_value = client.get(url, headers=headers)
+    assert rest_value.status_code == 200
+    assert rest_value.data == b'0123456789' * 10
+    assert rest_value.headers['Content-Length'] == '100'
+    etag = rest_value.headers['ETag']
+
+    rest_value = client.get(url, headers=dict(headers, Range='bytes=5-14'))
+    assert rest_value.status_code == 206
+    assert rest_value.data == b'5678901234'
+    assert rest_value.headers['Content-Range'] == 'bytes 5-14/100'
+
+    rest_value = client.get(url, headers=dict(headers, Range='bytes=0-1,-2'))
+    assert rest_value.status_code == 206
+    assert rest_value.mimetype == 'multipart/byteranges'
+    assert len(rest_value.data) == int(rest_value.headers['Content-Length'])
+    assert b'Content-Range: bytes 98-99/100\r\n\r\n89' in rest_value.data
+
+    rest_value = client.get(url, headers=dict(headers, Range='bytes=200-'))
+    assert rest_value.status_code == 416
+
+    rest_value = client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+    assert rest_value.status_code == 304
+
+def _register_files(client, count, **kwargs):
+    """
+    Register files for the test user and return their ids
+    """
+    new_files = [dict({
+        'file_path': '/tmp/test/file_' + str(i) + '.bw',
+        'file_type': 'bw',
+        'data_type': 'RNA-seq',
+        'taxon_id': 9606,
+        'source_id': [],
+        'meta_data': {'assembly': 'GRCh38', 'visible': True}
+    }, **kwargs) for i in range(count)]
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps(new_files),
+        headers=dict(Authorization='Authorization: Bearer teststring'),
+        content_type='application/json')
+    return [result['file_id'] for result in json.loads(rest_value.data)['files']]
+
+def _get_file(client, file_id):
+    """
+    Get the meta data for a file
+    """
+    rest_value = client.get(
+        '/mug/api/dmp/file_meta?file_id=' + file_id,
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    return json.loads(rest_value.data)
+
+def test_file_04(client):
+    """
+    Test that meta data keys are added and removed for several files at once
+    """
+    file_ids = _register_files(client, 2)
+    headers = dict(Authorization='Authorization: Bearer teststring')
+
+    rest_value = client.put(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps({
+            'file_id': file_ids, 'type': 'patch_meta',
+            'add_meta': {'cell_type': 'HeLa', 'replicate': 2},
+            'remove_meta': ['visible']
+        }),
+        headers=headers, content_type='application/json')
+    assert json.loads(rest_value.data) == file_ids
+
+    for file_id in file_ids:
+        meta_data = _get_file(client, file_id)['meta_data']
+        assert meta_data['cell_type'] == 'HeLa'
+        assert meta_data['replicate'] == 2
+        assert 'visible' not in meta_data
+        assert meta_data['assembly'] == 'GRCh38'
+
+    # A key cannot be both added and removed, and nothing is changed
+    rest_value = client.put(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps({
+            'file_id': file_ids, 'type': 'patch_meta',
+            'add_meta': {'cell_type': 'K562'}, 'remove_meta': ['cell_type']
+        }),
+        headers=headers, content_type='application/json')
+    assert json.loads(rest_value.data)['status_code'] == 400
+    for file_id in file_ids:
+        assert _get_file(client, file_id)['meta_data']['cell_type'] == 'HeLa'
+
+def test_file_05():
+    """
+    Test that the meta data for all of the files is changed in one update
+    when the DM API client exposes its database
+    """
+    mongomock = pytest.importorskip('mongomock')
+
+    class _Client(object):
+        """
+        DM API client that exposes its database
+        """
+        db = mongomock.MongoClient().dmp
+
+    dmp_api = _Client()
+    file_ids = [str(f_id) for f_id in dmp_api.db.entries.insert_many([
+        {'user_id': user_id, 'meta_data': {'assembly': 'GRCh38', 'visible': True}}
+        for user_id in ['test', 'test', 'other']
+    ]).inserted_ids]
+
+    updates = []
+    update_many = dmp_api.db.entries.update_many
+
+    def _update_many(*args, **kwargs):
+        updates.append(args)
+        return update_many(*args, **kwargs)
+    dmp_api.db.entries.update_many = _update_many
+
+    assert app.patch_file_metadata(
+        dmp_api, 'test', file_ids, {'cell_type': 'HeLa'}, ['visible']) == file_ids
+    assert len(updates) == 1
+
+    records = {str(r['_id']): r['meta_data'] for r in dmp_api.db.entries.find()}
+    for file_id in file_ids[:2]:
+        assert records[file_id] == {'assembly': 'GRCh38', 'cell_type': 'HeLa'}
+    assert records[file_ids[2]] == {'assembly': 'GRCh38', 'visible': True}
+
+    with pytest.raises(ValueError):
+        app.patch_file_metadata(dmp_api, 'test', file_ids, {'visible': False}, ['visible'])
+    assert len(updates) == 1
+
+def test_file_06(client):
+    """
+    Test that files are removed in bulk by id and by filter, and that a dry
+    run leaves them in place
+    """
+    parent_ids = _register_files(client, 1)
+    file_ids = _register_files(client, 3, source_id=parent_ids)
+    headers = dict(Authorization='Authorization: Bearer teststring')
+
+    def _delete(data):
+        rest_value = client.delete(
+            '/mug/api/dmp/file_meta', data=json.dumps(data),
+            headers=headers, content_type='application/json')
+        assert rest_value.mimetype == 'application/x-ndjson'
+        return [json.loads(line) for line in rest_value.data.splitlines()]
+
+    results = _delete({'filter': {'source_id': parent_ids[0]}, 'dry_run': True})
+    assert sorted(r['file_id'] for r in results) == sorted(file_ids)
+    assert set(r['status'] for r in results) == set(['would_delete'])
+    for file_id in file_ids:
+        assert _get_file(client, file_id)['_id'] == file_id
+
+    results = _delete({'file_ids': [file_ids[0], 'missing0000']})
+    assert results == [
+        {'file_id': file_ids[0], 'status': 'deleted'},
+        {'file_id': 'missing0000', 'status': 'not_found'}
+    ]
+
+    results = _delete({'filter': {'source_id': parent_ids[0]}})
+    assert sorted(r['file_id'] for r in results) == sorted(file_ids[1:])
+    assert set(r['status'] for r in results) == set(['deleted'])
+
+    results = _delete({'file_ids': file_ids, 'dry_run': True})
+    assert set(r['status'] for r in results) == set(['not_found'])
+    assert _get_file(client, parent_ids[0])['_id'] == parent_ids[0]
+
+    rest_value = client.delete(
+        '/mug/api/dmp/file_meta', data=json.dumps({'filter': {'taxon_id': 9606}}),
+        headers=headers, content_type='application/json')
+    assert json.loads(rest_value.data)['status_code'] == 400
+
+def test_file_07(client, monkeypatch):
+    """
+    Test that the files removed by a bulk delete are removed from the region
+    index once for each chunk
+    """
+    file_ids = _register_files(client, 3)
+    monkeypatch.setitem(app.APP.config, 'DM_BATCH_SIZE', 2)
+    removed = []
+    remove_files = app.REGION_INDEX.remove_files
+
+    def _remove_files(user_id, deleted):
+        removed.append(list(deleted))
+        remove_files(user_id, deleted)
+    monkeypatch.setattr(app.REGION_INDEX, 'remove_files', _remove_files)
+
+    rest_value = client.delete(
+        '/mug/api/dmp/file_meta', data=json.dumps({'file_ids': file_ids}),
+        headers=dict(Authorization='Authorization: Bearer teststring'),
+        content_type='application/json')
+    results = [json.loads(line) for line in rest_value.data.splitlines()]
+    assert set(r['status'] for r in results) == set(['deleted'])
+    assert removed == [file_ids[:2], file_ids[2:]]
@@ -66,3 +66,27 @@ def test_file_history_01(client):
         print("HISTORY RESULTS:", history_results)
 
         assert 'history_files' in history_results
+
+def test_file_history_02(client):
+    """
+    Test that the whole lineage of a file is returned as a DAG
+    """
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    results = json.loads(rest_value.data)
+
+    for result in results['files']:
+        rest_value = client.get(
+            '/mug/api/dmp/file_history?depth=0&file_id=' + result['_id'],
+            headers=dict(Authorization='Authorization: Bearer teststring')
+        )
+        history_results = json.loads(rest_value.data)
+
+        assert 'nodes' in history_results
+        assert 'edges' in history_results
+        assert history_results['nodes'][0]['_id'] == result['_id']
+
+        node_ids = [node['_id'] for node in history_results['nodes']]
+        assert len(node_ids) == len(set(node_ids))
@@ -17,12 +17,22 @@
 
 from __future__ import print_function
 
+import contextlib
+import datetime
+import multiprocessing
 import os
+import shutil
 import tempfile
+import threading
+import time
 import json
 import pytest
 
 from context import app
+from rest import dm_store
+from rest.lineage import LineageCache
+from rest.region_index import RegionIndex
+from rest.versioning import VERSION_SLOTS, VersionTracker
 
 @pytest.fixture
 def client(request):
@@ -43,6 +53,15 @@ def client(request):
 
     return client
 
+class _EntriesClient(object):
+    """
+    DM API client that exposes its database, as the DM API does in test mode
+    """
+
+    def __init__(self):
+        mongomock = pytest.importorskip('mongomock')
+        self.db = mongomock.MongoClient().dmp
+
 def _run_tests(details):
     """
     """
@@ -76,3 +95,525 @@ def test_files_02(client):
     details = json.loads(rest_value.data)
     print(details)
     _run_tests(details)
+
+def test_files_03(client):
+    """
+    Test that paging through the files for a user returns every file once
+    """
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    all_files = [f['_id'] for f in json.loads(rest_value.data)['files']]
+
+    paged_files = []
+    url = '/mug/api/dmp/files?by_user=1&limit=1'
+    while url is not None:
+        rest_value = client.get(
+            url,
+            headers=dict(Authorization='Authorization: Bearer teststring')
+        )
+        details = json.loads(rest_value.data)
+        assert len(details['files']) <= 1
+        paged_files += [f['_id'] for f in details['files']]
+        url = details['_links'].get('_next')
+
+    assert sorted(paged_files) == sorted(all_files)
+
+def test_files_04(client):
+    """
+    Test that the streamed listing returns the same files
+    """
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1&stream=1',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    details = json.loads(rest_value.data)
+    _run_tests(details)
+
+def test_files_05(client):
+    """
+    Test that the assembly, file type and data type filters can be combined
+    """
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    file_meta = json.loads(rest_value.data)['files'][0]
+
+    rest_value = client.get(
+        '/mug/api/dmp/files?assembly=' + file_meta['meta_data']['assembly'] +
+        '&file_type=' + file_meta['file_type'] + '&data_type=' + file_meta['data_type'],
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    details = json.loads(rest_value.data)
+    _run_tests(details)
+
+    for result in details['files']:
+        assert result['file_type'] == file_meta['file_type']
+        assert result['data_type'] == file_meta['data_type']
+
+def test_files_06(client):
+    """
+    Test that repeating a request with the returned ETag gives a 304
+    """
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    etag = rest_value.headers.get('ETag')
+    assert etag is not None
+
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1',
+        headers={
+            'Authorization': 'Authorization: Bearer teststring',
+            'If-None-Match': etag
+        }
+    )
+    assert rest_value.status_code == 304
+
+def test_files_07(client, monkeypatch):
+    """
+    Test that concurrent identical requests share a single query
+    """
+    requests = 8
+    calls = []
+    find_files = app.find_files
+
+    def _find_files(*args, **kwargs):
+        calls.append(args)
+        # Hold the query until the other requests are waiting for it
+        timeout = time.time() + 5
+        while app.SINGLE_FLIGHT.stats()['waiting'] < requests - 1 and time.time() < timeout:
+            time.sleep(0.01)
+        return find_files(*args, **kwargs)
+    monkeypatch.setattr(app, 'find_files', _find_files)
+
+    results = []
+
+    def _get():
+        rest_value = app.APP.test_client().get(
+            '/mug/api/dmp/files?assembly=GRCh38&file_type=bw',
+            headers=dict(Authorization='Authorization: Bearer teststring'))
+        results.append((rest_value.status_code, rest_value.data))
+
+    threads = [threading.Thread(target=_get) for _ in range(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(results) == requests
+    assert len(set(results)) == 1
+    assert 'files' in json.loads(results[0][1])
+
+def test_files_08():
+    """
+    Test that records read directly from the store can be serialised as JSON
+    """
+    dmp_api = _EntriesClient()
+    dmp_api.db.entries.insert_many([{
+        'user_id': 'test', 'file_path': '/tmp/test.bw', 'file_type': 'bw',
+        'data_type': 'RNA-seq', 'taxon_id': 9606, 'source_id': [],
+        'meta_data': {'assembly': 'GRCh38'},
+        'creation_time': datetime.datetime(2018, 1, 1)
+    } for _ in range(3)])
+
+    records = list(dm_store.iter_files_by_user(dmp_api, 'test', limit=2))
+    assert len(records) == 2
+    json.dumps(records)
+    assert records[0]['creation_time'] == str(datetime.datetime(2018, 1, 1))
+
+def test_files_09():
+    """
+    Test that filtered listings are normalised whichever path serves them
+    """
+    dmp_api = _EntriesClient()
+    dmp_api.db.entries.insert_one({
+        'user_id': 'test', 'file_path': '/tmp/test.bw', 'file_type': 'bw',
+        'data_type': 'RNA-seq', 'taxon_id': 9606, 'source_id': [],
+        'meta_data': {'assembly': 'GRCh38'},
+        'creation_time': datetime.datetime(2018, 1, 1)
+    })
+    records = dm_store.find_files(dmp_api, 'test', {'assembly': 'GRCh38'})
+    assert len(records) == 1
+    json.dumps(records)
+
+    class _Client(object):
+        """
+        DM API client without direct access to its database
+        """
+
+        @staticmethod
+        def get_files_by_assembly(user_id, assembly):
+            """
+            Get the files for an assembly
+            """
+            return list(dmp_api.db.entries.find(
+                {'user_id': user_id, 'meta_data.assembly': assembly}))
+
+    records = dm_store.find_files(_Client(), 'test', {'assembly': 'GRCh38'})
+    assert len(records) == 1
+    json.dumps(records)
+
+def test_files_10(client):
+    """
+    Test that files registered in bulk can be read back
+    """
+    new_files = [{
+        'file_path': '/tmp/test/bulk_' + str(i) + '.bw',
+        'file_type': 'bw',
+        'data_type': 'RNA-seq',
+        'taxon_id': 9606,
+        'source_id': [],
+        'meta_data': {'assembly': 'GRCh38'}
+    } for i in range(3)]
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps(new_files),
+        content_type='application/json',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    results = json.loads(rest_value.data)['files']
+    assert [r['index'] for r in results] == [0, 1, 2]
+    file_ids = [r['file_id'] for r in results]
+
+    for file_id, new_file in zip(file_ids, new_files):
+        rest_value = client.get(
+            '/mug/api/dmp/file_meta?file_id=' + file_id,
+            headers=dict(Authorization='Authorization: Bearer teststring')
+        )
+        assert rest_value.status_code == 200
+        details = json.loads(rest_value.data)
+        assert details['file_path'] == new_file['file_path']
+
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    assert rest_value.status_code == 200
+    listed = [f['_id'] for f in json.loads(rest_value.data)['files']]
+    assert set(file_ids) <= set(listed)
+
+def test_files_11():
+    """
+    Test that files are looked up by id with a single query for each chunk
+    """
+    dmp_api = _EntriesClient()
+    file_ids = [str(f_id) for f_id in dmp_api.db.entries.insert_many([{
+        'user_id': user_id, 'file_path': '/tmp/test_' + str(i) + '.bw',
+        'meta_data': {'assembly': 'GRCh38'},
+        'creation_time': datetime.datetime(2018, 1, 1)
+    } for i, user_id in enumerate(['test', 'test', 'test', 'other'])]).inserted_ids]
+
+    queries = []
+    find = dmp_api.db.entries.find
+
+    def _find(*args, **kwargs):
+        queries.append(args[0])
+        return find(*args, **kwargs)
+    dmp_api.db.entries.find = _find
+
+    requested = [file_ids[2], file_ids[0], file_ids[2], file_ids[3], file_ids[1]]
+    records = dm_store.get_files_by_ids(dmp_api, 'test', requested, chunk_size=2)
+    assert [r['_id'] for r in records] == [file_ids[2], file_ids[0], file_ids[1]]
+    json.dumps(records)
+    assert len(queries) == 2
+
+def test_files_12():
+    """
+    Test that files are looked up concurrently on a shared pool when the DM
+    API client does not expose its database
+    """
+    lock = threading.Lock()
+    active = [0, 0]
+
+    class _Client(object):
+        """
+        DM API client without direct access to its database
+        """
+
+        @staticmethod
+        def get_file_by_id(user_id, file_id):
+            """
+            Get a file, or None if it is not one of the user's files
+            """
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            if user_id != 'test' or file_id == 'missing':
+                return None
+            return {'_id': file_id, 'user_id': user_id}
+
+    requested = ['f3', 'f1', 'missing', 'f2', 'f1', 'f4']
+    records = dm_store.get_files_by_ids(_Client(), 'test', requested, max_workers=3)
+    assert [r['_id'] for r in records] == ['f3', 'f1', 'f2', 'f4']
+    assert 1 < active[1] <= 3
+
+    # The lookups of later requests run on the same threads
+    pool = dm_store.get_lookup_pool(3)
+    dm_store.get_files_by_ids(_Client(), 'test', requested, max_workers=3)
+    assert dm_store.get_lookup_pool(3) is pool
+    dm_store.shutdown_lookup_pool()
+    assert dm_store.get_lookup_pool(3) is not pool
+
+    active[1] = 0
+    records = dm_store.get_files_by_ids(_Client(), 'test', requested, max_workers=1)
+    assert [r['_id'] for r in records] == ['f3', 'f1', 'f2', 'f4']
+    assert active[1] == 1
+
+def test_files_13(client, monkeypatch):
+    """
+    Test that region queries return the files in the HDF5 index as well as
+    those with indexed intervals
+    """
+    def _get_hdf5_regions(self, user_id, assembly, regions):  # pylint: disable=unused-argument
+        """
+        HDF5 index with the same files for every region
+        """
+        return [{1: ['h5_file_1'], 1000: ['h5_file_2']} for _ in regions]
+    monkeypatch.setattr(app.Files, '_get_hdf5_regions', _get_hdf5_regions)
+
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps({
+            'file_path': '/tmp/test/merge.bed', 'file_type': 'bed', 'data_type': 'ChIP-seq',
+            'taxon_id': 9606, 'source_id': [],
+            'meta_data': {'assembly': 'test_merge', 'chrom': '1', 'start': 0, 'end': 100}
+        }),
+        headers=dict(Authorization='Authorization: Bearer teststring'),
+        content_type='application/json')
+    file_id = json.loads(rest_value.data)
+
+    rest_value = client.post(
+        '/mug/api/dmp/files',
+        data=json.dumps({'assembly': 'test_merge', 'regions': ['1:10:20', '2:10:20']}),
+        headers=dict(Authorization='Authorization: Bearer teststring'),
+        content_type='application/json')
+    assert [r['file_ids'] for r in json.loads(rest_value.data)['regions']] == [
+        [file_id, 'h5_file_1', 'h5_file_2'], ['h5_file_1', 'h5_file_2']]
+
+def test_files_14(client, request, monkeypatch):
+    """
+    Test that region index snapshots are only written once requested, keep
+    the real user and assembly, and that failures to write them are not
+    raised
+    """
+    snapshot_dir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(snapshot_dir))
+
+    def _loader(file_id):
+        return lambda: [{'_id': file_id, 'meta_data': {'chrom': '1', 'start': 0, 'end': 10}}]
+
+    # Both users are saved to the same sanitised directory
+    index = RegionIndex(snapshot_dir, save_interval=0)
+    assert index.query('a/b', 'GRCh38', '1', 5, 6, _loader('f1')) == ['f1']
+    assert os.listdir(snapshot_dir) == []
+    index.save_pending()
+    assert index.query('a_b', 'GRCh38', '1', 5, 6, _loader('f2')) == ['f2']
+    index.save_pending()
+    assert os.listdir(os.path.join(snapshot_dir, 'a_b')) == ['GRCh38']
+
+    index = RegionIndex(snapshot_dir)
+    index.warm()
+    assert index.stats() == {'a_b:GRCh38': 1}
+    assert index.query('a/b', 'GRCh38', '1', 5, 6) is None
+
+    index = RegionIndex(snapshot_dir)
+    index.remove_file('a_b', 'f2')
+    assert index.stats() == {'a_b:GRCh38': 0}
+
+    # The app writes snapshots once the response has been sent
+    monkeypatch.setattr(app.REGION_INDEX, 'snapshot_dir', os.path.join(snapshot_dir, 'app'))
+    rest_value = client.get(
+        '/mug/api/dmp/files?assembly=test_snapshot&region=1:1:3',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    assert not os.path.isdir(os.path.join(snapshot_dir, 'app'))
+    rest_value.close()
+    assert 'test_snapshot' in os.listdir(os.path.join(snapshot_dir, 'app', 'test'))
+
+    # The snapshot directory is a file
+    index = RegionIndex(os.path.join(snapshot_dir, 'a_b', 'GRCh38', 'manifest.json'))
+    assert index.query('test', 'GRCh38', '1', 5, 6, _loader('f1')) == ['f1']
+    index.save_pending()
+    index.flush()
+
+def test_files_15(request):
+    """
+    Test that changes made by another process only drop the cached indexes
+    and links for the users and assemblies that were changed
+    """
+    snapshot_dir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(snapshot_dir))
+
+    shared = multiprocessing.Value('L', 0)
+    slots = multiprocessing.Array('L', VERSION_SLOTS, lock=False)
+    local, other = VersionTracker(), VersionTracker()
+    local.share(shared, slots)
+    other.share(shared, slots)
+
+    loads = []
+
+    def _loader(file_id):
+        def _load():
+            loads.append(file_id)
+            return [{'_id': file_id, 'meta_data': {'chrom': '1', 'start': 0, 'end': 10}}]
+        return _load
+
+    index = RegionIndex(snapshot_dir, save_interval=0)
+    lineage = LineageCache()
+    for user_id, assembly in [('u1', 'GRCh38'), ('u1', 'GRCm38'), ('u2', 'GRCh38')]:
+        index.query(user_id, assembly, '1', 5, 6, _loader(user_id + assembly))
+        lineage.put(user_id, 'f1', ['f0'])
+    index.save_pending()
+
+    # Changes made by this process are not stale
+    local.bump('u1')
+    assert local.changed_elsewhere() is None
+
+    other.bump('u1', ['f2'], assemblies=['GRCh38'])
+    stale = local.changed_elsewhere()
+    assert stale('u1', 'GRCh38')
+    assert not stale('u1', 'GRCm38')
+    assert not stale('u2', 'GRCh38')
+    assert not stale('u1')
+    assert local.changed_elsewhere() is None
+
+    index.invalidate(stale)
+    lineage.invalidate_users(stale)
+    assert sorted(index.stats()) == ['u1:GRCm38', 'u2:GRCh38']
+    assert lineage.get('u1', 'f1') == ('f0',)
+
+    # The dropped index is rebuilt rather than loaded from its snapshot, and
+    # the snapshot is used again once it has been replaced
+    del loads[:]
+    assert index.query('u1', 'GRCh38', '1', 5, 6, _loader('new')) == ['new']
+    index.save_pending()
+    index.invalidate()
+    assert index.query('u1', 'GRCh38', '1', 5, 6, _loader('newer')) == ['newer']
+    index = RegionIndex(snapshot_dir)
+    assert index.query('u1', 'GRCh38', '1', 5, 6, _loader('unused')) == ['new']
+    assert loads == ['new', 'newer']
+
+    # Removing files can affect any assembly and the links
+    other.bump('u1', ['f1'])
+    stale = local.changed_elsewhere()
+    assert stale('u1') and stale('u1', 'GRCm38')
+    assert not stale('u2') and not stale('u2', 'GRCh38')
+    lineage.invalidate_users(stale)
+    assert lineage.get('u1', 'f1') is None
+    assert lineage.get('u2', 'f1') == ('f0',)
+
+def _no_hdf5_regions(self, user_id, assembly, regions):  # pylint: disable=unused-argument
+    """
+    HDF5 index without any files
+    """
+    return [{1: [], 1000: []} for _ in regions]
+
+def test_files_16(client, monkeypatch):
+    """
+    Test that the files overlapping each of a list of regions are returned
+    for both JSON and BED requests
+    """
+    # Only the files registered here, and not those in the HDF5 index
+    monkeypatch.setattr(app.Files, '_get_hdf5_regions', _no_hdf5_regions)
+    headers = dict(Authorization='Authorization: Bearer teststring')
+    files = []
+    for assembly, meta_data in [
+            ('test_batch', {'chrom': '1', 'start': 1000, 'end': 2000}),
+            ('test_batch', {'regions': [['1', 1500, 3000], ['2', 100, 200]]}),
+            ('test_batch_m', {'chrom': '1', 'start': 1000, 'end': 2000})]:
+        meta_data['assembly'] = assembly
+        files.append({
+            'file_path': '/tmp/test/batch.bed', 'file_type': 'bed', 'data_type': 'ChIP-seq',
+            'taxon_id': 9606, 'source_id': [], 'meta_data': meta_data
+        })
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta', data=json.dumps(files), headers=headers,
+        content_type='application/json')
+    file_ids = [result['file_id'] for result in json.loads(rest_value.data)['files']]
+
+    rest_value = client.post(
+        '/mug/api/dmp/files',
+        data=json.dumps({
+            'assembly': 'test_batch', 'include_files': True,
+            'regions': ['1:2500:2600', '1:100:200', ['2', 150, 160, 'peak_1'], '1:1900:1900']
+        }),
+        headers=headers, content_type='application/json')
+    details = json.loads(rest_value.data)
+    assert [r['file_ids'] for r in details['regions']] == [
+        [file_ids[1]], [], [file_ids[1]], [file_ids[0], file_ids[1]]]
+    assert details['regions'][2]['name'] == 'peak_1'
+    assert sorted(f['_id'] for f in details['files']) == sorted(file_ids[:2])
+
+    bed = 'track name=peaks\n1\t1200\t1300\tpeak_1\n2\t0\t50\tpeak_2\n'
+    rest_value = client.post(
+        '/mug/api/dmp/files?assembly=test_batch', data=bed, headers=headers,
+        content_type='text/x-bed')
+    details = json.loads(rest_value.data)
+    assert [(r['name'], r['file_ids']) for r in details['regions']] == [
+        ('peak_1', [file_ids[0]]), ('peak_2', [])]
+    assert 'files' not in details
+
+    rest_value = client.post(
+        '/mug/api/dmp/files?assembly=test_batch', data='1\t1200\n', headers=headers,
+        content_type='text/x-bed')
+    assert json.loads(rest_value.data)['error'] == 'InvalidParameters'
+
+def test_files_17(client, monkeypatch):
+    """
+    Test that files registered in bulk are inserted in chunks when the DM API
+    client exposes its database and that they can be read back
+    """
+    dmp_api = _EntriesClient()
+    inserts = []
+    insert_many = dmp_api.db.entries.insert_many
+
+    def _insert_many(docs, **kwargs):
+        inserts.append(len(docs))
+        return insert_many(docs, **kwargs)
+    monkeypatch.setattr(dmp_api.db.entries, 'insert_many', _insert_many)
+
+    def _get_file_by_id(user_id, file_id):
+        return dmp_api.db.entries.find_one(
+            {'_id': dm_store.to_object_ids([file_id])[0], 'user_id': user_id})
+    dmp_api.get_file_by_id = _get_file_by_id
+
+    @contextlib.contextmanager
+    def _get_dm_api(user_id=None):  # pylint: disable=unused-argument
+        yield dmp_api
+    monkeypatch.setattr(app, '_get_dm_api', _get_dm_api)
+
+    new_files = [{
+        'file_path': '/tmp/test/chunk_' + str(i) + '.bw', 'file_type': 'bw',
+        'data_type': 'RNA-seq', 'taxon_id': 9606, 'source_id': [],
+        'meta_data': {'assembly': 'GRCh38'}
+    } for i in range(3)]
+    results = dm_store.insert_files(dmp_api, 'test', new_files, chunk_size=2)
+    assert inserts == [2, 1]
+    assert [error for _, error in results] == [None, None, None]
+
+    rest_value = client.get(
+        '/mug/api/dmp/file_meta?file_id=' + results[2][0],
+        headers=dict(Authorization='Authorization: Bearer teststring'))
+    details = json.loads(rest_value.data)
+    assert details['file_path'] == '/tmp/test/chunk_2.bw'
+    assert isinstance(details['creation_time'], str)
+
+def test_files_18(client):
+    """
+    Test that malformed regions are rejected rather than raising an error
+    """
+    for region in ['1:10', '1:a:20', '1:20:10', '1:-5:10']:
+        for extra in ['', '&stats=1']:
+            rest_value = client.get(
+                '/mug/api/dmp/files?assembly=GRCh38&region=' + region + extra,
+                headers=dict(Authorization='Authorization: Bearer teststring'))
+            details = json.loads(rest_value.data)
+            assert (details['status_code'], details['error']) == (400, 'InvalidParameters')
@@ -0,0 +1,144 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import struct
+import tempfile
+import json
+import zlib
+import pytest
+
+from context import app
+
+HEADERS = dict(Authorization='Authorization: Bearer teststring')
+
+LINES = [
+    '1\t100\t200\tpeak_1\n',
+    '1\t150\t20000\tpeak_2\n',
+    '1\t40000\t40100\tpeak_3\n',
+    '2\t100\t200\tpeak_4\n',
+]
+
+@pytest.fixture
+def client(request):
+    """
+    Definges the client object to make requests against
+    """
+    db_fd, app.APP.config['DATABASE'] = tempfile.mkstemp()
+    app.APP.config['TESTING'] = True
+    client = app.APP.test_client()
+
+    def teardown():
+        """
+        Close the client once testing has completed
+        """
+        os.close(db_fd)
+        os.unlink(app.APP.config['DATABASE'])
+    request.addfinalizer(teardown)
+
+    return client
+
+def _bgzip(data, block_size=32):
+    """
+    Compress data as BGZF blocks, small enough for lines to span blocks
+    """
+    blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)] + [b'']
+    compressed = b''
+    for block in blocks:
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = deflate.compress(block) + deflate.flush()
+        compressed += struct.pack(
+            '<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(cdata) + 25)
+        compressed += cdata + struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block))
+    return compressed
+
+@pytest.fixture
+def bed_ids(client, request, monkeypatch):
+    """
+    Register an uncompressed and a bgzipped BED file
+    """
+    bed_dir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(bed_dir))
+    monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', [os.path.join(bed_dir, 'data')])
+    monkeypatch.setitem(app.APP.config, 'TABIX_INDEX_DIR', os.path.join(bed_dir, 'index'))
+    os.mkdir(os.path.join(bed_dir, 'data'))
+    data = ('track name=peaks\n' + ''.join(LINES)).encode('utf-8')
+
+    file_ids = []
+    for name, contents in [('peaks.bed', data), ('peaks.bed.gz', _bgzip(data))]:
+        file_path = os.path.join(bed_dir, 'data', name)
+        with open(file_path, 'wb') as handle:
+            handle.write(contents)
+        rest_value = client.post(
+            '/mug/api/dmp/file_meta',
+            data=json.dumps({
+                'file_path': file_path, 'file_type': 'bed', 'data_type': 'ChIP-seq',
+                'taxon_id': 9606, 'source_id': [], 'meta_data': {'assembly': 'GRCh38'}
+            }),
+            headers=HEADERS, content_type='application/json')
+        file_ids.append(json.loads(rest_value.data))
+    return file_ids
+
+def test_region_01(client):
+    """
+    Test that the region endpoint is returning the usage parameters
+    """
+    rest_value = client.get('/mug/api/dmp/region', headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert 'usage' in details
+
+def test_region_02(client, bed_ids):
+    """
+    Test that only the lines overlapping the region are returned, both from
+    uncompressed and bgzipped files
+    """
+    for file_id in bed_ids:
+        rest_value = client.get(
+            '/mug/api/dmp/region?region=1:190:30000&file_id=' + file_id, headers=HEADERS)
+        assert rest_value.mimetype == 'text/tab-separated-values'
+        assert rest_value.data.decode('utf-8') == LINES[0] + LINES[1]
+
+        rest_value = client.get(
+            '/mug/api/dmp/region?region=2:0:100&file_id=' + file_id, headers=HEADERS)
+        assert rest_value.data == b''
+
+        rest_value = client.get(
+            '/mug/api/dmp/region?region=2:0:101&file_id=' + file_id, headers=HEADERS)
+        assert rest_value.data.decode('utf-8') == LINES[3]
+
+def test_region_03(client, bed_ids, monkeypatch):
+    """
+    Test that the indexes are saved in the index directory rather than next
+    to the files, and that files are only read from the configured
+    directories
+    """
+    data_dir = app.APP.config['ORIGINAL_FILE_ROOTS'][0]
+    index_dir = app.APP.config['TABIX_INDEX_DIR']
+    for file_id in bed_ids:
+        rest_value = client.get(
+            '/mug/api/dmp/region?region=1:190:30000&file_id=' + file_id, headers=HEADERS)
+        assert rest_value.data.decode('utf-8') == LINES[0] + LINES[1]
+    assert sorted(os.listdir(data_dir)) == ['peaks.bed', 'peaks.bed.gz']
+    assert len([name for name in os.listdir(index_dir) if not name.startswith('.')]) == 2
+
+    monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', [index_dir])
+    rest_value = client.get(
+        '/mug/api/dmp/region?region=1:190:30000&file_id=' + bed_ids[0], headers=HEADERS)
+    assert json.loads(rest_value.data)['status_code'] == 403
@@ -0,0 +1,167 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import gzip
+import os
+import shutil
+import tempfile
+import json
+import pytest
+
+from context import app
+
+HEADERS = dict(Authorization='Authorization: Bearer teststring')
+
+SEQUENCE = 'ACGTTGCA' * 20
+
+RECORDS = ['@read_{}\n{}\n+\n{}\n'.format(i, 'ACGT' * 5, 'IIII' * 5) for i in range(50)]
+
+@pytest.fixture
+def client(request):
+    """
+    Definges the client object to make requests against
+    """
+    db_fd, app.APP.config['DATABASE'] = tempfile.mkstemp()
+    app.APP.config['TESTING'] = True
+    client = app.APP.test_client()
+
+    def teardown():
+        """
+        Close the client once testing has completed
+        """
+        os.close(db_fd)
+        os.unlink(app.APP.config['DATABASE'])
+    request.addfinalizer(teardown)
+
+    return client
+
+@pytest.fixture
+def sequence_dir(request, monkeypatch):
+    """
+    Directory for the sequence files, with their indexes kept elsewhere
+    """
+    path = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    os.mkdir(os.path.join(path, 'data'))
+    monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', [os.path.join(path, 'data')])
+    monkeypatch.setitem(app.APP.config, 'SEQUENCE_INDEX_DIR', os.path.join(path, 'index'))
+    return os.path.join(path, 'data')
+
+def _register(client, file_path, file_type):
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps({
+            'file_path': file_path, 'file_type': file_type, 'data_type': 'RNA-seq',
+            'taxon_id': 9606, 'source_id': [], 'meta_data': {'assembly': 'GRCh38'}
+        }),
+        headers=HEADERS, content_type='application/json')
+    return json.loads(rest_value.data)
+
+def test_sequence_01(client):
+    """
+    Test that the sequence endpoint is returning the usage parameters
+    """
+    rest_value = client.get('/mug/api/dmp/sequence', headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert 'usage' in details
+
+def test_sequence_02(client, sequence_dir, monkeypatch):
+    """
+    Test that subsequences spanning several lines are read from a FASTA file,
+    that the index is saved in the index directory and that files are only
+    read from the configured directories
+    """
+    file_path = os.path.join(sequence_dir, 'test.fasta')
+    with open(file_path, 'w') as handle:
+        handle.write('>1 test\n')
+        for i in range(0, len(SEQUENCE), 60):
+            handle.write(SEQUENCE[i:i + 60] + '\n')
+        handle.write('>2\nACGT\n')
+    file_id = _register(client, file_path, 'fasta')
+
+    rest_value = client.get(
+        '/mug/api/dmp/sequence?region=1:55:130&file_id=' + file_id, headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert details['sequence'] == SEQUENCE[55:130]
+    assert os.listdir(sequence_dir) == ['test.fasta']
+    index_dir = app.APP.config['SEQUENCE_INDEX_DIR']
+    assert [name for name in os.listdir(index_dir) if name.endswith('.fai')]
+
+    rest_value = client.get(
+        '/mug/api/dmp/sequence?region=2:2:100&file_id=' + file_id, headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert (details['sequence'], details['end']) == ('GT', 4)
+
+    rest_value = client.get(
+        '/mug/api/dmp/sequence?region=3:0:10&file_id=' + file_id, headers=HEADERS)
+    assert json.loads(rest_value.data)['error'] == 'UnknownChromosome'
+
+    monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', [index_dir])
+    rest_value = client.get(
+        '/mug/api/dmp/sequence?region=1:55:130&file_id=' + file_id, headers=HEADERS)
+    assert json.loads(rest_value.data)['status_code'] == 403
+
+def test_sequence_03(client, sequence_dir):
+    """
+    Test that the first records and a random sample of the records are
+    returned from plain and gzipped FASTQ files
+    """
+    file_ids = []
+    for name, opener in [('test.fastq', open), ('test.fastq.gz', gzip.open)]:
+        file_path = os.path.join(sequence_dir, name)
+        with opener(file_path, 'wb') as handle:
+            handle.write(''.join(RECORDS).encode('utf-8'))
+        file_ids.append(_register(client, file_path, 'fastq'))
+
+    for file_id in file_ids:
+        rest_value = client.get(
+            '/mug/api/dmp/sequence?records=3&file_id=' + file_id, headers=HEADERS)
+        assert rest_value.data.decode('utf-8') == ''.join(RECORDS[:3])
+
+        url = '/mug/api/dmp/sequence?records=5&sample=1&seed=1&file_id=' + file_id
+        sample = client.get(url, headers=HEADERS).data.decode('utf-8')
+        records = ['@' + record for record in sample.split('@')[1:]]
+        assert len(records) == 5
+        assert sorted(records, key=RECORDS.index) == records
+        assert client.get(url, headers=HEADERS).data.decode('utf-8') == sample
+
+def test_sequence_04(client, sequence_dir):
+    """
+    Test that the ETag changes when the file is rewritten without its record
+    changing
+    """
+    file_path = os.path.join(sequence_dir, 'test.fasta')
+    with open(file_path, 'w') as handle:
+        handle.write('>1\n' + SEQUENCE + '\n')
+    file_id = _register(client, file_path, 'fasta')
+
+    url = '/mug/api/dmp/sequence?region=1:0:8&file_id=' + file_id
+    rest_value = client.get(url, headers=HEADERS)
+    etag = rest_value.headers['ETag']
+    headers = dict(HEADERS, **{'If-None-Match': etag})
+    assert client.get(url, headers=headers).status_code == 304
+
+    with open(file_path, 'w') as handle:
+        handle.write('>1\n' + SEQUENCE[::-1] + '\n')
+    stat = os.stat(file_path)
+    os.utime(file_path, (stat.st_atime, stat.st_mtime + 10))
+    rest_value = client.get(url, headers=headers)
+    assert rest_value.status_code == 200
+    assert rest_value.headers['ETag'] != etag
+    assert json.loads(rest_value.data)['sequence'] == SEQUENCE[::-1][:8]
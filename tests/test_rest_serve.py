@@ -0,0 +1,161 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+import pytest
+
+from context import app
+from rest import serve
+
+class _Channel(object):
+    """
+    Connection with the requests that are running on it
+    """
+
+    def __init__(self, requests):
+        self.requests = requests
+
+class _Server(object):
+    """
+    Server with the attributes used to drain and reload it
+    """
+
+    def __init__(self):
+        self.accepting = True
+        self.active_channels = {}
+
+@pytest.fixture
+def registry(request):
+    """
+    Put the DM API client pools back as they were once testing has completed
+    """
+    pools = app.DM_REGISTRY._pools  # pylint: disable=protected-access
+    sizes = {mode: pool.max_size for mode, pool in pools.items()}
+
+    def teardown():
+        """
+        Resize and clear the pools
+        """
+        for mode, size in sizes.items():
+            app.DM_REGISTRY.resize(size, mode=mode)
+        app.DM_REGISTRY.reload()
+    request.addfinalizer(teardown)
+
+def test_serve_01():
+    """
+    Test that the launcher options are parsed with the expected defaults
+    """
+    options = serve._parse_args([])  # pylint: disable=protected-access
+    assert (options.host, options.port, options.threads, options.workers) == (
+        '127.0.0.1', 5002, 4, 1)
+    assert (options.backend, options.sqlite_path, options.no_warm) == (None, None, False)
+    assert options.max_start_failures == 5
+
+    options = serve._parse_args([  # pylint: disable=protected-access
+        '--threads', '8', '--workers', '2', '--backend', 'sqlite',
+        '--sqlite-path', '/tmp/dmp.sqlite', '--no-warm', '--max-start-failures', '2'])
+    assert (options.threads, options.workers, options.backend) == (8, 2, 'sqlite')
+    assert (options.sqlite_path, options.no_warm, options.max_start_failures) == (
+        '/tmp/dmp.sqlite', True, 2)
+
+    with pytest.raises(SystemExit):
+        serve._parse_args(['--backend', 'mongo'])  # pylint: disable=protected-access
+
+def test_serve_02(request, registry, monkeypatch):  # pylint: disable=unused-argument
+    """
+    Test that starting a process applies the backend options and sizes the
+    client pools to the number of threads
+    """
+    db_dir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(db_dir))
+    sqlite_path = os.path.join(db_dir, 'dmp.sqlite')
+    monkeypatch.setitem(app.APP.config, 'DM_BACKEND', 'dmp')
+    monkeypatch.setitem(app.APP.config, 'DM_SQLITE_PATH', None)
+    warmed = []
+    monkeypatch.setattr(serve, 'warm', lambda: warmed.append(True))
+
+    serve._start(serve._parse_args([  # pylint: disable=protected-access
+        '--threads', '6', '--backend', 'sqlite', '--sqlite-path', sqlite_path, '--no-warm']))
+    assert app.APP.config['DM_BACKEND'] == 'sqlite'
+    assert app.APP.config['DM_SQLITE_PATH'] == sqlite_path
+    assert app.DM_REGISTRY.stats()['test']['max_size'] == 6
+    assert warmed == []
+
+    serve._start(serve._parse_args(['--threads', '2']))  # pylint: disable=protected-access
+    assert app.APP.config['DM_SQLITE_PATH'] == sqlite_path
+    assert app.DM_REGISTRY.stats()['live']['max_size'] == 2
+    assert warmed == [True]
+
+def test_serve_03(monkeypatch):
+    """
+    Test that reloading a single process server waits for the running
+    requests, clears the caches and then accepts connections again
+    """
+    calls = []
+    for name in ['REGION_INDEX', 'LINEAGE_CACHE', 'HANDLE_CACHE']:
+        monkeypatch.setattr(
+            getattr(app, name), 'clear', lambda name=name: calls.append(name))
+    monkeypatch.setattr(serve, '_start', lambda options: calls.append('start'))
+
+    server = _Server()
+    channel = server.active_channels[1] = _Channel(['request'])
+    options = serve._parse_args([])  # pylint: disable=protected-access
+    reload_thread = serve._reload(server, options)  # pylint: disable=protected-access
+
+    time.sleep(0.3)
+    assert server.accepting is False
+    assert calls == []
+
+    channel.requests = []
+    reload_thread.join(5)
+    assert calls == ['REGION_INDEX', 'LINEAGE_CACHE', 'HANDLE_CACHE', 'start']
+    assert server.accepting is True
+
+def test_serve_04(request):
+    """
+    Test that workers that fail to start are replaced with an increasing
+    delay and that the master gives up after too many failures in a row
+    """
+    master = serve.Master(serve._parse_args([  # pylint: disable=protected-access
+        '--port', '0', '--workers', '2', '--max-start-failures', '3']))
+    request.addfinalizer(master.sock.close)
+    start_failed = serve.START_FAILED << 8
+
+    def _delay():
+        return master.respawn_at.pop() - time.time()
+
+    master._replace(start_failed)  # pylint: disable=protected-access
+    assert serve.RESPAWN_DELAY < _delay() <= 2 * serve.RESPAWN_DELAY
+    master._replace(start_failed)  # pylint: disable=protected-access
+    assert 2 * serve.RESPAWN_DELAY < _delay() <= 4 * serve.RESPAWN_DELAY
+
+    # A worker that started resets the failures
+    master.started.value += 1
+    master._replace(1 << 8)  # pylint: disable=protected-access
+    assert _delay() <= serve.RESPAWN_DELAY
+    assert master.failures == 0
+
+    for _ in range(3):
+        master._replace(start_failed)  # pylint: disable=protected-access
+    assert master.stopping is True
+    assert master.failed is True
+    assert len(master.respawn_at) == 2
@@ -0,0 +1,146 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import json
+import pytest
+
+from context import app
+
+HEADERS = dict(Authorization='Authorization: Bearer teststring')
+
+def _reset_caches():
+    app.DM_REGISTRY.reload()
+    app.REGION_INDEX.invalidate()
+    app.LINEAGE_CACHE.clear()
+
+@pytest.fixture
+def client(request):
+    """
+    Client for the app running with the sqlite backend
+    """
+    db_dir = tempfile.mkdtemp()
+    backend = app.APP.config['DM_BACKEND']
+    sqlite_path = app.APP.config['DM_SQLITE_PATH']
+    app.APP.config['TESTING'] = True
+    app.APP.config['DM_BACKEND'] = 'sqlite'
+    app.APP.config['DM_SQLITE_PATH'] = os.path.join(db_dir, 'dmp.sqlite')
+    _reset_caches()
+    client = app.APP.test_client()
+
+    def teardown():
+        """
+        Switch back to the original backend once testing has completed
+        """
+        app.APP.config['DM_BACKEND'] = backend
+        app.APP.config['DM_SQLITE_PATH'] = sqlite_path
+        _reset_caches()
+        shutil.rmtree(db_dir)
+    request.addfinalizer(teardown)
+
+    return client
+
+def _register(client, files):
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta', data=json.dumps(files), headers=HEADERS,
+        content_type='application/json')
+    return [result['file_id'] for result in json.loads(rest_value.data)['files']]
+
+def _file(source_id, file_type='bw', **meta_data):
+    meta_data.setdefault('assembly', 'GRCh38')
+    return {
+        'file_path': '/tmp/test/file.' + file_type, 'file_type': file_type,
+        'data_type': 'RNA-seq', 'taxon_id': 9606, 'source_id': source_id,
+        'meta_data': meta_data
+    }
+
+def test_sqlite_files(client):
+    """
+    Test that registered files can be listed, filtered and found by region
+    """
+    file_ids = _register(client, [
+        _file([], 'fastq'),
+        _file([], chrom='1', start=1000, end=2000),
+        _file([], chrom='1', start=5000, end=6000, assembly='GRCm38'),
+    ])
+    assert len(file_ids) == 3
+
+    rest_value = client.get('/mug/api/dmp/files?by_user=1&limit=2', headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert [f['_id'] for f in details['files']] == file_ids[:2]
+    assert '_next' in details['_links']
+
+    rest_value = client.get('/mug/api/dmp/files?assembly=GRCh38&file_type=bw', headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert [f['_id'] for f in details['files']] == [file_ids[1]]
+
+    rest_value = client.get(
+        '/mug/api/dmp/files?assembly=GRCh38&region=1:1500:1600', headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert [f['_id'] for f in details['files']] == [file_ids[1]]
+
+def test_sqlite_history(client):
+    """
+    Test that the lineage of a file is followed through the source links and
+    that files can be removed by source
+    """
+    root_id = _register(client, [_file([], 'fastq')])[0]
+    bam_id = _register(client, [_file([root_id], 'bam')])[0]
+    bw_id = _register(client, [_file([bam_id], 'bw')])[0]
+
+    rest_value = client.get(
+        '/mug/api/dmp/file_history?file_id=' + bw_id, headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert details['history_files'] == [bam_id, root_id]
+
+    rest_value = client.get(
+        '/mug/api/dmp/file_history?depth=0&file_id=' + bw_id, headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert [node['_id'] for node in details['nodes']] == [bw_id, bam_id, root_id]
+
+    rest_value = client.delete(
+        '/mug/api/dmp/file_meta', data=json.dumps({'filter': {'source_id': root_id}}),
+        headers=HEADERS, content_type='application/json')
+    results = [json.loads(line) for line in rest_value.data.decode('utf-8').splitlines()]
+    assert results == [{'file_id': bam_id, 'status': 'deleted'}]
+
+def test_sqlite_ids(client):
+    """
+    Test that file ids and cursors that the store could not have generated
+    are not found or rejected
+    """
+    file_ids = _register(client, [_file([]), _file([])])
+
+    for file_id in ['f' * 24, '-1', 'testtest0000']:
+        rest_value = client.get('/mug/api/dmp/file_meta?file_id=' + file_id, headers=HEADERS)
+        assert json.loads(rest_value.data)['status_code'] == 404
+
+    for cursor in [app._encode_cursor('f' * 24), app._encode_cursor('zz'), '%%%']:  # pylint: disable=protected-access
+        for stream in ['0', '1']:
+            rest_value = client.get(
+                '/mug/api/dmp/files?by_user=1&limit=1&stream=' + stream + '&cursor=' + cursor,
+                headers=HEADERS)
+            assert json.loads(rest_value.data)['status_code'] == 400
+
+    rest_value = client.get(
+        '/mug/api/dmp/files?by_user=1&limit=1&cursor=' + app._encode_cursor(file_ids[0]),  # pylint: disable=protected-access
+        headers=HEADERS)
+    assert [f['_id'] for f in json.loads(rest_value.data)['files']] == file_ids[1:]
@@ -0,0 +1,213 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import shutil
+import tempfile
+import json
+import pytest
+
+from context import app
+from rest.handle_cache import HandleCache
+
+HEADERS = dict(Authorization='Authorization: Bearer teststring')
+
+@pytest.fixture
+def client(request):
+    """
+    Definges the client object to make requests against
+    """
+    db_fd, app.APP.config['DATABASE'] = tempfile.mkstemp()
+    app.APP.config['TESTING'] = True
+    client = app.APP.test_client()
+
+    def teardown():
+        """
+        Close the client once testing has completed
+        """
+        os.close(db_fd)
+        os.unlink(app.APP.config['DATABASE'])
+    request.addfinalizer(teardown)
+
+    return client
+
+@pytest.fixture
+def bigwig_id(client, request, monkeypatch):
+    """
+    Register a small bigWig file with a value of 1 to 10 for each base of
+    1:0:10 and no data after that
+    """
+    pyBigWig = pytest.importorskip('pyBigWig')
+    track_dir = tempfile.mkdtemp()
+    file_path = os.path.join(track_dir, 'test.bw')
+
+    handle = pyBigWig.open(file_path, 'w')
+    handle.addHeader([('1', 1000)])
+    handle.addEntries('1', 0, values=[float(i) for i in range(1, 11)], span=1, step=1)
+    handle.close()
+    request.addfinalizer(lambda: shutil.rmtree(track_dir))
+    monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', [track_dir])
+
+    rest_value = client.post(
+        '/mug/api/dmp/file_meta',
+        data=json.dumps({
+            'file_path': file_path, 'file_type': 'bw', 'data_type': 'RNA-seq',
+            'taxon_id': 9606, 'source_id': [], 'meta_data': {'assembly': 'GRCh38'}
+        }),
+        headers=HEADERS, content_type='application/json')
+    return json.loads(rest_value.data)
+
+def test_track_01(client):
+    """
+    Test that the track endpoint is returning the usage parameters
+    """
+    rest_value = client.get('/mug/api/dmp/track', headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert 'usage' in details
+
+def test_track_02(client, bigwig_id):
+    """
+    Test that the values and binned summaries are returned for a region
+    """
+    rest_value = client.get(
+        '/mug/api/dmp/track?region=1:5:15&file_id=' + bigwig_id, headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert details['values'] == [6.0, 7.0, 8.0, 9.0, 10.0, None, None, None, None, None]
+
+    rest_value = client.get(
+        '/mug/api/dmp/track?region=1:0:10&bins=2&summary=max&file_id=' + bigwig_id,
+        headers=HEADERS)
+    details = json.loads(rest_value.data)
+    assert details['values'] == [5.0, 10.0]
+
+def test_track_03(client, bigwig_id):
+    """
+    Test that the values can be returned as a NumPy .npz file
+    """
+    np = pytest.importorskip('numpy')
+    rest_value = client.get(
+        '/mug/api/dmp/track?region=1:0:4&format=npz&file_id=' + bigwig_id, headers=HEADERS)
+    arrays = np.load(io.BytesIO(rest_value.data))
+    assert arrays['values'].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+def test_track_04(client, bigwig_id):
+    """
+    Test that the open track file is reused between requests
+    """
+    for _ in range(2):
+        client.get(
+            '/mug/api/dmp/track?region=1:0:4&file_id=' + bigwig_id, headers=HEADERS)
+    rest_value = client.get('/mug/api/dmp/ping')
+    details = json.loads(rest_value.data)
+    assert details['handle_cache']['hits'] >= 1
+
+def _no_hdf5_regions(self, user_id, assembly, regions):  # pylint: disable=unused-argument
+    """
+    HDF5 index without any files
+    """
+    return [{1: [], 1000: []} for _ in regions]
+
+def test_track_05(client, request, monkeypatch):
+    """
+    Test that region queries return the overlap of each file with the region
+    and can be ordered and trimmed by it
+    """
+    # Only the files registered here, and not those in the HDF5 index
+    monkeypatch.setattr(app.Files, '_get_hdf5_regions', _no_hdf5_regions)
+    pyBigWig = pytest.importorskip('pyBigWig')
+    track_dir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(track_dir))
+    monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', [track_dir])
+    file_path = os.path.join(track_dir, 'test.bw')
+
+    handle = pyBigWig.open(file_path, 'w')
+    handle.addHeader([('1', 1000)])
+    handle.addEntries('1', 0, values=[float(i) for i in range(1, 11)], span=1, step=1)
+    handle.close()
+
+    file_ids = []
+    for file_type, path, end in [('bw', file_path, 10), ('bed', '/tmp/test.bed', 100)]:
+        rest_value = client.post(
+            '/mug/api/dmp/file_meta',
+            data=json.dumps({
+                'file_path': path, 'file_type': file_type, 'data_type': 'ChIP-seq',
+                'taxon_id': 9606, 'source_id': [],
+                'meta_data': {'assembly': 'test_stats', 'chrom': '1', 'start': 0, 'end': end}
+            }),
+            headers=HEADERS, content_type='application/json')
+        file_ids.append(json.loads(rest_value.data))
+
+    url = '/mug/api/dmp/files?assembly=test_stats&region=1:5:15&stats=1'
+    rest_value = client.get(url + '&sort=mean', headers=HEADERS)
+    files = json.loads(rest_value.data)['files']
+    assert [f['_id'] for f in files] == file_ids
+    assert files[0]['region_stats'] == {
+        'features': 1, 'bases_covered': 5, 'min': 6.0, 'mean': 8.0, 'max': 10.0}
+    assert files[1]['region_stats'] == {'features': 1, 'bases_covered': 10}
+
+    rest_value = client.get(url + '&sort=bases_covered&limit=1', headers=HEADERS)
+    assert [f['_id'] for f in json.loads(rest_value.data)['files']] == file_ids[1:]
+
+    # Tracks outside of the configured directories are not read
+    monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', [tempfile.gettempdir() + '/none'])
+    rest_value = client.get(url, headers=HEADERS)
+    files = json.loads(rest_value.data)['files']
+    assert files[0]['region_stats'] == {'features': 1, 'bases_covered': 5}
+
+def test_track_06(client, bigwig_id, monkeypatch):
+    """
+    Test that tracks are only read from the configured directories
+    """
+    url = '/mug/api/dmp/track?region=1:0:4&file_id=' + bigwig_id
+    rest_value = client.get(url, headers=HEADERS)
+    assert json.loads(rest_value.data)['values'] == [1.0, 2.0, 3.0, 4.0]
+
+    for roots in [None, [tempfile.gettempdir() + '/none']]:
+        monkeypatch.setitem(app.APP.config, 'ORIGINAL_FILE_ROOTS', roots)
+        rest_value = client.get(url, headers=HEADERS)
+        assert json.loads(rest_value.data)['status_code'] == 403
+
+def test_track_07(request):
+    """
+    Test that a file opened by different readers gets a handle from each of
+    them and that discarding the file closes all of its handles
+    """
+    file_dir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(file_dir))
+    file_path = os.path.join(file_dir, 'test.bed')
+    with open(file_path, 'w') as handle:
+        handle.write('1\t0\t10\n')
+
+    cache = HandleCache()
+    closed = []
+
+    def _opener(kind):
+        return lambda path: (kind, path)
+
+    for _ in range(2):
+        with cache.open(file_path, _opener('tabix'), 'tabix', closed.append) as handle:
+            assert handle == ('tabix', file_path)
+        with cache.open(file_path, _opener('fasta'), 'fasta', closed.append) as handle:
+            assert handle == ('fasta', file_path)
+    assert (cache.stats()['open'], cache.stats()['hits']) == (2, 2)
+
+    cache.discard(file_path)
+    assert sorted(closed) == [('fasta', file_path), ('tabix', file_path)]
+    assert cache.stats()['open'] == 0
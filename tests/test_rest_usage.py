@@ -17,12 +17,15 @@
 
 from __future__ import print_function
 
+import gc
 import os
 import tempfile
+import threading
 import json
 import pytest
 
 from context import app
+from rest.metrics import Counter
 
 @pytest.fixture
 def client(request):
@@ -63,6 +66,16 @@ def test_ping(client):
     #print(details)
     assert 'status' in details
 
+def test_ping_dm_pool(client):
+    """
+    Test that the ping function is reporting the DM API client pool stats
+    """
+    rest_value = client.get('/mug/api/dmp/ping')
+    details = json.loads(rest_value.data)
+    assert 'dm_pool' in details
+    assert 'live' in details['dm_pool']
+    assert 'test' in details['dm_pool']
+
 def test_file(client):
     """
     Test that the track endpoint is returning the usage paramerts
@@ -99,3 +112,78 @@ def test_filehistory(client):
     details = json.loads(rest_value.data)
     # print(details)
     assert 'usage' in details
+
+def test_token_purge(client):
+    """
+    Test that a token used for a request is cached and can then be purged
+    """
+    client.get(
+        '/mug/api/dmp/files?by_user=1',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    rest_value = client.delete(
+        '/mug/api/dmp/token',
+        headers=dict(Authorization='Authorization: Bearer teststring')
+    )
+    details = json.loads(rest_value.data)
+    assert details['purged'] is True
+
+def test_metrics(client):
+    """
+    Test that the metrics endpoint reports the requests that have been made
+    """
+    client.get('/mug/api/dmp/ping')
+    rest_value = client.get('/mug/api/dmp/metrics')
+    assert rest_value.mimetype == 'text/plain'
+    metrics = rest_value.data.decode('utf-8')
+    assert '# TYPE dmp_http_request_duration_seconds histogram' in metrics
+    assert 'dmp_http_requests_total{resource="Ping",method="GET",status="200"}' in metrics
+
+def test_metrics_threads():
+    """
+    Test that the values recorded by threads that have finished are kept
+    without keeping a list of values for each of the threads
+    """
+    counter = Counter('test_total', 'Test counter')
+
+    def _inc():
+        for _ in range(10):
+            counter.inc()
+
+    for _ in range(5):
+        threads = [threading.Thread(target=_inc) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    del thread, threads
+    gc.collect()
+
+    assert counter.render()[-1] == 'test_total 200'
+    assert len(counter._series[()]._shards) == 0  # pylint: disable=protected-access
+
+def test_profile(client):
+    """
+    Test that a request is profiled when asked for and that old profiles are
+    rotated out
+    """
+    profile_dir = tempfile.mkdtemp()
+    app.APP.config['PROFILE_ENABLED'] = True
+    app.APP.config['PROFILE_DIR'] = profile_dir
+    app.APP.config['PROFILE_MAX_FILES'] = 2
+    try:
+        client.get('/mug/api/dmp/ping')
+        assert os.listdir(profile_dir) == []
+
+        rest_value = client.get('/mug/api/dmp/ping?profile=1')
+        rest_value.close()
+        assert 'X-Profile-Id' in rest_value.headers
+        profiles = sorted(os.listdir(profile_dir))
+        assert [os.path.splitext(p)[1] for p in profiles] == ['.collapsed', '.pstats']
+
+        client.get('/mug/api/dmp/ping', headers={'X-Profile': 'cprofile'}).close()
+        assert len(os.listdir(profile_dir)) == 2
+    finally:
+        app.APP.config['PROFILE_ENABLED'] = False
+        app.APP.config['PROFILE_DIR'] = None
+        app.APP.config['PROFILE_MAX_FILES'] = 50